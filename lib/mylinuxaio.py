@@ -0,0 +1,134 @@
+#
+#   Linux native AIO (io_submit and friends) through ctypes
+#
+#   There is no wrapper for it in the standard library (and libaio may
+#   not be installed), so the system calls are made directly.  Their
+#   numbers depend on the architecture.
+#
+#   (see /usr/include/linux/aio_abi.h)
+#
+
+import errno
+import os
+import platform
+
+from ctypes import *
+
+
+IOCB_CMD_PREAD = 0
+IOCB_CMD_PWRITE = 1
+
+IOCB_FLAG_RESFD = 1             # Signal an eventfd on completion
+
+# (io_setup, io_destroy, io_getevents, io_submit, io_cancel)
+SYSCALL_NUMBERS = {
+    "x86_64":  (206, 207, 208, 209, 210),
+    "i686":    (245, 246, 247, 248, 249),
+    "aarch64": (0, 1, 4, 2, 3),
+    "riscv64": (0, 1, 4, 2, 3),
+    "armv6l":  (243, 244, 245, 246, 247),
+    "armv7l":  (243, 244, 245, 246, 247),
+}
+
+libc = CDLL(None, use_errno=True)
+libc.syscall.restype = c_long
+
+
+class iocb(LittleEndianStructure):
+    _fields_ = [ ('aio_data', c_uint64),
+                ('aio_key', c_uint32),
+                ('aio_rw_flags', c_int32),
+                ('aio_lio_opcode', c_uint16),
+                ('aio_reqprio', c_int16),
+                ('aio_fildes', c_uint32),
+                ('aio_buf', c_uint64),
+                ('aio_nbytes', c_uint64),
+                ('aio_offset', c_int64),
+                ('aio_reserved2', c_uint64),
+                ('aio_flags', c_uint32),
+                ('aio_resfd', c_uint32) ]
+
+class io_event(LittleEndianStructure):
+    _fields_ = [ ('data', c_uint64),
+                ('obj', c_uint64),
+                ('res', c_int64),
+                ('res2', c_int64) ]
+
+class timespec(Structure):
+    _fields_ = [ ('tv_sec', c_long),
+                ('tv_nsec', c_long) ]
+
+
+def check_syscall(ret):
+    if ret < 0:
+        err = get_errno()
+        raise OSError(err, os.strerror(err))
+
+    return ret
+
+
+class AIOContext:
+    def __init__(self, max_events):
+        numbers = SYSCALL_NUMBERS.get(platform.machine())
+
+        if numbers is None:
+            raise OSError(errno.ENOSYS, "No native AIO on " +
+                          platform.machine())
+
+        (self.nr_setup, self.nr_destroy, self.nr_getevents,
+         self.nr_submit, self.nr_cancel) = numbers
+
+        self.ctx = c_ulong(0)
+        self.events = (io_event * max_events)()
+        self.max_events = max_events
+
+        check_syscall(libc.syscall(c_long(self.nr_setup),
+                                   c_uint(max_events), byref(self.ctx)))
+
+    #
+    #   Queue one read or write of "length" bytes at "address" (the
+    #   iocb and the memory have to be kept until it completes).  "data"
+    #   comes back with the completion.
+    #
+    def prepare(self, one_iocb, opcode, fd, address, length, data,
+                event_fd=None):
+        memset(byref(one_iocb), 0, sizeof(one_iocb))
+
+        one_iocb.aio_data = data
+        one_iocb.aio_lio_opcode = opcode
+        one_iocb.aio_fildes = fd
+        one_iocb.aio_buf = address
+        one_iocb.aio_nbytes = length
+
+        if event_fd is not None:
+            one_iocb.aio_flags = IOCB_FLAG_RESFD
+            one_iocb.aio_resfd = event_fd
+
+    def submit(self, one_iocb):
+        iocbs = (POINTER(iocb) * 1)(pointer(one_iocb))
+
+        return check_syscall(libc.syscall(c_long(self.nr_submit), self.ctx,
+                                          c_long(1), iocbs))
+
+    # The completions so far as (data, result), without waiting
+    def get_events(self):
+        result = []
+        no_wait = timespec(0, 0)
+        count = self.max_events
+
+        while count == self.max_events:
+            count = check_syscall(libc.syscall(c_long(self.nr_getevents),
+                                               self.ctx, c_long(0),
+                                               c_long(self.max_events),
+                                               self.events, byref(no_wait)))
+
+            for i in range(count):
+                result.append((self.events[i].data, self.events[i].res))
+
+        return result
+
+    # (waits for or cancels everything that is still queued)
+    def destroy(self):
+        if self.ctx.value != 0:
+            check_syscall(libc.syscall(c_long(self.nr_destroy), self.ctx))
+            self.ctx = c_ulong(0)
@@ -7,6 +7,7 @@ class usbNull:
 
     def __init__(self):
         self.max_packet = 512
+        self.via_relay = False
 
     def send_packet(self, data):
         print(">", data)
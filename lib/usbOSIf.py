@@ -12,6 +12,8 @@ class usbOSIf:
 
         self.max_packet = max_packet  # Size of largest USB bulk transaction
 
+        self.via_relay = False
+
         self.buffer = bytearray(self.max_packet)
         self.buffer_mv = memoryview(self.buffer)
 
@@ -33,6 +35,23 @@ class usbOSIf:
 
         return still_ok
 
+    # One packet from several buffers (e.g. a header and its data)
+    def send_packet_vec(self, bufs):
+        still_ok = 1
+        pack_len = sum(len(one_buf) for one_buf in bufs)
+
+        num_bytes = os.writev(self.out_fd, bufs)
+
+        # The same ZLP rule as send_packet()
+        if (pack_len != self.max_packet) and (pack_len % self.bulkSize == 0):
+            os.write(self.out_fd, b"")
+
+        if num_bytes != pack_len:
+            print("Error sending data packet", num_bytes, "of", pack_len)
+            still_ok = 0
+
+        return still_ok
+
     def receive_packet(self, timeout=None):
         still_ok = True
 
@@ -66,3 +85,6 @@ class usbOSIf:
         self.buffer_mv = memoryview(self.buffer)
 
         return (old_size, new_size)
+
+    def close(self):
+        pass        # (the endpoints are closed by their owner)
@@ -0,0 +1,322 @@
+#
+#   usbOSIf, but with several transfers queued on the endpoints at once
+#
+#   With one blocking read or write at a time, the UDC is idle between
+#   transfers (while the server works out what to send next).  Here up
+#   to "depth" reads are kept queued on the OUT endpoint, and up to
+#   "depth" writes on the IN endpoint, so the bulk pipe stays full:
+#   send_packet() only queues a packet (an error shows up as a failure
+#   of a later send), and receive_packet() takes the next packet that
+#   arrived.
+#
+#   FunctionFS endpoints take native AIO (io_submit, see mylinuxaio),
+#   with the completions signalled through an eventfd that the server
+#   waits on.  Where that is not available, a thread for each endpoint
+#   does the blocking reads and writes instead (see open_async()).
+#
+
+import os
+import queue
+import select
+import sys
+import threading
+import time
+
+from ctypes import addressof, c_char
+
+import mylinuxaio
+import usbOSIf
+
+DEF_DEPTH = 4
+
+# aio_data of writes (reads are 0 and up)
+WRITE_DATA = 1 << 16
+
+
+#
+#   The native AIO version (or the thread version if it cannot be used)
+#
+def open_async(in_fd, out_fd, max_packet, depth=DEF_DEPTH, bulkSize=512):
+    try:
+        port = usbOSIfAIO(in_fd, out_fd, max_packet, depth, bulkSize)
+
+    except (OSError, AttributeError) as my_except:
+        print("Native AIO is not available (" + str(my_except) +
+              "), using threads", file=sys.stderr)
+
+        port = usbOSIfThreaded(in_fd, out_fd, max_packet, depth, bulkSize)
+
+    return port
+
+
+class usbOSIfAIO(usbOSIf.usbOSIf):
+
+    def __init__(self, in_fd, out_fd, max_packet, depth=DEF_DEPTH,
+                 bulkSize=512):
+        usbOSIf.usbOSIf.__init__(self, in_fd, out_fd, max_packet, bulkSize)
+
+        self.depth = max(depth, 1)
+
+        # (a write may need a zero length packet after it)
+        self.aio = mylinuxaio.AIOContext(3 * self.depth)
+        self.event_fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+
+        # Only one thread waits for completions, the rest wait on "cond"
+        self.cond = threading.Condition()
+        self.reaping = False
+
+        # Reads - the packets that arrived (by the order they were
+        #  queued in), and the buffer that receive_packet() returned last
+        self.in_iocbs = [mylinuxaio.iocb() for i in range(self.depth)]
+        self.in_buffers = [None] * self.depth
+        self.in_seq = [0] * self.depth
+        self.arrived = {}
+        self.next_seq = 0
+        self.last_seq = 0
+        self.lent = None
+
+        # Writes
+        self.out_iocbs = [mylinuxaio.iocb() for i in range(2 * self.depth)]
+        self.out_buffers = [None] * (2 * self.depth)
+        self.out_free = list(range(2 * self.depth))
+        self.out_failed = False
+
+        with self.cond:
+            for i in range(self.depth):
+                self.__submit_read(i)
+
+    # Queue a read into buffer "i" (the lock is already held)
+    def __submit_read(self, i):
+        if (self.in_buffers[i] is None) or \
+                (len(self.in_buffers[i]) != self.max_packet):
+            self.in_buffers[i] = bytearray(self.max_packet)
+
+        buffer = self.in_buffers[i]
+
+        self.aio.prepare(self.in_iocbs[i], mylinuxaio.IOCB_CMD_PREAD,
+                         self.in_fd,
+                         addressof((c_char * len(buffer)).from_buffer(buffer)),
+                         len(buffer), i, self.event_fd)
+
+        self.in_seq[i] = self.last_seq
+        self.last_seq += 1
+
+        self.aio.submit(self.in_iocbs[i])
+
+    # Queue a write from buffer "i" (the lock is already held)
+    def __submit_write(self, i, length):
+        buffer = self.out_buffers[i]
+
+        self.aio.prepare(self.out_iocbs[i], mylinuxaio.IOCB_CMD_PWRITE,
+                         self.out_fd,
+                         addressof((c_char * len(buffer)).from_buffer(buffer)),
+                         length, WRITE_DATA + i, self.event_fd)
+
+        self.aio.submit(self.out_iocbs[i])
+
+    #
+    #   Wait up to "timeout" seconds (None = forever) for completions, and
+    #   handle them.  The lock is already held (and is let go while
+    #   waiting).
+    #
+    def __wait(self, timeout):
+        if self.reaping:
+            self.cond.wait(timeout)
+
+        else:
+            self.reaping = True
+            self.cond.release()
+
+            try:
+                (r, w, e) = select.select([self.event_fd], [], [], timeout)
+
+                if self.event_fd in r:
+                    os.eventfd_read(self.event_fd)
+
+                events = self.aio.get_events()
+
+            finally:
+                self.cond.acquire()
+                self.reaping = False
+
+            for (data, res) in events:
+                if data >= WRITE_DATA:
+                    self.__write_done(data - WRITE_DATA, res)
+                else:
+                    self.arrived[self.in_seq[data]] = (data, res)
+
+            self.cond.notify_all()
+
+    def __write_done(self, i, res):
+        if res != self.out_iocbs[i].aio_nbytes:
+            if not self.out_failed:
+                print("Error sending data packet", res, file=sys.stderr)
+
+            self.out_failed = True
+
+        self.out_free.append(i)
+
+    def send_packet(self, packet):
+        return self.send_packet_vec([packet])
+
+    # (the pieces are copied into a buffer that stays until it is sent)
+    def send_packet_vec(self, bufs):
+        still_ok = 1
+        pack_len = sum(len(one_buf) for one_buf in bufs)
+
+        # Do I need to end with a ZLP?
+        #  (this is if the last packet in a transaction is full sized)
+        zlp = (pack_len != self.max_packet) and \
+              (pack_len % self.bulkSize == 0)
+
+        with self.cond:
+            while (len(self.out_free) < 1 + zlp) and (not self.out_failed):
+                self.__wait(None)
+
+            # (an earlier packet did not make it)
+            if self.out_failed:
+                still_ok = 0
+
+            else:
+                i = self.out_free.pop()
+
+                if (self.out_buffers[i] is None) or \
+                        (len(self.out_buffers[i]) < pack_len):
+                    self.out_buffers[i] = bytearray(max(pack_len,
+                                                        self.max_packet))
+
+                offset = 0
+
+                for one_buf in bufs:
+                    self.out_buffers[i][offset:offset + len(one_buf)] = \
+                            one_buf
+                    offset += len(one_buf)
+
+                self.__submit_write(i, pack_len)
+
+                if zlp:
+                    i = self.out_free.pop()
+
+                    if self.out_buffers[i] is None:
+                        self.out_buffers[i] = bytearray(self.max_packet)
+
+                    self.__submit_write(i, 0)
+
+        return still_ok
+
+    def receive_packet(self, timeout=None):
+        data = None
+        deadline = None
+
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        with self.cond:
+            # The packet returned last time is not used anymore
+            if self.lent is not None:
+                self.__submit_read(self.lent)
+                self.lent = None
+
+            timed_out = False
+
+            while (self.next_seq not in self.arrived) and (not timed_out):
+                if deadline is None:
+                    self.__wait(None)
+                else:
+                    self.__wait(max(deadline - time.time(), 0))
+                    timed_out = time.time() >= deadline
+
+            if self.next_seq in self.arrived:
+                (i, res) = self.arrived.pop(self.next_seq)
+                self.next_seq += 1
+
+                if res < 0:
+                    self.__submit_read(i)
+                    raise OSError(-res, os.strerror(-res))
+
+                self.lent = i
+                data = memoryview(self.in_buffers[i])[:res]
+
+        return data
+
+    def setMaxPacket(self, new_size=-1):
+        with self.cond:
+            # (the buffers are replaced as they are queued again)
+            result = usbOSIf.usbOSIf.setMaxPacket(self, new_size)
+
+        return result
+
+    def close(self):
+        self.aio.destroy()
+        os.close(self.event_fd)
+
+
+class usbOSIfThreaded(usbOSIf.usbOSIf):
+
+    def __init__(self, in_fd, out_fd, max_packet, depth=DEF_DEPTH,
+                 bulkSize=512):
+        usbOSIf.usbOSIf.__init__(self, in_fd, out_fd, max_packet, bulkSize)
+
+        # (packets, or the exception that stopped the reader)
+        self.received = queue.Queue(max(depth, 1))
+        self.outgoing = queue.Queue(max(depth, 1))
+        self.out_failed = False
+
+        for target in (self.__reader, self.__writer):
+            one_thread = threading.Thread(target=target)
+            one_thread.daemon = True    # Die with the main thread
+            one_thread.start()
+
+    def __reader(self):
+        still_ok = True
+
+        while still_ok:
+            buffer = bytearray(self.max_packet)
+
+            try:
+                num_bytes = os.readv(self.in_fd, [buffer])
+                self.received.put(memoryview(buffer)[:num_bytes])
+
+            except OSError as my_except:
+                self.received.put(my_except)
+                still_ok = False
+
+    def __writer(self):
+        while not self.out_failed:
+            packet = self.outgoing.get()
+
+            try:
+                if not usbOSIf.usbOSIf.send_packet(self, packet):
+                    self.out_failed = True
+
+            except OSError as my_except:
+                print("Error sending data packet", my_except,
+                      file=sys.stderr)
+                self.out_failed = True
+
+    def send_packet(self, packet):
+        still_ok = 0
+
+        # (an earlier packet did not make it)
+        if not self.out_failed:
+            self.outgoing.put(bytes(packet))
+            still_ok = 1
+
+        return still_ok
+
+    def send_packet_vec(self, bufs):
+        return self.send_packet(b"".join(bufs))
+
+    def receive_packet(self, timeout=None):
+        try:
+            data = self.received.get(timeout=timeout)
+
+        except queue.Empty:
+            data = None
+
+        if isinstance(data, Exception):
+            # (so the next call fails the same way)
+            self.received.put(data)
+            raise data
+
+        return data
@@ -1,3 +1,6 @@
+import ctypes
+import ctypes.util
+import errno
 import os
 import select
 import socket
@@ -7,16 +10,23 @@ import sys
 DEF_PEER_IP = "localhost"
 DEF_PEER_PORT = 12345
 
+# Streamed transfers arrive in bursts, so ask for a large receive buffer
+#  (the kernel caps this at net.core.rmem_max)
+DEF_RECV_BUFFER = 2 * 1024 * 1024
+
 
 class usbUDP:
 
     def __init__(self, max_packet=512):
         self.my_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.my_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                  DEF_RECV_BUFFER)
         self.to_port = DEF_PEER_PORT
         self.to_ip = DEF_PEER_IP
         self.curr_timeout = None
         self.is_connected = False
         self.max_packet = max_packet
+        self.via_relay = True       # Always talks to a relay
         self.my_seq_num = 1
         self.last_sent = None
         self.last_recv = None
@@ -47,6 +57,20 @@ class usbUDP:
 
         return still_ok
 
+    # One packet from several buffers (e.g. a header and its data)
+    def send_packet_vec(self, bufs):
+
+        if not self.is_connected:
+            self.connect()
+
+        self.last_sent = [self.one_byte_struct.pack(self.my_seq_num)] + \
+                         list(bufs)
+        still_ok = self.my_socket.sendmsg(self.last_sent)
+
+        self.my_seq_num = (self.my_seq_num + 1) % 256
+
+        return still_ok
+
     def connect(self, remote_ip=None, remote_port=None):
         if remote_ip is None:
             remote_ip = self.to_ip
@@ -147,3 +171,193 @@ class usbUDP:
         self.max_packet = new_size
 
         return (old_size, new_size)
+
+
+#
+#   Receive and send many datagrams per system call (recvmmsg/sendmmsg)
+#   on a non-blocking IPv4 socket (used by the relay).  Where those calls
+#   are not available, this falls back to one recvfrom/sendto at a time.
+#
+MAX_DATAGRAM = 65536
+DEF_BATCH = 64
+
+MSG_DONTWAIT = 0x40
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(iovec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+sockaddr_in_struct = struct.Struct("=H")        # (then port and address)
+SOCKADDR_IN_LEN = 16
+
+
+class DatagramBatcher:
+    def __init__(self, sock, batch=DEF_BATCH):
+        self.sock = sock
+        self.batch = batch
+        self.libc = None
+
+        # Packed addresses of the peers (the same few are used over and over)
+        self.sockaddrs = {}
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+            if (sock.family == socket.AF_INET) and \
+                    hasattr(libc, "recvmmsg") and hasattr(libc, "sendmmsg"):
+                self.libc = libc
+
+        except OSError as my_except:
+            self.libc = None
+
+        if self.libc is not None:
+            self.recv_bufs = [ctypes.create_string_buffer(MAX_DATAGRAM)
+                              for i in range(batch)]
+            self.recv_names = [ctypes.create_string_buffer(SOCKADDR_IN_LEN)
+                               for i in range(batch)]
+            self.recv_iovs = (iovec * batch)()
+            self.recv_msgs = (mmsghdr * batch)()
+
+            for i in range(batch):
+                self.recv_iovs[i].iov_base = \
+                        ctypes.addressof(self.recv_bufs[i])
+                self.recv_iovs[i].iov_len = MAX_DATAGRAM
+
+                hdr = self.recv_msgs[i].msg_hdr
+                hdr.msg_name = ctypes.addressof(self.recv_names[i])
+                hdr.msg_iov = ctypes.pointer(self.recv_iovs[i])
+                hdr.msg_iovlen = 1
+
+            self.send_iovs = (iovec * batch)()
+            self.send_msgs = (mmsghdr * batch)()
+
+    def uses_mmsg(self):
+        return self.libc is not None
+
+    def __sockaddr(self, addr):
+        result = self.sockaddrs.get(addr)
+
+        if result is None:
+            if len(self.sockaddrs) > 4096:
+                self.sockaddrs.clear()
+
+            result = ctypes.create_string_buffer(
+                            sockaddr_in_struct.pack(socket.AF_INET) +
+                            struct.pack(">H", addr[1]) +
+                            socket.inet_aton(addr[0]), SOCKADDR_IN_LEN)
+
+            self.sockaddrs[addr] = result
+
+        return result
+
+    #
+    #   Returns a list of (data, (ip, port)) - empty if nothing is waiting
+    #
+    def recv_batch(self):
+        result = []
+
+        if self.libc is not None:
+            for i in range(self.batch):
+                self.recv_msgs[i].msg_hdr.msg_namelen = SOCKADDR_IN_LEN
+
+            count = self.libc.recvmmsg(self.sock.fileno(), self.recv_msgs,
+                                       self.batch, MSG_DONTWAIT, None)
+
+            if count < 0:
+                err = ctypes.get_errno()
+
+                if (err != errno.EAGAIN) and (err != errno.EWOULDBLOCK):
+                    raise OSError(err, os.strerror(err))
+
+            for i in range(max(count, 0)):
+                name = ctypes.string_at(self.recv_names[i], SOCKADDR_IN_LEN)
+                addr = (socket.inet_ntoa(name[4:8]),
+                        struct.unpack_from(">H", name, 2)[0])
+
+                data = ctypes.string_at(self.recv_iovs[i].iov_base,
+                                        self.recv_msgs[i].msg_len)
+
+                result.append((data, addr))
+        else:
+            try:
+                while len(result) < self.batch:
+                    result.append(self.sock.recvfrom(MAX_DATAGRAM))
+
+            except BlockingIOError as my_except:
+                pass        # Nothing more waiting
+
+        return result
+
+    #
+    #   Send a list of (data, (ip, port)).  Returns how many were sent
+    #   (the rest would block).  Errors are raised if nothing was sent
+    #   (otherwise the next call gets them).
+    #
+    def send_batch(self, packets):
+        sent = 0
+
+        if self.libc is not None:
+            while sent < len(packets):
+                count = min(len(packets) - sent, self.batch)
+                keep = []
+
+                for i in range(count):
+                    (data, addr) = packets[sent + i]
+                    name = self.__sockaddr(addr)
+                    keep.append(data)
+
+                    self.send_iovs[i].iov_base = ctypes.cast(
+                                ctypes.c_char_p(data), ctypes.c_void_p).value
+                    self.send_iovs[i].iov_len = len(data)
+
+                    hdr = self.send_msgs[i].msg_hdr
+                    hdr.msg_name = ctypes.addressof(name)
+                    hdr.msg_namelen = SOCKADDR_IN_LEN
+                    hdr.msg_iov = ctypes.pointer(self.send_iovs[i])
+                    hdr.msg_iovlen = 1
+
+                done = self.libc.sendmmsg(self.sock.fileno(), self.send_msgs,
+                                          count, MSG_DONTWAIT)
+
+                if done <= 0:
+                    err = ctypes.get_errno()
+
+                    if (done < 0) and (sent == 0) and \
+                            (err != errno.EAGAIN) and \
+                            (err != errno.EWOULDBLOCK):
+                        raise OSError(err, os.strerror(err))
+
+                    break
+
+                sent += done
+        else:
+            try:
+                for (data, addr) in packets:
+                    self.sock.sendto(data, addr)
+                    sent += 1
+
+            except BlockingIOError as my_except:
+                pass        # The rest has to wait
+
+            except OSError as my_except:
+                if sent == 0:
+                    raise
+
+        return sent
@@ -32,6 +32,7 @@ class usbUSB:
         #self.out_endpoint = out_endpoint
 
         self.max_packet = max_packet
+        self.via_relay = False
 
         self.buffer = bytearray(self.max_packet)
         self.buffer_mv = memoryview(self.buffer)
@@ -3,6 +3,7 @@ import usb1
 import ctypes
 import select
 import os
+import queue
 import sys
 import threading
 import time
@@ -10,6 +11,19 @@ import time
 VENDOR_ID = 0xca7e
 PRODUCT_ID = 0xca7e
 
+#
+#   With "num_transfers", the port uses libusb's asynchronous transfers:
+#   that many IN transfers are kept submitted (a ring, each into a
+#   buffer of its own that is handed to the caller as it completes and
+#   replaced by a new one), and up to that many OUT transfers are queued
+#   back to back.  The completions are handled by the event thread.
+#   (0 = one synchronous transfer at a time)
+#
+DEF_NUM_TRANSFERS = 0
+
+# Seconds the event thread waits for completions at a time
+EVENT_TIMEOUT = 1.0
+
 
 class usbUSB1:
 
@@ -19,8 +33,12 @@ class usbUSB1:
     #
     def _event_checker(self, context):
         while True:
-            context.handleEventsTimeout()
-            time.sleep(10)
+            if self.num_transfers > 0:
+                context.handleEventsTimeout(EVENT_TIMEOUT)
+
+            else:
+                context.handleEventsTimeout()
+                time.sleep(10)
 
     def _hotplug_callback(self, context, device, event):
         #print("Context:", context)
@@ -40,7 +58,10 @@ class usbUSB1:
                  max_packet=512,    # Default - tries to match remote server
                  bulkSize=512,     # Default to FS/HS size
                  vendor_id=VENDOR_ID,
-                 product_id=PRODUCT_ID):
+                 product_id=PRODUCT_ID,
+                 num_transfers=DEF_NUM_TRANSFERS):
+
+        context = None
 
         if dev is None:
             context = usb1.USBContext()
@@ -66,6 +87,7 @@ class usbUSB1:
         self.out_endpoint = out_endpoint
         self.max_packet = max_packet      # Max size for a USB bulk transaction
         self.bulkSize = bulkSize        # Max size of a USB bulk packet
+        self.via_relay = False          # Directly connected to the server
 
         self.buffer = bytearray(self.max_packet)
         self.buffer_mv = memoryview(self.buffer)
@@ -73,18 +95,197 @@ class usbUSB1:
         self.buffer_char = None
         self.buffer_char_t = None
 
-        if context.hasCapability(usb1.libusb1.LIBUSB_CAP_HAS_HOTPLUG):
+        # (the completions are handled with the context of the device)
+        self.num_transfers = num_transfers
+
+        if (num_transfers > 0) and (context is None):
+            print("Warning: asynchronous transfers need a device opened",
+                  "by usbUSB1 - using synchronous ones", file=sys.stderr)
+            self.num_transfers = 0
+
+        hotplug = (context is not None) and \
+                  context.hasCapability(usb1.libusb1.LIBUSB_CAP_HAS_HOTPLUG)
+
+        if hotplug:
             context.hotplugRegisterCallback(
                 self._hotplug_callback,
                 vendor_id=vendor_id,
                 product_id=product_id,
                 events=usb1.libusb1.LIBUSB_HOTPLUG_EVENT_DEVICE_LEFT)
 
+        if self.num_transfers > 0:
+            self._start_async()
+
+        if hotplug or (self.num_transfers > 0):
             t1 = threading.Thread(target=self._event_checker, args=[context])
             t1.daemon = True
             t1.start()
 
+    #
+    #   Set up the asynchronous transfers (see DEF_NUM_TRANSFERS)
+    #
+    def _start_async(self):
+        self.received = queue.Queue()   # Buffers (or an exception)
+
+        self.in_cond = threading.Condition()
+        self.in_submitted = 0
+        self.in_resizing = False
+        self.in_transfers = []
+
+        self.out_cond = threading.Condition()
+        self.out_free = []
+        self.out_status = None          # Of the last OUT transfer that failed
+
+        for i in range(0, self.num_transfers):
+            self.in_transfers.append(self.dev.getTransfer())
+            self.out_free.append(self.dev.getTransfer())
+
+        self._submit_in_ring()
+
+    def _submit_in_ring(self):
+        for transfer in self.in_transfers:
+            transfer.setBulk(self.in_endpoint, bytearray(self.max_packet),
+                             callback=self._in_done)
+
+            with self.in_cond:
+                self.in_submitted += 1
+
+            transfer.submit()
+
+    #
+    #   An IN transfer is done (called by the event thread) - hand its
+    #   buffer over and submit it again with a new one, so the data is
+    #   never overwritten while the caller still uses it
+    #
+    def _in_done(self, transfer):
+        status = transfer.getStatus()
+
+        if status == usb1.TRANSFER_COMPLETED:
+            self.received.put(memoryview(transfer.getBuffer())[
+                                    :transfer.getActualLength()])
+
+        elif status != usb1.TRANSFER_CANCELLED:
+            self.received.put(IOError("USB receive failed, transfer " +
+                                      "status " + str(status)))
+
+        with self.in_cond:
+            resubmit = (status == usb1.TRANSFER_COMPLETED) and \
+                       (not self.in_resizing)
+
+            if resubmit:
+                transfer.setBuffer(bytearray(self.max_packet))
+
+                try:
+                    transfer.submit()
+
+                except usb1.USBError as my_except:
+                    self.received.put(my_except)
+                    resubmit = False
+
+            if not resubmit:
+                self.in_submitted -= 1
+                self.in_cond.notify_all()
+
+    # An OUT transfer is done (called by the event thread)
+    def _out_done(self, transfer):
+        status = transfer.getStatus()
+
+        with self.out_cond:
+            if (status != usb1.TRANSFER_COMPLETED) or \
+                    (transfer.getActualLength() != len(transfer.getBuffer())):
+                self.out_status = status
+
+            self.out_free.append(transfer)
+            self.out_cond.notify()
+
+    #
+    #   Queue a packet to be sent (waits if all of the OUT transfers are
+    #   in use).  Returns 0 if an earlier packet could not be sent.
+    #
+    def _send_async(self, data):
+        still_ok = 1
+        pack_len = len(data)
+
+        # (it is sent later, so it must not change in the meantime)
+        if not isinstance(data, bytes):
+            data = bytes(data)
+
+        with self.out_cond:
+            self.out_cond.wait_for(lambda: len(self.out_free) > 0)
+            transfer = self.out_free.pop()
+
+            if self.out_status is not None:
+                print("Error sending data packet, transfer status",
+                      self.out_status, file=sys.stderr)
+                self.out_status = None
+                still_ok = 0
+
+        transfer.setBulk(self.out_endpoint, data, callback=self._out_done)
+
+        # The same ZLP rule as the synchronous send
+        transfer.setAddZeroPacket((pack_len != self.max_packet) and
+                                  (pack_len % self.bulkSize == 0))
+
+        transfer.submit()
+
+        return still_ok
+
+    def _receive_async(self, timeout):
+        try:
+            data = self.received.get(timeout=timeout)
+
+        except queue.Empty:
+            data = None
+
+        if isinstance(data, Exception):
+            raise data
+
+        return data
+
+    #
+    #   Cancel the IN ring and submit it again with buffers of the new
+    #   size (a transfer that is cancelled part way through loses its
+    #   data, so only do this while the link is quiet)
+    #
+    def _resize_in_ring(self):
+        with self.in_cond:
+            self.in_resizing = True
+
+        for transfer in self.in_transfers:
+            try:
+                transfer.cancel()
+
+            except usb1.USBError as my_except:
+                pass            # Not submitted (anymore)
+
+        with self.in_cond:
+            self.in_cond.wait_for(lambda: self.in_submitted == 0)
+            self.in_resizing = False
+
+        self._submit_in_ring()
+
     def send_packet(self, data):
+        if self.num_transfers > 0:
+            still_ok = self._send_async(data)
+        else:
+            still_ok = self._send_sync(data)
+
+        return still_ok
+
+    # (libusb sends from a single buffer, so the pieces are joined)
+    def send_packet_vec(self, bufs):
+        return self.send_packet(b"".join(bufs))
+
+    def receive_packet(self, timeout=None):
+        if self.num_transfers > 0:
+            # (a timeout of 0 waits forever, like libusb's)
+            data = self._receive_async(timeout or None)
+        else:
+            data = self._receive_sync(timeout)
+
+        return data
+
+    def _send_sync(self, data):
         still_ok = 1
         initial_send_failed = False
         pack_len = len(data)
@@ -125,7 +326,7 @@ class usbUSB1:
 
         return still_ok
 
-    def receive_packet(self, timeout=None):
+    def _receive_sync(self, timeout):
         if timeout is None:
             timeout = 0
         else:
@@ -176,4 +377,7 @@ class usbUSB1:
         self.buffer_char = None
         self.buffer_char_t = None
 
+        if (self.num_transfers > 0) and (new_size != old_size):
+            self._resize_in_ring()
+
         return (old_size, new_size)
@@ -0,0 +1,506 @@
+#
+#   asyncio version of the client (talking to a relay over UDP)
+#
+#   Many requests can be in flight at the same time.  The packets of a
+#   transfer are told apart by the transaction id in them, so any number
+#   of transfers (e.g. downloads) can go on at once on one socket.  The
+#   first response to a new command cannot be told apart from the first
+#   response to another one (its id is not known yet, and it is 0 for a
+#   single packet response), so a socket only has one new command
+#   waiting for its first response at a time.
+#
+#   To have many new commands (e.g. stats and hashes) waiting at once,
+#   the client has a pool of sockets ("lanes" - the relay tells them
+#   apart by their address, like different clients).  A new command is
+#   sent on a lane that is not waiting for a first response, and the
+#   rest of its transfer stays on that lane.
+#   (each lane is a client to the relay too, e.g. for its fair queue and
+#   its limit on the number of clients, so there are only two of them
+#   unless more are asked for)
+#
+#   Like usbUDP, the sequence number in front of every packet is used to
+#   drop packets that the relay sent twice.
+#
+#   Errors are returned as None (like usb_comm.Client), except by
+#   client_get_fileYield(), which raises IOError if the transfer fails.
+#
+
+import asyncio
+import os
+import socket
+import sys
+import time
+
+import usbUDP
+import usb_comm
+import usb_compress
+
+DEF_TIMEOUT = 10        # In seconds
+
+DEF_LANES = 2           # Sockets (new commands waiting at once)
+
+RESP_CONTINUE = ord("c")
+RESP_DATA = ord("d")
+RESP_LAST = ord("l")
+RESP_ERROR = ord("z")
+
+
+class RelayProtocol(asyncio.DatagramProtocol):
+    def __init__(self, lane):
+        self.lane = lane
+        self.last_data = None
+
+    def datagram_received(self, data, addr):
+        # Sent again?  (the sequence number is the same too)
+        if data != self.last_data:
+            self.last_data = data
+
+            if len(data) > 1:
+                self.lane.packet_received(data[1:])
+
+    def error_received(self, exc):
+        self.lane.connection_failed(exc)
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            self.lane.connection_failed(exc)
+
+
+#
+#   One socket to the relay, with its own sequence numbers and transfers
+#
+class RelayLane:
+    def __init__(self, client):
+        self.client = client
+        self.transport = None
+        self.my_seq_num = 1
+
+        # (the new command that waits for its first response)
+        self.first_response = None
+
+        self.transfers = {}             # trans id -> asyncio.Queue
+
+        # Transfers that were given up (trans id -> until when the rest of
+        #  their packets are dropped)
+        self.abandoned = {}
+
+    async def open(self, remote_ip, remote_port):
+        loop = asyncio.get_running_loop()
+
+        (self.transport, protocol) = await loop.create_datagram_endpoint(
+                                        lambda: RelayProtocol(self),
+                                        remote_addr=(remote_ip, remote_port))
+
+        # Many transfers at once can mean a lot of packets at once
+        self.transport.get_extra_info("socket").setsockopt(socket.SOL_SOCKET,
+                                socket.SO_RCVBUF, usbUDP.DEF_RECV_BUFFER)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    def send_packet(self, data):
+        self.client.print_debug(5, "Sending: ", data)
+
+        self.transport.sendto(self.client.one_byte_struct.pack(
+                                                self.my_seq_num) + data)
+
+        self.my_seq_num = (self.my_seq_num + 1) % 256
+
+    #
+    #   Called (by RelayProtocol) for every packet from the relay
+    #
+    def packet_received(self, packet):
+        self.client.print_debug(5, "Received: ", packet)
+
+        trans_id = 0
+
+        if len(packet) >= 2:
+            trans_id = packet[1]
+
+        if (trans_id != 0) and (trans_id in self.transfers):
+            self.transfers[trans_id].put_nowait(packet)
+
+        elif self.abandoned.get(trans_id, 0) > time.monotonic():
+            self.client.print_debug(4,
+                                    "Dropping a packet of a transfer given up")
+
+        elif (self.first_response is not None) and \
+                (not self.first_response.done()):
+            # The start of a transfer - the rest of it may arrive before
+            #  the coroutine that waits for this packet gets to run
+            if (packet[0] == RESP_DATA) and (trans_id != 0):
+                self.transfers[trans_id] = asyncio.Queue()
+
+            self.first_response.set_result(packet)
+
+        else:
+            self.client.print_debug(4, "Dropping a packet for no request",
+                                    packet)
+
+    def connection_failed(self, exc):
+        print("Connection to the relay failed:", exc, file=sys.stderr)
+
+        if (self.first_response is not None) and \
+                (not self.first_response.done()):
+            self.first_response.set_result(None)
+
+        for queue in self.transfers.values():
+            queue.put_nowait(None)
+
+
+class AsyncClient(usb_comm.USBComm):
+    def __init__(self, timeout=DEF_TIMEOUT, num_lanes=DEF_LANES):
+        usb_comm.USBComm.__init__(self, None, timeout)
+
+        self.max_packet = 8192          # (until the relay is asked)
+
+        self.lanes = [RelayLane(self) for i in range(max(num_lanes, 1))]
+        self.idle_lanes = None          # Lanes with no new command waiting
+
+        self.server_features = None
+        self.stream_window = None       # None = compute from max_packet
+        self.compress_algos = usb_compress.supported_algos()
+
+    async def connect(self, remote_ip=usbUDP.DEF_PEER_IP,
+                      remote_port=usbUDP.DEF_PEER_PORT):
+        self.idle_lanes = asyncio.Queue()
+
+        for lane in self.lanes:
+            await lane.open(remote_ip, remote_port)
+            self.idle_lanes.put_nowait(lane)
+
+        max_packet = await self.client_get_max_packet()
+
+        if max_packet is not None:
+            self.max_packet = max_packet
+
+        return max_packet is not None
+
+    def close(self):
+        for lane in self.lanes:
+            lane.close()
+
+    async def __receive(self, waitable):
+        try:
+            result = await asyncio.wait_for(waitable, self.timeout)
+
+        except asyncio.TimeoutError as my_except:
+            print("Timed out talking to the relay", file=sys.stderr)
+            result = None
+
+        return result
+
+    # Send one packet and wait for the response (new commands only)
+    async def __request(self, lane, packet):
+        lane.first_response = asyncio.get_running_loop().create_future()
+
+        lane.send_packet(packet)
+        result = await self.__receive(lane.first_response)
+
+        lane.first_response = None
+
+        return result
+
+    #
+    #   Send a new command (with "P" packets first if the path does not
+    #   fit) and return the lane it went on and the first packet of the
+    #   response
+    #
+    async def __send_cmd(self, cmd, data=b""):
+        result = None
+        still_ok = 1
+        start = 0
+
+        # (the "P" packets and the command have to go on the same lane)
+        lane = await self.idle_lanes.get()
+
+        try:
+            while still_ok and (len(cmd) + len(data) - start >
+                                self.max_packet):
+                response = await self.__request(lane, b"P" +
+                                data[start:start + self.max_packet - 1])
+
+                if (response is None) or (response[0] != RESP_CONTINUE):
+                    print("Did not get a 'continue' response when sending",
+                          cmd, response, file=sys.stderr)
+                    still_ok = 0
+
+                start = start + self.max_packet - 1
+
+            if still_ok:
+                result = await self.__request(lane, cmd + data[start:])
+
+        finally:
+            self.idle_lanes.put_nowait(lane)
+
+        return (lane, result)
+
+    #
+    #   The payloads of all of the packets of a response, as they arrive.
+    #   Raises IOError if the transfer fails.
+    #
+    async def __send_cmd_and_receive_all_yield(self, cmd, path=b"",
+                                               window=0, credits=1):
+        (lane, one_packet) = await self.__send_cmd(cmd, path)
+        trans_id = None
+        still_ok = 1
+        ended = False           # (the server is done with the transfer)
+
+        try:
+            while still_ok:
+                if (one_packet is None) or (len(one_packet) < 2):
+                    raise IOError("No (or a runt) response to " + str(cmd))
+
+                resp = one_packet[0]
+                ended = resp != RESP_DATA
+
+                if resp == RESP_ERROR:
+                    raise IOError("Error response to " + str(cmd) + " " +
+                                  str(path))
+
+                elif (resp != RESP_DATA) and (resp != RESP_LAST):
+                    raise IOError("Unknown response to " + str(cmd) + " " +
+                                  str(one_packet))
+
+                yield bytes(one_packet[2:])
+
+                if resp == RESP_DATA:
+                    trans_id = one_packet[1]
+
+                    # Ask for the next packet(s) (see usb_comm.Client)
+                    if window > 0:
+                        credits -= 1
+
+                        if credits <= window // 2:
+                            lane.send_packet(b"W" + one_packet[1:2] +
+                                self.one_byte_struct.pack(window - credits))
+                            credits = window
+                    else:
+                        lane.send_packet(b"C" + one_packet[1:2])
+
+                    one_packet = await self.__receive(
+                                        lane.transfers[trans_id].get())
+
+                else:
+                    still_ok = 0        # Last packet
+
+        finally:
+            if trans_id is not None:
+                lane.transfers.pop(trans_id, None)
+
+                # (the server may still send the rest of it)
+                if not ended:
+                    lane.abandoned[trans_id] = time.monotonic() + \
+                                               self.timeout
+
+    # The whole response (None on errors)
+    async def __send_cmd_and_receive_all(self, cmd, path=b"", window=0,
+                                         credits=1):
+        result = bytearray(0)
+
+        try:
+            async for data in self.__send_cmd_and_receive_all_yield(cmd,
+                                                path, window, credits):
+                result.extend(data)
+
+        except IOError as my_except:
+            self.print_debug(2, my_except)
+            result = None
+
+        return result
+
+    # Decode a whole (compressed) response, None if it is not valid
+    def __decode_all(self, decoder, data):
+        if (decoder is not None) and (data is not None):
+            try:
+                data = decoder.feed(data) + decoder.finish()
+
+                if not decoder.complete:
+                    data = None
+
+            except Exception as my_except:
+                print("Bad compressed data received:", my_except,
+                      file=sys.stderr)
+                data = None
+
+        return data
+
+    async def client_get_max_packet(self):
+        self.print_debug(3, "Sending GetMaxPacket() Command")
+
+        data = await self.__send_cmd_and_receive_all(b"M")
+
+        if (data is not None) and (len(data) >= 4):
+            data = int.from_bytes(data[0:4], 'little')
+        else:
+            data = None
+
+        return data
+
+    # (see usb_comm.Client.client_get_features())
+    async def client_get_features(self):
+        if self.server_features is None:
+            self.print_debug(3, "Sending Features Command")
+
+            features = 0
+            data = await self.__send_cmd_and_receive_all(b"NF")
+
+            if (data is not None) and (len(data) >= 5) and \
+                    (bytes(data[4:5]) == usb_comm.FEATURE_ORIGIN_RELAY):
+                features = int.from_bytes(data[0:4], 'little')
+
+            self.server_features = features
+
+        return self.server_features
+
+    async def client_has_feature(self, feature):
+        return ((await self.client_get_features()) & feature) != 0
+
+    # Number of packets to allow in flight (0 = use lock-step "C" packets)
+    def client_set_stream_window(self, window):
+        self.stream_window = min(window, usb_comm.MAX_STREAM_WINDOW)
+
+    async def client_get_stream_window(self):
+        window = 0
+
+        if await self.client_has_feature(usb_comm.FEATURE_STREAM):
+            if self.stream_window is None:
+                window = usb_comm.DEF_STREAM_BYTES // self.max_packet
+            else:
+                window = self.stream_window
+
+            window = max(0, min(window, usb_comm.MAX_STREAM_WINDOW))
+
+        return window
+
+    # Bitmask of usb_compress.COMP_* types to accept (0 = no compression)
+    def client_set_compression(self, algos):
+        self.compress_algos = algos & usb_compress.supported_algos()
+
+    async def client_use_compression(self):
+        return (self.compress_algos != 0) and \
+                await self.client_has_feature(usb_comm.FEATURE_COMPRESS)
+
+    # (see usb_comm.Client.client_ls())
+    async def client_ls(self, pathname, dir_only=False):
+        self.print_debug(3, "Sending LS Command, arg=", pathname)
+
+        if isinstance(pathname, str):
+            pathname = pathname.encode('latin1')
+
+        if await self.client_use_compression():
+            data = await self.__send_cmd_and_receive_all(b"Y" +
+                        self.one_byte_struct.pack(self.compress_algos) + b"L",
+                        pathname)
+
+            data = self.__decode_all(usb_compress.StreamDecoder(), data)
+
+        else:
+            data = await self.__send_cmd_and_receive_all(b"L", pathname)
+
+        if data is not None:
+            data = data.decode('latin1')
+
+            # Special case two \0\0 == a file and it was found
+            if data == "\0\0":
+                if dir_only:
+                    data = None
+                else:
+                    data = os.path.basename(pathname).decode('latin1')
+
+            elif len(data) == 0:
+                data = []
+
+            else:
+                data = data.split("\0")
+
+        return data
+
+    async def client_stat_path(self, pathname):
+        self.print_debug(3, "Sending Stat() Command, arg=", pathname)
+
+        if isinstance(pathname, str):
+            pathname = pathname.encode('latin1')
+
+        data = await self.__send_cmd_and_receive_all(b"S", pathname)
+
+        if data is not None:
+            data = self.stat_struct.unpack(data)
+
+        return data
+
+    async def client_stat_pathToDict(self, pathname):
+        data = await self.client_stat_path(pathname)
+
+        return self.stat_to_dict(data)
+
+    async def client_hash_file(self, pathname):
+        self.print_debug(3, "Sending HashFile Command, arg=", pathname)
+
+        if isinstance(pathname, str):
+            pathname = pathname.encode('latin1')
+
+        data = await self.__send_cmd_and_receive_all(b"H", pathname)
+
+        if data is not None:
+            data = data.decode('latin1')
+
+        return data
+
+    #
+    #   An async iterator over the data of a file as it arrives (streamed
+    #   and compressed if the relay can).  Raises IOError on errors.
+    #
+    async def client_get_fileYield(self, pathname, as_bytes=False):
+        self.print_debug(3, "Sending GetFile Command with yield, arg=",
+                         pathname)
+
+        if isinstance(pathname, str):
+            pathname = pathname.encode('latin1')
+
+        window = await self.client_get_stream_window()
+        decoder = None
+
+        if await self.client_use_compression():
+            cmd = b"X" + self.one_byte_struct.pack(window) + \
+                  self.one_byte_struct.pack(self.compress_algos)
+            decoder = usb_compress.StreamDecoder()
+
+        elif window > 0:
+            cmd = b"F" + self.one_byte_struct.pack(window)
+
+        else:
+            cmd = b"G"
+
+        async for data in self.__send_cmd_and_receive_all_yield(cmd,
+                                        pathname, window, max(window, 1)):
+            if decoder is not None:
+                data = decoder.feed(data)
+
+            if len(data) > 0:
+                yield bytes(data) if as_bytes else data
+
+        if decoder is not None:
+            data = decoder.finish()
+
+            if not decoder.complete:
+                raise IOError("Incomplete compressed data received")
+
+            if len(data) > 0:
+                yield bytes(data) if as_bytes else data
+
+    # The whole file (None on errors)
+    async def client_get_file(self, pathname):
+        result = bytearray(0)
+
+        try:
+            async for data in self.client_get_fileYield(pathname):
+                result.extend(data)
+
+        except IOError as my_except:
+            print("Could not get", pathname, "-", my_except, file=sys.stderr)
+            result = None
+
+        return result
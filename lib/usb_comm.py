@@ -9,6 +9,18 @@ import threading
 import time
 import traceback
 
+import usb_compress
+import usb_delta
+import usb_digest
+import usb_hashcache
+import usb_jobs
+import usb_journal
+import usb_manifest
+import usb_pathcache
+import usb_pipeline
+import usb_readahead
+import usb_treehash
+
 MAX_FILE_PATHLEN = 4096
 
 MAX_TRANSACTIONS = 100
@@ -16,6 +28,51 @@ MAX_CURR_TIME = 5000
 
 DEF_DEBUG = 1
 
+#
+#   Optional protocol features (reported by "NF" - see PROTOCOL.txt)
+#
+FEATURE_STREAM = 0x0001         # F/W credit-based streaming
+FEATURE_LISTSTAT = 0x0002       # A (list with attributes)
+FEATURE_RANGE = 0x0004          # R (get part of a file)
+FEATURE_COMPRESS = 0x0008       # X/Y (compressed gets and listings)
+FEATURE_DELTA = 0x0010          # U/D (uploads and delta gets)
+FEATURE_TREEHASH = 0x0020       # T (tree hashes of files)
+FEATURE_DIGEST = 0x0040         # V (gets with a digest of the file)
+FEATURE_MANIFEST = 0x0080       # E (recursive manifest of a tree)
+FEATURE_JOURNAL = 0x0100        # J (changes since a generation)
+FEATURE_PIPELINE = 0x0200       # I (tagged requests, see usb_pipeline)
+FEATURE_JOBS = 0x0400           # B/O (background jobs, see usb_jobs)
+
+SERVER_FEATURES = FEATURE_STREAM | FEATURE_LISTSTAT | FEATURE_RANGE | \
+                  FEATURE_COMPRESS | FEATURE_DELTA | FEATURE_TREEHASH | \
+                  FEATURE_DIGEST | FEATURE_MANIFEST | FEATURE_PIPELINE
+
+# Requests that can be background jobs (the answer starts with one packet)
+JOB_CMDS = "HTLAY"
+
+FEATURE_ORIGIN_SERVER = b"S"
+FEATURE_ORIGIN_RELAY = b"R"
+
+# Size (in bytes) of the data a client allows to be in flight at once
+#  when streaming (converted into a number of packets)
+DEF_STREAM_BYTES = 512 * 1024
+MAX_STREAM_WINDOW = 255
+
+# Fixed-size arguments that sit between the command byte and the path
+CMD_ARG_SIZES = {"F": 1, "W": 2, "R": 17, "X": 2, "Y": 2, "D": 2, "T": 4,
+                 "V": 2, "E": 4, "J": 17}
+
+# How much of a file to hash at a time (for "H")
+HASH_CHUNK = 1024 * 1024
+
+# What a slot holds between find_free_slot() and being filled
+SLOT_RESERVED = b""
+
+
+# Data uploaded by a client (with "U") - kept in a transaction slot
+class UploadBuffer(bytearray):
+    pass
+
 
 class USBComm:
     def __init__(self, raw_port=None, timeout=0):
@@ -32,6 +89,25 @@ class USBComm:
         # Speedup - Compile the structure once
         self.stat_struct = struct.Struct("<BHLLL")
         self.one_byte_struct = struct.Struct("B")
+        self.two_byte_struct = struct.Struct("<H")
+
+        # Stat records inside of "A" listings (64-bit sizes and times)
+        self.stat_long_struct = struct.Struct("<BHQqq")
+
+        # Offset and length of an "R" (ranged get) request
+        self.range_struct = struct.Struct("<QQ")
+
+        # Leaf size of a "T" (tree hash) request
+        self.leaf_size_struct = struct.Struct("<L")
+
+        # Counters of a relay ("NI" - see client_get_relay_stats)
+        self.relay_stats_struct = struct.Struct("<QQQLQQQQ")
+
+        # A client queue of a relay ("NQ" - see client_get_relay_queues)
+        self.relay_queue_struct = struct.Struct("<HBLLLL")
+
+        # Threads used to hash the pieces of a file
+        self.hash_workers = usb_treehash.DEF_WORKERS
 
         # Variables for the stat() cache (often set by os.scandir)
 
@@ -59,6 +135,32 @@ class USBComm:
 
         return retval
 
+    #
+    #   Send one packet made up of several buffers (e.g. a header and the
+    #   data after it), without joining them first if the port can
+    #
+    def send_packet_vec(self, bufs):
+        self.print_debug(5, "Sending: ", bufs)
+        self.last_sent = bufs
+
+        try:
+            if hasattr(self.raw_port, "send_packet_vec"):
+                retval = self.raw_port.send_packet_vec(bufs)
+            else:
+                retval = self.raw_port.send_packet(b"".join(bufs))
+
+        except Exception as my_except:
+            print("usb_comm::send_packet_vec failed", my_except)
+            print("Trying to send:", bufs)
+            print("Timeout was", self.timeout)
+            traceback.print_exc()  # Print the traceback
+
+            os._exit(1)
+
+        self.print_debug(5, "send_packet_vec returned", retval)
+
+        return retval
+
     def receive_packet(self):
         get_more = True
 
@@ -79,8 +181,7 @@ class USBComm:
                 os._exit(1)
 
             if data is None:
-                print("Got None")
-
+                # (a timeout - the server just waits again when idle)
                 self.print_debug(4, "receive_packet returned None")
                 get_more = False
 
@@ -114,6 +215,26 @@ class USBComm:
     def set_debug(self, newlevel):
         self.debug = newlevel
 
+    # (flags, mode, size, mtime, ctime) from a stat response -> dict
+    def stat_to_dict(self, data):
+        new_dict = None
+
+        if data is not None:
+            (flags, mode, size, mtime, ctime) = data
+            new_dict = {}
+
+            new_dict['is_dir'] = flags & 0x01
+            new_dict['is_file'] = flags & 0x02
+            new_dict['is_symlink'] = flags & 0x80
+
+            new_dict['flags'] = flags
+            new_dict['mode'] = mode
+            new_dict['size'] = size
+            new_dict['mtime'] = mtime
+            new_dict['ctime'] = ctime
+
+        return new_dict
+
     #
     # ----------------------------------------------------------------------
     #
@@ -281,7 +402,14 @@ class USBComm:
             #
             #hash_res = hashlib.file_digest(f, "sha512")
 
-            hash_res = hashlib.sha512(f.read())
+            # Read a chunk at a time (files may be bigger than memory)
+            hash_res = hashlib.sha512()
+            data = f.read(HASH_CHUNK)
+
+            while len(data) > 0:
+                hash_res.update(data)
+                data = f.read(HASH_CHUNK)
+
             f.close()
 
             if hash_res is not None:
@@ -289,6 +417,16 @@ class USBComm:
 
         return result
 
+    def compute_tree_hash(self, realpath,
+                          leaf_size=usb_treehash.DEF_LEAF_SIZE):
+        result = None
+
+        if os.path.isfile(realpath):
+            result = usb_treehash.compute_tree_hash(realpath, leaf_size,
+                                                    self.hash_workers)
+
+        return result
+
 #
 # ----------------------------------------------------------------------
 #
@@ -298,6 +436,12 @@ class Client(USBComm):
     def __init__(self, raw_port, timeout):
         USBComm.__init__(self, raw_port, timeout)
 
+        self.server_features = None
+        self.stream_window = None       # None = compute from max_packet
+
+        # Compression types we can decode (0 = do not ask for compression)
+        self.compress_algos = usb_compress.supported_algos()
+
         self.client_set_max_packet(self.client_get_max_packet())
 
     def client_reset(self):
@@ -310,6 +454,10 @@ class Client(USBComm):
     def __client_send_cmd(self, cmd, data=b""):
         still_ok = 1
 
+        # Slow requests are handled in the background by the server
+        if (chr(cmd[0]) in JOB_CMDS) and self.client_has_feature(FEATURE_JOBS):
+            cmd = usb_jobs.REQ_BACKGROUND + cmd
+
         start = 0
         whole_len = len(data)
 
@@ -350,14 +498,59 @@ class Client(USBComm):
 # ----------------------------------------------------------------------
 #
 
-    def __client_send_cmd_and_receive_all(self, cmd, path=b"", callback=None):
+    #
+    #   After a "d" packet, ask for more data.  In lock-step mode that is
+    #   one "C" per packet.  When streaming, the server was granted
+    #   "credits" packets, so just top the window back up with a "W"
+    #   once half of it has arrived (the rest is still on its way).
+    #
+    def __client_request_more(self, one_packet, window, credits):
+        still_ok = 1
+
+        if window > 0:
+            credits -= 1
+
+            if credits <= window // 2:
+                still_ok = self.send_packet(b"W" + one_packet[1:2] +
+                                self.one_byte_struct.pack(window - credits))
+                credits = window
+
+        else:
+            still_ok = self.send_packet(b"C" + one_packet[1:2])
+
+        return (still_ok, credits)
+
+    #
+    #   Receive the next packet of an answer - a background job that is
+    #   not done yet ("p") is asked for ("O") until it is
+    #
+    def __client_receive_answer(self):
+        one_packet = self.receive_packet()
+        delay = usb_jobs.MIN_POLL_DELAY
+
+        while (one_packet is not None) and (len(one_packet) == 2) and \
+                (one_packet[0] == usb_jobs.RESP_PENDING[0]):
+            job_id = one_packet[1]
+
+            self.print_debug(4, "Waiting for job", job_id)
+
+            time.sleep(delay)
+            delay = min(delay * 2, usb_jobs.MAX_POLL_DELAY)
+
+            one_packet = self.send_and_receive_packet(
+                                usb_jobs.REQ_POLL + bytes([job_id]))
+
+        return one_packet
+
+    def __client_send_cmd_and_receive_all(self, cmd, path=b"", callback=None,
+                                          window=0, credits=1):
 
         whole_data = bytearray(0)
 
         still_ok = self.__client_send_cmd(cmd, path)
 
         while still_ok:
-            one_packet = self.receive_packet()
+            one_packet = self.__client_receive_answer()
             # Received a too small packet? then abort
 
             if (one_packet is None) or (len(one_packet) < 2):
@@ -389,8 +582,9 @@ class Client(USBComm):
                     whole_data.extend(one_packet[2:])
 
                 if resp == "d":
-                    # Ask for next packet
-                    still_ok = self.send_packet(b"C" + one_packet[1:2])
+                    # Ask for next packet(s)
+                    (still_ok, credits) = self.__client_request_more(
+                                                one_packet, window, credits)
 
                 elif resp == "l":
                     still_ok = 0          # last data packet
@@ -407,10 +601,13 @@ class Client(USBComm):
                           cmd, path, "received", one_packet,
                           file=sys.stderr)
 
-        if callback is not None:
-            result = still_ok
-        else:
+        # (a callback user gets None back if the transfer did not finish)
+        if callback is None:
             result = whole_data
+        elif whole_data is None:
+            result = None
+        else:
+            result = 1
 
         return result
 
@@ -420,12 +617,13 @@ class Client(USBComm):
 #
 
 
-    def __client_send_cmd_and_receive_all_yield(self, cmd, path=b"", as_bytes=False):
+    def __client_send_cmd_and_receive_all_yield(self, cmd, path=b"",
+                                        as_bytes=False, window=0, credits=1):
 
         still_ok = self.__client_send_cmd(cmd, path)
 
         while still_ok:
-            one_packet = self.receive_packet()
+            one_packet = self.__client_receive_answer()
             # Received a too small packet? then abort
 
             if (one_packet is None) or (len(one_packet) < 2):
@@ -447,8 +645,9 @@ class Client(USBComm):
                     yield one_packet[2:]
 
                 if resp == "d":
-                    # Ask for next packet
-                    still_ok = self.send_packet(b"C" + one_packet[1:2])
+                    # Ask for next packet(s)
+                    (still_ok, credits) = self.__client_request_more(
+                                                one_packet, window, credits)
 
                 elif resp == "l":
                     still_ok = 0          # last data packet
@@ -483,6 +682,66 @@ class Client(USBComm):
 
         return ret
 
+    #
+    #   Ask the relay for the counters of its metadata and content caches
+    #   (and of its shared downloads).  Returns None if there is no relay
+    #   (the server answers "NI" like any other NoOp)
+    #
+    def client_get_relay_stats(self):
+        self.print_debug(3, "Sending Relay Info Command")
+
+        result = None
+        data = self.__client_send_cmd_and_receive_all(b"NI")
+
+        if (data is not None) and \
+                (len(data) >= self.relay_stats_struct.size):
+            (hits, misses, coalesced, entries, content_hits,
+             content_misses, content_bytes, joined) = \
+                    self.relay_stats_struct.unpack_from(data)
+
+            result = {"hits": hits, "misses": misses,
+                      "coalesced": coalesced, "entries": entries,
+                      "content_hits": content_hits,
+                      "content_misses": content_misses,
+                      "content_bytes": content_bytes, "joined": joined}
+
+        return result
+
+    #
+    #   Ask the relay what each client has queued for the server.
+    #   Returns a list of dicts (waits are in seconds), or None if there
+    #   is no relay.
+    #
+    def client_get_relay_queues(self):
+        self.print_debug(3, "Sending Relay Queues Command")
+
+        result = None
+        data = self.__client_send_cmd_and_receive_all(b"NQ")
+
+        # (the server answers with an empty packet)
+        if (data is not None) and (len(data) >= 2):
+            result = []
+            count = int.from_bytes(data[0:2], 'little')
+            pos = 2
+
+            while (len(result) < count) and (pos < len(data)) and \
+                    (pos + 1 + data[pos] + self.relay_queue_struct.size <=
+                     len(data)):
+                ip = bytes(data[pos + 1:pos + 1 + data[pos]]).decode("latin1")
+                pos += 1 + data[pos]
+
+                (port, priority, queued, oldest, avg_wait, served) = \
+                        self.relay_queue_struct.unpack_from(data, pos)
+                pos += self.relay_queue_struct.size
+
+                result.append({"ip": ip, "port": port,
+                               "priority": priority, "queued": queued,
+                               "oldest_wait": oldest / 1000,
+                               "avg_wait": avg_wait / 1000,
+                               "served": served})
+
+        return result
+
     def client_verify_server(self, val=None):
         """Simple check to see if the server responds)"""
 
@@ -494,6 +753,130 @@ class Client(USBComm):
 
         return ret is not None
 
+    #
+    #   Ask the peer which optional features it supports.  Old servers
+    #   answer "NF" like any other NoOp (no data), so they report none.
+    #   Behind a relay only the relay's (masked) answer counts - an old
+    #   relay just forwards the request to the server, which would
+    #   advertise features the relay cannot pass along.
+    #
+    def client_get_features(self):
+        if self.server_features is None:
+            self.print_debug(3, "Sending Features Command")
+
+            features = 0
+            data = self.__client_send_cmd_and_receive_all(b"NF")
+
+            if (data is not None) and (len(data) >= 5):
+                origin = bytes(data[4:5])
+
+                if (not self.raw_port.via_relay) or \
+                        (origin == FEATURE_ORIGIN_RELAY):
+                    features = int.from_bytes(data[0:4], 'little')
+
+            self.print_debug(4, "Peer features are", hex(features))
+
+            self.server_features = features
+
+        return self.server_features
+
+    def client_has_feature(self, feature):
+        return (self.client_get_features() & feature) != 0
+
+    # Number of packets to allow in flight (0 = use lock-step "C" packets)
+    def client_set_stream_window(self, window):
+        if window > MAX_STREAM_WINDOW:
+            window = MAX_STREAM_WINDOW
+
+        self.stream_window = window
+
+    def client_get_stream_window(self):
+        window = 0
+
+        if self.client_has_feature(FEATURE_STREAM):
+            if self.stream_window is None:
+                window = DEF_STREAM_BYTES // self.max_packet
+            else:
+                window = self.stream_window
+
+            window = max(0, min(window, MAX_STREAM_WINDOW))
+
+        return window
+
+    # Bitmask of usb_compress.COMP_* types to accept (0 = no compression)
+    def client_set_compression(self, algos):
+        self.compress_algos = algos & usb_compress.supported_algos()
+
+    def client_use_compression(self):
+        return (self.compress_algos != 0) and \
+                self.client_has_feature(FEATURE_COMPRESS)
+
+    #
+    #   Pick the verified ("V"), compressed ("X"), streamed ("F") or the
+    #   lock-step ("G") form of a file request.  Returns (cmd, window,
+    #   credits, decoder) where decoder is None unless the data will
+    #   arrive compressed (or with a digest to check).
+    #
+    def __client_file_cmd(self, verify=False):
+        window = self.client_get_stream_window()
+
+        if verify and self.client_has_feature(FEATURE_DIGEST):
+            algos = 0
+
+            if self.client_use_compression():
+                algos = self.compress_algos
+
+            result = (b"V" + self.one_byte_struct.pack(window) +
+                      self.one_byte_struct.pack(algos),
+                      window, max(window, 1),
+                      usb_digest.DigestDecoder(usb_compress.StreamDecoder()))
+
+        elif self.client_use_compression():
+            result = (b"X" + self.one_byte_struct.pack(window) +
+                      self.one_byte_struct.pack(self.compress_algos),
+                      window, max(window, 1), usb_compress.StreamDecoder())
+
+        elif window > 0:
+            result = (b"F" + self.one_byte_struct.pack(window), window, window,
+                      None)
+        else:
+            result = (b"G", 0, 1, None)
+
+        return result
+
+    # Decode a whole (compressed) response, None if it is not valid
+    def __client_decode_all(self, decoder, data):
+        if (decoder is not None) and (data is not None):
+            try:
+                data = decoder.feed(data) + decoder.finish()
+
+                if not decoder.complete:
+                    data = None
+
+            except Exception as my_except:
+                print("Bad compressed data received:", my_except,
+                      file=sys.stderr)
+                data = None
+
+        return data
+
+    #
+    #   Send a listing ("L" or "A") request - compressed ("Y") if possible
+    #
+    def __client_list_cmd(self, cmd, pathname, window=0):
+        if self.client_use_compression():
+            data = self.__client_send_cmd_and_receive_all(b"Y" +
+                        self.one_byte_struct.pack(self.compress_algos) + cmd,
+                        pathname, window=window)
+
+            data = self.__client_decode_all(usb_compress.StreamDecoder(), data)
+
+        else:
+            data = self.__client_send_cmd_and_receive_all(cmd, pathname,
+                                                          window=window)
+
+        return data
+
     def client_set_priority(self, new_priority):
         self.print_debug(3, "Sending SetPriority Command")
 
@@ -506,7 +889,7 @@ class Client(USBComm):
         if isinstance(pathname, str):
             pathname = pathname.encode('latin1')
 
-        data = self.__client_send_cmd_and_receive_all(b"L", pathname)
+        data = self.__client_list_cmd(b"L", pathname)
 
         if data is not None:
             data = data.decode('latin1')
@@ -527,15 +910,24 @@ class Client(USBComm):
 
         return data
 
-    def client_get_file(self, pathname):
+    #
+    #   With "verify", the server also sends the digest of the file (if
+    #   it can), and the data is only returned if it matches
+    #
+    def client_get_file(self, pathname, verify=False):
         if isinstance(pathname, str):
             pathname = pathname.encode('latin1')
 
         self.print_debug(3,
                          "Sending GetFile Command, arg=", pathname)
 
+        (cmd, window, credits, decoder) = self.__client_file_cmd(verify)
+
         # Returns as bytes() not a str()
-        return self.__client_send_cmd_and_receive_all(b"G", pathname)
+        data = self.__client_send_cmd_and_receive_all(cmd, pathname,
+                                            window=window, credits=credits)
+
+        return self.__client_decode_all(decoder, data)
 
     def client_hash_file(self, pathname):
         if isinstance(pathname, str):
@@ -582,625 +974,1967 @@ class Client(USBComm):
 
         return (res, local_res, remote_res)
 
-    def client_get_fileYield(self, pathname, as_bytes=False):
-        self.print_debug(3,
-                         "Sending GetFile Command with yield, arg=", pathname)
+    #
+    #   Get the tree hash (see usb_treehash) of a remote file.  The server
+    #   may pick a different leaf size (check the "leaf_size" returned).
+    #   Returns None if the server cannot do it (or there is no such file)
+    #
+    def client_tree_hash_file(self, pathname,
+                              leaf_size=usb_treehash.DEF_LEAF_SIZE):
+        result = None
 
         if isinstance(pathname, str):
             pathname = pathname.encode('latin1')
 
-        # Returns as bytes() not a str()
-        return self.__client_send_cmd_and_receive_all_yield(b"G",
-                                                    pathname, as_bytes)
-
-    def client_get_fileCB(self, pathname, callback):
-        still_ok = 1
-
-        self.print_debug(
-            3,
-            "Sending GetFile Command with callback, arg=",
-            pathname)
-
-        if isinstance(pathname, str):
-            pathname = pathname.encode('latin1')
+        self.print_debug(3, "Sending TreeHash Command, arg=", pathname,
+                         leaf_size)
 
-        result = self.__client_send_cmd_and_receive_all(b"G",
-                                                 pathname, callback)
+        if self.client_has_feature(FEATURE_TREEHASH):
+            data = self.__client_send_cmd_and_receive_all(b"T" +
+                            self.leaf_size_struct.pack(leaf_size), pathname)
 
-        if result is None:
-            still_ok = 0
+            if data is not None:
+                result = usb_treehash.unpack_tree(data)
 
-        return still_ok
+        return result
 
-    def client_get_max_packet(self):
-        self.print_debug(3, "Sending GetMaxPacket() Command")
+    #
+    #   Like client_compare_hash_file(), but with tree hashes, so it also
+    #   returns the byte ranges of the remote file that are different
+    #   (see usb_treehash.diff_ranges) and both trees
+    #
+    def client_compare_tree_hash(self, localpath, remotepath,
+                                 leaf_size=usb_treehash.DEF_LEAF_SIZE):
+        local_tree = None
+        remote_tree = None
+        ranges = []
 
-        data = self.__client_send_cmd_and_receive_all(b"M")
+        if not os.path.isfile(localpath):
+            res = 2  # Local file not found
 
-        if data is not None:
-            data = data[0] + (data[1] * 256) + (data[2] * 256**2) + \
-                (data[3] * 256**3)
+        else:
+            # (hash the local file with the leaf size the server used)
+            remote_tree = self.client_tree_hash_file(remotepath, leaf_size)
 
-        return data
+            if remote_tree is not None:
+                local_tree = self.compute_tree_hash(localpath,
+                                                    remote_tree.leaf_size)
 
-    def client_get_symlink(self, pathname):
-        self.print_debug(3, "Sending GetSymlink() Command, arg=", pathname)
+            if remote_tree is None:
+                res = 3  # Remote file not found
 
-        if isinstance(pathname, str):
-            pathname = pathname.encode('latin1')
+            elif local_tree is None:
+                res = 2
 
-        data = self.__client_send_cmd_and_receive_all(b"K", pathname)
+            else:
+                ranges = usb_treehash.diff_ranges(local_tree, remote_tree)
 
-        if isinstance(data, bytearray):
-            data = bytes(data)
+                if len(ranges) == 0:
+                    res = 0  # Same file
+                else:
+                    res = 1  # Different file
 
-        return data
+        return (res, ranges, local_tree, remote_tree)
 
     #
-    # (is_dir, mode, size, mtime, ctime)
+    #   Check that a local file matches the remote one.  With "repair",
+    #   only the parts that are different are fetched again (if the
+    #   server can do tree hashes).  Returns (res, ranges, still_bad)
+    #   where "res" is as for client_compare_hash_file() (after any
+    #   repair), "ranges" lists what was different and "still_bad" what
+    #   is still different after the repair (both None if not known).
     #
-    # mtime and ctime are truncated to whole seconds only
+    #   If the server does not send a tree hash, the hashes of the whole
+    #   files are compared instead, so a res of 3 means that the remote
+    #   file could not be hashed at all (not that it is different).
     #
-    def client_stat_path(self, pathname):
-        self.print_debug(3, "Sending Stat() Command, arg=", pathname)
+    def client_verify_file(self, localpath, remotepath, repair=False):
+        ranges = None
+        still_bad = None
+        res = 3
 
-        if isinstance(pathname, str):
-            pathname = pathname.encode('latin1')
+        if self.client_has_feature(FEATURE_TREEHASH):
+            (res, ranges, local_tree, remote_tree) = \
+                    self.client_compare_tree_hash(localpath, remotepath)
 
-        data = self.__client_send_cmd_and_receive_all(b"S", pathname)
-        if data is not None:
-            #(flags, mode, size, mtime, ctime) = struct.unpack("<BHLLL", data)
-            #data = (flags, mode, size, mtime, ctime)
+            still_bad = ranges
 
-            data = self.stat_struct.unpack(data)
+            if (res == 1) and repair:
+                if self.__client_fetch_ranges(localpath, remotepath, ranges,
+                                              remote_tree.file_size):
+                    (res, still_bad, local_tree, remote_tree) = \
+                            self.client_compare_tree_hash(localpath,
+                                                          remotepath)
 
-        self.print_debug(4, "stat() returned", data)
+        if res == 3:
+            (res, local_hash, remote_hash) = \
+                    self.client_compare_hash_file(localpath, remotepath)
 
-        return data
+            still_bad = None
 
-    def client_stat_pathToDict(self, pathname):
-        new_dict = None
+        return (res, ranges, still_bad)
 
-        data = self.client_stat_path(pathname)
+    # Overwrite parts of a local file with the same parts of a remote one
+    def __client_fetch_ranges(self, localpath, remotepath, ranges, size):
+        still_ok = 1
 
-        if data is not None:
-            (flags, mode, size, mtime, ctime) = data
-            new_dict = {}
+        fd = os.open(localpath, os.O_WRONLY)
+        os.truncate(fd, size)
 
-            new_dict['is_dir'] = flags & 0x01
-            new_dict['is_symlink'] = flags & 0x80
+        for (offset, length) in ranges:
+            pos = offset
 
-            new_dict['flags'] = flags
-            new_dict['mode'] = mode
-            new_dict['size'] = size
-            new_dict['mtime'] = mtime
-            new_dict['ctime'] = ctime
+            def range_callback(data):
+                nonlocal pos
 
-        return new_dict
+                if data is not None:
+                    os.pwrite(fd, data, pos)
+                    pos += len(data)
 
-    def client_local_stat_path(self, pathname):
-        result = None
+            if still_ok and (length > 0):
+                self.print_debug(2, "Fetching", remotepath, offset, length)
 
-        if isinstance(pathname, str):
-            pathname = pathname.encode('latin1')
+                still_ok = self.client_get_file_rangeCB(remotepath, offset,
+                                                        length,
+                                                        range_callback)
 
-        stat_res = self.stat_file_helper(pathname)
+        os.close(fd)
 
-        if stat_res is not None:
-            result = stat_res
+        return still_ok
 
-        return result
+    def client_get_fileYield(self, pathname, as_bytes=False):
+        self.print_debug(3,
+                         "Sending GetFile Command with yield, arg=", pathname)
 
-#
-# ----------------------------------------------------------------------
-#
-    def client_local_stat_pathToDict(self, pathname):
         if isinstance(pathname, str):
             pathname = pathname.encode('latin1')
 
-        result = None
+        (cmd, window, credits, decoder) = self.__client_file_cmd()
 
-        stat_res = self.stat_file_helper(pathname)
+        # Returns as bytes() not a str()
+        data_gen = self.__client_send_cmd_and_receive_all_yield(cmd,
+                                    pathname, as_bytes, window, credits)
 
-        if stat_res is not None:
-            (flags, mode, size, mtime, ctime) = stat_res
+        if decoder is not None:
+            data_gen = self.__client_decode_yield(decoder, data_gen, as_bytes)
 
-            result = {}
+        return data_gen
 
-            result["is_dir"] = flags & 0x01
-            result["is_symlink"] = flags & 0x80
-            result["is_file"] = flags & 0x02
+    #
+    #   Decompress the data from a generator as it arrives
+    #   (like an uncompressed transfer, it just stops early on errors)
+    #
+    def __client_decode_yield(self, decoder, data_gen, as_bytes):
+        try:
+            for data in data_gen:
+                data = decoder.feed(data)
 
-            result["flags"] = flags
-            result["mode"] = mode
-            result["size"] = size
-            result["mtime"] = mtime
-            result["ctime"] = ctime
+                if len(data) > 0:
+                    yield bytes(data) if as_bytes else data
 
-        return result
+            data = decoder.finish()
 
+            if not decoder.complete:
+                print("Incomplete compressed data received", file=sys.stderr)
 
-#
-# ----------------------------------------------------------------------
-#
+            elif len(data) > 0:
+                yield bytes(data) if as_bytes else data
+
+        except Exception as my_except:
+            print("Bad compressed data received:", my_except,
+                  file=sys.stderr)
+
+    # (see client_get_file() for "verify")
+    def client_get_fileCB(self, pathname, callback, verify=False):
+        still_ok = 1
+
+        self.print_debug(
+            3,
+            "Sending GetFile Command with callback, arg=",
+            pathname)
+
+        if isinstance(pathname, str):
+            pathname = pathname.encode('latin1')
+
+        (cmd, window, credits, decoder) = self.__client_file_cmd(verify)
+
+        if decoder is None:
+            result = self.__client_send_cmd_and_receive_all(cmd,
+                                     pathname, callback, window, credits)
+
+        else:
+            result = self.__client_decode_CB(decoder, cmd, pathname,
+                                             callback, window, credits)
+
+        if result is None:
+            still_ok = 0
+
+        return still_ok
+
+    # Decompress the data before it is handed to the callback
+    def __client_decode_CB(self, decoder, cmd, pathname, callback,
+                           window, credits):
+        bad_data = False
+
+        def decode_callback(data):
+            nonlocal bad_data
+
+            if bad_data:
+                pass            # Already reported
+
+            elif data is None:
+                callback(None)
+
+            else:
+                try:
+                    data = decoder.feed(data)
+
+                except Exception as my_except:
+                    print("Bad compressed data received:", my_except,
+                          file=sys.stderr)
+                    bad_data = True
+                    callback(None)
+
+                if (not bad_data) and (len(data) > 0):
+                    callback(data)
+
+        result = self.__client_send_cmd_and_receive_all(cmd,
+                                pathname, decode_callback, window, credits)
+
+        if (result is not None) and (not bad_data):
+            data = decoder.finish()
+
+            if not decoder.complete:
+                result = None
+                callback(None)
+
+            elif len(data) > 0:
+                callback(data)
+
+        if bad_data:
+            result = None
+
+        return result
+
+    # Build the ranged ("R") form of a file request
+    def __client_range_cmd(self, offset, length):
+        window = self.client_get_stream_window()
+
+        cmd = b"R" + self.one_byte_struct.pack(window) + \
+                self.range_struct.pack(offset, length)
+
+        if window > 0:
+            result = (cmd, window, window)
+        else:
+            result = (cmd, 0, 1)
+
+        return result
+
+    #
+    #   Get "length" bytes of a file starting at "offset"
+    #   (a length of 0 gets everything up to the end of the file)
+    #
+    #   Servers without ranged gets send the whole file, and the
+    #   unwanted parts are thrown away here.
+    #
+    def client_get_file_range(self, pathname, offset, length=0):
+        if isinstance(pathname, str):
+            pathname = pathname.encode('latin1')
+
+        self.print_debug(3, "Sending GetFileRange Command, arg=", pathname,
+                         offset, length)
+
+        if self.client_has_feature(FEATURE_RANGE):
+            (cmd, window, credits) = self.__client_range_cmd(offset, length)
+
+            data = self.__client_send_cmd_and_receive_all(cmd, pathname,
+                                            window=window, credits=credits)
+
+        else:
+            data = self.client_get_file(pathname)
+
+            if data is not None:
+                if length > 0:
+                    data = data[offset:offset + length]
+                else:
+                    data = data[offset:]
+
+        return data
+
+    def client_get_file_rangeCB(self, pathname, offset, length, callback):
+        still_ok = 1
+
+        if isinstance(pathname, str):
+            pathname = pathname.encode('latin1')
+
+        self.print_debug(3, "Sending GetFileRange Command with callback, arg=",
+                         pathname, offset, length)
+
+        if self.client_has_feature(FEATURE_RANGE):
+            (cmd, window, credits) = self.__client_range_cmd(offset, length)
+
+            result = self.__client_send_cmd_and_receive_all(cmd,
+                                     pathname, callback, window, credits)
+
+            if result is None:
+                still_ok = 0
+
+        else:
+            # Skip over everything before the offset (and after the end)
+            pos = 0
+
+            def range_callback(data):
+                nonlocal pos
+
+                if data is None:
+                    callback(None)
+
+                else:
+                    start = max(offset - pos, 0)
+                    end = len(data)
+
+                    if length > 0:
+                        end = min(end, offset + length - pos)
+
+                    pos += len(data)
+
+                    if start < end:
+                        callback(data[start:end])
+
+            still_ok = self.client_get_fileCB(pathname, range_callback)
+
+        return still_ok
+
+    #
+    #   Upload data into a server transaction slot (for a later command)
+    #   Returns the transaction id, or None if the upload failed
+    #
+    def __client_upload(self, data):
+        trans_id = 0
+        chunk_size = self.max_packet - 2
+        pos = 0
+
+        while (trans_id is not None) and \
+                ((pos < len(data)) or (trans_id == 0)):
+            chunk = data[pos:pos + chunk_size]
+            pos += len(chunk)
+
+            res = self.__client_send_cmd_and_receive_all(b"U" +
+                            self.one_byte_struct.pack(trans_id) + chunk)
+
+            if res is None:
+                trans_id = None
+
+            elif trans_id == 0:
+                if len(res) == 1:
+                    trans_id = res[0]
+                else:
+                    trans_id = None
+
+        return trans_id
+
+    #
+    #   Get a file by only transferring the changes from an older copy
+    #   of it ("basis_path"), e.g. the current local version of the file.
+    #   The (whole) new file is handed to the callback.
+    #
+    #   Falls back to getting the whole file if the server cannot do this.
+    #
+    def client_get_file_delta(self, pathname, basis_path, callback):
+        if isinstance(pathname, str):
+            pathname = pathname.encode('latin1')
+
+        self.print_debug(3, "Sending GetFileDelta Command, arg=", pathname,
+                         basis_path)
+
+        if self.client_has_feature(FEATURE_DELTA):
+            still_ok = self.__client_get_file_delta(pathname, basis_path,
+                                                    callback)
+        else:
+            still_ok = self.client_get_fileCB(pathname, callback)
+
+        return still_ok
+
+    def __client_get_file_delta(self, pathname, basis_path, callback):
+        still_ok = 1
+
+        block_size = usb_delta.choose_block_size(
+                                            os.path.getsize(basis_path))
+
+        trans_id = self.__client_upload(
+                        usb_delta.compute_signatures(basis_path, block_size))
+
+        if trans_id is None:
+            callback(None)
+            still_ok = 0
+
+        if still_ok:
+            bad_data = False
+            basis_f = open(basis_path, "rb")
+            decoder = usb_delta.DeltaDecoder(basis_f, block_size, callback)
+
+            def delta_callback(data):
+                nonlocal bad_data
+
+                if bad_data:
+                    pass            # Already reported
+
+                elif data is None:
+                    callback(None)
+
+                else:
+                    try:
+                        decoder.feed(data)
+
+                    except Exception as my_except:
+                        print("Bad delta data received:", my_except,
+                              file=sys.stderr)
+                        bad_data = True
+                        callback(None)
+
+            window = self.client_get_stream_window()
+
+            result = self.__client_send_cmd_and_receive_all(b"D" +
+                            self.one_byte_struct.pack(window) +
+                            self.one_byte_struct.pack(trans_id),
+                            pathname, delta_callback, window, max(window, 1))
+
+            basis_f.close()
+
+            if (result is None) or bad_data:
+                still_ok = 0
+
+            elif not decoder.finish():
+                print("Delta transfer did not rebuild the file correctly",
+                      file=sys.stderr)
+                callback(None)
+                still_ok = 0
+
+        return still_ok
+
+    def client_get_max_packet(self):
+        self.print_debug(3, "Sending GetMaxPacket() Command")
+
+        data = self.__client_send_cmd_and_receive_all(b"M")
+
+        if data is not None:
+            data = data[0] + (data[1] * 256) + (data[2] * 256**2) + \
+                (data[3] * 256**3)
+
+        return data
+
+    def client_get_symlink(self, pathname):
+        self.print_debug(3, "Sending GetSymlink() Command, arg=", pathname)
+
+        if isinstance(pathname, str):
+            pathname = pathname.encode('latin1')
+
+        data = self.__client_send_cmd_and_receive_all(b"K", pathname)
+
+        if isinstance(data, bytearray):
+            data = bytes(data)
+
+        return data
+
+    #
+    # (is_dir, mode, size, mtime, ctime)
+    #
+    # mtime and ctime are truncated to whole seconds only
+    #
+    def client_stat_path(self, pathname):
+        self.print_debug(3, "Sending Stat() Command, arg=", pathname)
+
+        if isinstance(pathname, str):
+            pathname = pathname.encode('latin1')
+
+        data = self.__client_send_cmd_and_receive_all(b"S", pathname)
+        if data is not None:
+            #(flags, mode, size, mtime, ctime) = struct.unpack("<BHLLL", data)
+            #data = (flags, mode, size, mtime, ctime)
+
+            data = self.stat_struct.unpack(data)
+
+        self.print_debug(4, "stat() returned", data)
+
+        return data
+
+    def client_stat_pathToDict(self, pathname):
+        return self.stat_to_dict(self.client_stat_path(pathname))
+
+    #
+    # List a directory along with the stat() of every entry
+    #
+    #   Returns a list of (name, (flags, mode, size, mtime, ctime), link)
+    #   for a directory, a single such tuple for a file (unless dir_only)
+    #   or None if the path was not found.  "link" is the destination of
+    #   a symlink ("" if not a symlink).
+    #
+    def client_ls_stat(self, pathname, dir_only=False):
+        self.print_debug(3, "Sending LS+Stat Command, arg=", pathname)
+
+        if isinstance(pathname, str):
+            pathname = pathname.encode('latin1')
+
+        if self.client_has_feature(FEATURE_LISTSTAT):
+            data = self.__client_list_cmd(b"A", pathname,
+                            window=self.client_get_stream_window())
+
+            if data is not None:
+                data = self.__client_parse_ls_stat(data)
+
+        else:
+            data = self.__client_ls_stat_slowly(pathname, dir_only)
+
+        # A single (non-directory) entry?
+        if (data is not None) and (len(data) == 1) and (data[0][0] == ""):
+            if dir_only:
+                data = None
+            else:
+                (name, stat_res, link) = data[0]
+                data = (os.path.basename(pathname).decode('latin1'),
+                        stat_res, link)
+
+        return data
+
+    def client_ls_statToDict(self, pathname, dir_only=False):
+        result = self.client_ls_stat(pathname, dir_only)
+
+        if isinstance(result, tuple):
+            (name, stat_res, link) = result
+            result = (name, self.stat_to_dict(stat_res))
+            result[1]['link'] = link
+
+        elif result is not None:
+            new_result = []
+
+            for (name, stat_res, link) in result:
+                new_dict = self.stat_to_dict(stat_res)
+                new_dict['link'] = link
+
+                new_result.append((name, new_dict))
+
+            result = new_result
+
+        return result
+
+    #
+    #   Each entry is <len:16bit><name><stat record><len:16bit><link>
+    #   (a file, rather than a directory, is sent as one entry w/o a name)
+    #
+    def __client_parse_ls_stat(self, data):
+        result = []
+
+        start = 0
+        whole_len = len(data)
+
+        while start < whole_len:
+            (name_len,) = self.two_byte_struct.unpack_from(data, start)
+            start += self.two_byte_struct.size
+
+            name = bytes(data[start:start + name_len]).decode('latin1')
+            start += name_len
+
+            stat_res = self.stat_long_struct.unpack_from(data, start)
+            start += self.stat_long_struct.size
+
+            (link_len,) = self.two_byte_struct.unpack_from(data, start)
+            start += self.two_byte_struct.size
+
+            link = bytes(data[start:start + link_len]).decode('latin1')
+            start += link_len
+
+            result.append((name, stat_res, link))
+
+        return result
+
+    # Same results as "A", but for servers (or relays) without it
+    def __client_ls_stat_slowly(self, pathname, dir_only):
+        result = None
+
+        names = self.client_ls(pathname, dir_only)
+
+        if isinstance(names, list):
+            result = []
+
+            for name in names:
+                fullpath = pathname + b"/" + name.encode('latin1')
+                entry = self.__client_stat_and_link(fullpath, name)
+
+                if entry is not None:
+                    result.append(entry)
+
+        elif names is not None:
+            entry = self.__client_stat_and_link(pathname, "")
+
+            if entry is not None:
+                result = [entry]
+
+        return result
+
+    def __client_stat_and_link(self, fullpath, name):
+        entry = None
+        link = ""
+
+        stat_res = self.client_stat_path(fullpath)
+
+        if stat_res is not None:
+            if stat_res[0] & 0x80:
+                link = self.client_get_symlink(fullpath)
+
+                if link is not None:
+                    link = link.decode('latin1')
+
+            if link is not None:
+                entry = (name, stat_res, link)
+
+        return entry
+
+    #
+    #   Get a manifest of a whole directory tree (in one transaction) and
+    #   yield (relative path, (flags, mode, size, mtime, ctime), link,
+    #   digest) for every entry, where the digest is the SHA-512 (hex) of
+    #   a file if the server had it (and "digests" is set) or None.
+    #   A directory that could not be read is yielded with a stat of None.
+    #
+    #   Only directories up to "max_depth" levels down are listed.
+    #   Raises IOError if the whole manifest did not arrive (or the server
+    #   cannot send one - see FEATURE_MANIFEST).
+    #
+    def client_manifest(self, pathname,
+                        max_depth=usb_manifest.MAX_MANIFEST_DEPTH,
+                        digests=False):
+        if isinstance(pathname, str):
+            pathname = pathname.encode('latin1')
+
+        self.print_debug(3, "Sending Manifest Command, arg=", pathname)
+
+        if not self.client_has_feature(FEATURE_MANIFEST):
+            raise IOError("Server cannot send manifests")
+
+        window = self.client_get_stream_window()
+        algos = 0
+        flags = 0
+
+        if self.client_use_compression():
+            algos = self.compress_algos
+
+        if digests:
+            flags |= usb_manifest.MANIFEST_DIGESTS
+
+        cmd = b"E" + bytes([window, algos, flags,
+                            min(max_depth, usb_manifest.MAX_MANIFEST_DEPTH)])
+
+        data_gen = self.__client_decode_yield(usb_compress.StreamDecoder(),
+                        self.__client_send_cmd_and_receive_all_yield(cmd,
+                                pathname, False, window, max(window, 1)),
+                        False)
+
+        parser = usb_manifest.ManifestParser()
+
+        for data in data_gen:
+            for (rec_type, path, stat_res, link, digest) in \
+                    parser.feed(data):
+                path = path.decode('latin1')
+
+                if rec_type == usb_manifest.RECORD_ENTRY:
+                    if len(digest) > 0:
+                        digest = digest.hex()
+                    else:
+                        digest = None
+
+                    yield (path, stat_res, link.decode('latin1'), digest)
+
+                elif rec_type == usb_manifest.RECORD_UNREADABLE:
+                    yield (path, None, "", None)
+
+        if not parser.ended:
+            raise IOError("Incomplete manifest received for " +
+                          pathname.decode('latin1'))
+
+    #
+    #   Ask for the changes under a directory since "generation" (from
+    #   an earlier call, along with its "journal_id" - use 0 for both the
+    #   first time).  Returns (journal_id, generation, changes) where
+    #   changes is a list of (kind, relative path), kind being one of the
+    #   usb_journal.CHANGE_* values, or None if the client has to do a
+    #   full resync.  Returns None if the server cannot do this.
+    #
+    def client_changes_since(self, pathname, journal_id, generation):
+        result = None
+
+        if isinstance(pathname, str):
+            pathname = pathname.encode('latin1')
+
+        self.print_debug(3, "Sending ChangesSince Command, arg=", pathname,
+                         journal_id, generation)
+
+        if self.client_has_feature(FEATURE_JOURNAL):
+            algos = 0
+
+            if self.client_use_compression():
+                algos = self.compress_algos
+
+            data = self.__client_send_cmd_and_receive_all(b"J" +
+                            self.one_byte_struct.pack(algos) +
+                            usb_journal.id_gen_struct.pack(journal_id,
+                                                           generation),
+                            pathname)
+
+            data = self.__client_decode_all(usb_compress.StreamDecoder(),
+                                            data)
+
+            if (data is not None) and \
+                    (len(data) > usb_journal.id_gen_struct.size):
+                (journal_id, generation) = \
+                        usb_journal.id_gen_struct.unpack_from(data, 0)
+                pos = usb_journal.id_gen_struct.size
+
+                changes = None
+
+                if data[pos] == 0:
+                    changes = [(kind, path.decode('latin1'))
+                               for (kind, path) in
+                               usb_journal.unpack_changes(data, pos + 1)]
+
+                result = (journal_id, generation, changes)
+
+        return result
+
+    def client_local_stat_path(self, pathname):
+        result = None
+
+        if isinstance(pathname, str):
+            pathname = pathname.encode('latin1')
+
+        stat_res = self.stat_file_helper(pathname)
+
+        if stat_res is not None:
+            result = stat_res
+
+        return result
+
+#
+# ----------------------------------------------------------------------
+#
+    def client_local_stat_pathToDict(self, pathname):
+        if isinstance(pathname, str):
+            pathname = pathname.encode('latin1')
+
+        result = None
+
+        stat_res = self.stat_file_helper(pathname)
+
+        if stat_res is not None:
+            (flags, mode, size, mtime, ctime) = stat_res
+
+            result = {}
+
+            result["is_dir"] = flags & 0x01
+            result["is_symlink"] = flags & 0x80
+            result["is_file"] = flags & 0x02
+
+            result["flags"] = flags
+            result["mode"] = mode
+            result["size"] = size
+            result["mtime"] = mtime
+            result["ctime"] = ctime
+
+        return result
+
+
+#
+# ----------------------------------------------------------------------
+#
 
 class Server(USBComm):
+    # (in place - the slots are shared with the threads of tagged requests)
     def __reset_buffers(self):
+        for i in range(0, MAX_TRANSACTIONS):
+            self.clear_one_slot(i)
+
+    def __init__(self, raw_port, timeout):
         self.buffer = [None] * MAX_TRANSACTIONS
         self.init_time = [0] * MAX_TRANSACTIONS
         self.buff_start = [0] * MAX_TRANSACTIONS
         self.buff_len = [0] * MAX_TRANSACTIONS
+        self.good_prefixes = []
+
+        # The aliases (to their real paths) and the real paths that are
+        #  allowed, and the answers of path_is_good() (see usb_pathcache)
+        self.alias_trie = usb_pathcache.PrefixTrie()
+        self.good_trie = usb_pathcache.PrefixTrie()
+        self.path_cache = usb_pathcache.PathCache()
+
+        # Tagged requests ("I") are handled by a thread for each tag, so
+        #  sending, finding a free slot and sending from a slot is locked
+        self.send_lock = threading.RLock()
+        self.slot_lock = threading.Lock()
+        self.slot_locks = [threading.Lock() for i in range(MAX_TRANSACTIONS)]
+        self.tag_ports = {}
+
+        self.packet_buffer = bytearray(raw_port.max_packet)
+        self.packet_mv = memoryview(self.packet_buffer)
+
+        self.features = SERVER_FEATURES
+
+        # Compression types (in order of preference) and level
+        self.compress_algos = usb_compress.parse_algo_list("zstd,zlib")
+        self.compress_level = usb_compress.DEF_COMPRESS_LEVEL
+
+        # Optional persistent cache of file hashes (see usb_hashcache)
+        self.hash_cache = None
+
+        # Optional journal of the changes to files (see usb_journal)
+        self.journal = None
+
+        # Optional pool that runs slow requests ("B" - see usb_jobs)
+        self.job_pool = None
+
+        # Bytes of a file to read ahead of the client (see usb_readahead)
+        self.read_ahead = usb_readahead.DEF_READ_AHEAD
+
+        # When the last command arrived (to tell if the link is idle)
+        self.last_cmd_time = time.time()
+
+        USBComm.__init__(self, raw_port, timeout)
+
+    #
+    #   Set the compression types offered (in order of preference) and
+    #   the compression level (an empty list turns compression off)
+    #
+    def server_set_compression(self, algo_list, level):
+        self.compress_algos = algo_list
+        self.compress_level = level
+
+        if len(algo_list) > 0:
+            self.features |= FEATURE_COMPRESS
+        else:
+            self.features &= ~FEATURE_COMPRESS
+
+    def server_set_hash_cache(self, hash_cache):
+        self.hash_cache = hash_cache
+
+    def server_set_journal(self, journal):
+        self.journal = journal
+
+        if self.path_cache is not None:
+            self.path_cache.set_journal(journal)
+
+        if journal is not None:
+            self.features |= FEATURE_JOURNAL
+        else:
+            self.features &= ~FEATURE_JOURNAL
+
+    def server_set_job_pool(self, job_pool):
+        self.job_pool = job_pool
+
+        if job_pool is not None:
+            self.features |= FEATURE_JOBS
+        else:
+            self.features &= ~FEATURE_JOBS
+
+    # Seconds to keep the answers of path_is_good() (0 = no cache)
+    def server_set_path_cache(self, ttl, max_entries):
+        self.path_cache = None
+
+        if ttl > 0:
+            self.path_cache = usb_pathcache.PathCache(ttl, max_entries,
+                                                      self.journal)
+
+    # How much of a file to read ahead when sending it (0 = none)
+    def server_set_read_ahead(self, num_bytes):
+        self.read_ahead = num_bytes
+
+    # True if no command arrived in the last "idle_secs" seconds
+    def server_is_idle(self, idle_secs):
+        return time.time() - self.last_cmd_time >= idle_secs
+
+    # The real (not aliased) directories that clients can access
+    def server_good_roots(self):
+        roots = []
+
+        for (real_p, alias_p) in self.good_prefixes:
+            if real_p not in roots:
+                roots.append(real_p)
+
+        return roots
+
+    #
+    #   compute_hash() and compute_tree_hash(), but using the hash cache
+    #   (if there is one)
+    #
+    def server_hash_file(self, realpath):
+        if self.hash_cache is None:
+            result = self.compute_hash(realpath)
+
+        else:
+            result = self.hash_cache.lookup(realpath,
+                            usb_hashcache.KIND_SHA512,
+                            lambda path: self.__hash_as_bytes(path))
+
+            if result is not None:
+                result = result.decode('latin1')
+
+        return result
+
+    def __hash_as_bytes(self, realpath):
+        result = self.compute_hash(realpath)
+
+        if result is not None:
+            result = result.encode('latin1')
+
+        return result
+
+    def server_tree_hash_file(self, realpath, leaf_size):
+        if self.hash_cache is None:
+            result = self.compute_tree_hash(realpath, leaf_size)
+
+        else:
+            result = self.hash_cache.lookup(realpath,
+                            usb_hashcache.tree_kind(leaf_size),
+                            lambda path: self.__tree_hash_as_bytes(path,
+                                                                leaf_size))
+
+            if result is not None:
+                result = usb_treehash.unpack_tree(result)
+
+        return result
+
+    # The digest of a file, but only if it is already in the hash cache
+    def server_cached_digest(self, realpath, stat_res):
+        result = None
+
+        if self.hash_cache is not None:
+            result = self.hash_cache.get(usb_hashcache.stat_key(stat_res),
+                                         usb_hashcache.KIND_SHA512)
+
+            if result is not None:
+                result = bytes.fromhex(result.decode('latin1'))
+
+        return result
+
+    def __tree_hash_as_bytes(self, realpath, leaf_size):
+        result = self.compute_tree_hash(realpath, leaf_size)
+
+        if result is not None:
+            result = usb_treehash.pack_tree(result)
+
+        return result
+
+#
+# ----------------------------------------------------------------------
+#
+    def add_slash(self, p):
+        if isinstance(p, str):
+            p = p.encode("latin1")
+
+        if not p.endswith(b"/"):
+            p = p + b"/"
+
+        return p
+
+    def add_prefix_entry(self, real_p, alias_p):
+        if isinstance(real_p, str):
+            real_p = real_p.encode("latin1")
+
+        if isinstance(alias_p, str):
+            alias_p = alias_p.encode("latin1")
+
+        self.good_prefixes.append([real_p, alias_p])
+
+        self.alias_trie.insert(alias_p, real_p)
+        self.good_trie.insert(real_p, True)
+
+        if self.path_cache is not None:
+            self.path_cache.clear()
+
+    def add_good_prefix(self, p):
+        # Allow for the form of <real-path> <alias-path>+
+        if isinstance(p, list):
+            if len(p) == 1:
+                real_p = self.add_slash(p[0])
+
+                self.add_prefix_entry(real_p, real_p)
+                self.print_debug(4, "Added GOOD_PREFIX", real_p)
+
+            elif len(p) > 1:
+                real_p = self.add_slash(p[0])
+
+                for alias_p in p[1:]:
+                    alias_p = self.add_slash(alias_p)
+
+                    self.add_prefix_entry(real_p, alias_p)
+                    self.print_debug(4, "Added GOOD_PREFIX", real_p, alias_p)
+
+        elif isinstance(p, str):
+            real_p = self.add_slash(p)
+
+            self.add_prefix_entry(real_p, real_p)
+            self.print_debug(4, "Added GOOD_PREFIX", real_p)
+
+        else:
+            print("Invalid path given to add_good_prefix",
+                  p, "ignoring", file=sys.stderr)
+
+
+#
+# ----------------------------------------------------------------------
+#
+
+    # Convert any aliases into real paths
+    #   (the longest alias that the path starts with)
+
+    def path_convert_aliases(self, p):
+
+        (real_p, rest) = self.alias_trie.longest_match(p)
+
+        if rest is None:
+            pass
+        elif len(rest) == 0:
+            p = real_p[:-1]
+        else:
+            p = real_p + b"/".join(rest)
+
+        return p
+
+    def path_is_good(self, p):
+        result = None
+
+        if self.path_cache is not None:
+            (unaliased_p, result) = self.path_cache.get(p)
+
+        # (a symlink on the way may lead somewhere else now)
+        if (result is not None) and \
+                (os.path.realpath(unaliased_p) != result[1]):
+            result = None
+
+        if result is None:
+            # Unalias the path
+            unaliased_p = self.path_convert_aliases(p)
+
+            result = self.__path_check(unaliased_p)
+
+            # (only allowed paths - a missing one may be created any time)
+            if (self.path_cache is not None) and result[0]:
+                self.path_cache.put(p, unaliased_p, result)
+
+        return result
+
+    def __path_check(self, p):
+        is_good = False
+
+        # Convert to an absolute path
+        p = os.path.realpath(p)
+
+        # Allow for access to the real directory itself too
+        if self.good_trie.has_prefix_of(p):
+            is_good = True
+
+        # Disallow non files and directories
+        try:
+            mode = os.stat(p).st_mode
+
+        except (OSError, ValueError) as my_except:
+            mode = 0
+
+        if (not stat.S_ISREG(mode)) and (not stat.S_ISDIR(mode)):
+            is_good = False
+
+        # Extra check for symlinks that go out of a good section
+        # if (is_good) and (os.path.islink(p)):
+        #    (is_good, p2) = self.path_is_good(os.readlink(p))
+
+        return (is_good, p)
+#
+# ----------------------------------------------------------------------
+#
+
+    def clear_one_slot(self, i):
+        # If this is a file handle, then close it first
+        if isinstance(self.buffer[i], io.BufferedReader):
+            self.buffer[i].close()
+
+        self.buffer[i] = None
+        self.init_time[i] = 0
+        self.buff_start[i] = 0
+        self.buff_len[i] = 0
+
+    def purge_old_buffers(self, purge_time=240):
+        too_old = int(time.time() - purge_time)
+
+        for i in range(0, MAX_TRANSACTIONS):
+            # Delete transactions older than the purge time
+            if self.init_time[i] < too_old:
+                self.clear_one_slot(i)
+
+    def find_free_slot_h(self):
+        start = random.randint(1, MAX_TRANSACTIONS - 1)
+        last = (start - 1) % MAX_TRANSACTIONS
+
+        # Skip the zero slot
+        if last == 0:
+            last = 1
+
+        i = start
+        while (self.buffer[i] is not None) and (i != last):
+            i = i + 1
+            i = i % MAX_TRANSACTIONS
+
+            # Skip slot 0
+            if i == 0:
+                i = 1
+
+        # Did we run out of buffers?  if so, then return -1 as an error
+        if self.buffer[i] is not None:
+            i = -1
 
-    def __init__(self, raw_port, timeout):
-        self.__reset_buffers()
-        self.good_prefixes = []
+        return i
 
-        self.packet_buffer = bytearray(raw_port.max_packet)
-        self.packet_mv = memoryview(self.packet_buffer)
+    #  Find a free slot (and reserve it), but try to purge if necessary
+    def find_free_slot(self):
+        with self.slot_lock:
+            free_slot = self.find_free_slot_h()
 
-        USBComm.__init__(self, raw_port, timeout)
+            if free_slot < 0:
+                self.purge_old_buffers()
+                free_slot = self.find_free_slot_h()
+
+            if free_slot >= 0:
+                self.buffer[free_slot] = SLOT_RESERVED
+                self.init_time[free_slot] = int(time.time())
+
+        return free_slot
+
+    #
+    # ----------------------------------------------------------------------
+    #
+
+    def send_packet(self, data):
+        with self.send_lock:
+            retval = USBComm.send_packet(self, data)
+
+        return retval
+
+    def send_packet_vec(self, bufs):
+        with self.send_lock:
+            retval = USBComm.send_packet_vec(self, bufs)
+
+        return retval
+
+    def server_send_one_packet(self, response, trans_id=0, data=b""):
+        still_ok = 1
+
+        # Double check to see if the resulting packet would be too big
+        if len(data) + 2 > self.raw_port.max_packet:
+            still_ok = 0
+
+        # (the data is sent from where it is, after the header)
+        elif len(data) > 0:
+            still_ok = self.send_packet_vec([response +
+                                 self.one_byte_struct.pack(trans_id), data])
+
+        else:
+            still_ok = self.send_packet(response +
+                                 self.one_byte_struct.pack(trans_id))
+
+        return still_ok
+
+    def server_send_err_response(self):
+        return self.server_send_one_packet(b"z")
+
+    def __server_send_data_response(self, data=b""):
+        still_ok = 1
+
+        response = b"l"      # default=Last packet
+        trans_id = 0         # default to no transaction (since single packet)
+
+        whole_len = len(data)
+        end = whole_len
+
+        # (the packets are sent from views of the data - not copies)
+        data = memoryview(data)
+
+        # Does the data (+ 2 byte header) NOT fit into a single packet?
+        if whole_len + 3 > self.raw_port.max_packet:
+
+            end = self.raw_port.max_packet - 2
+            my_slot = self.find_free_slot()
+
+            # Valid slot?
+            if my_slot != -1:
+                self.buffer[my_slot] = data[end:]
+
+                # Record when created
+                self.init_time[my_slot] = int(time.time())
+
+                # At the beginning of the buffer
+                self.buff_start[my_slot] = 0
+
+                # What (how much) is left to buffer
+                self.buff_len[my_slot] = whole_len - end
+
+                response = b"d"
+
+                # Convert to 1..MAX_TRANSACTIONS (vs. 0..MAX_TRANSACTIONS-1)
+                trans_id = my_slot
+
+            else:
+                still_ok = 0
+                self.server_send_err_response()
+
+        # Check to see if it still possible to send the packet
+        if still_ok != 0:
+            still_ok = self.server_send_one_packet(response, trans_id, data[:end])
+
+        return still_ok
+
+    def __server_send_next_from_file(self, i):
+        still_ok = 1
+
+        if self.buffer[i] is None:
+            still_ok = self.send_packet(b"l" + i.to_byte(1, 'little'))
+
+        else:
+            end = self.raw_port.max_packet
+
+            # Only part of the file was requested?  (-1 = to the end)
+            if (self.buff_len[i] >= 0) and (self.buff_len[i] < end - 2):
+                end = self.buff_len[i] + 2
+
+            try:
+                num_bytes = self.buffer[i].readinto(self.packet_mv[2:end])
+
+            except Exception as my_except:
+                still_ok = 0
+
+            if still_ok:
+                if self.buff_len[i] >= 0:
+                    self.buff_len[i] -= num_bytes
+
+                # If we didn't use all of the buffer (or sent all that was
+                #  asked for), then we are at the end
+
+                if (num_bytes < self.raw_port.max_packet - 2) or \
+                        (self.buff_len[i] == 0):
+                    self.packet_buffer[0] = 108      # b"l"
+                else:
+                    self.packet_buffer[0] = 100      # b"d"
+
+                self.packet_buffer[1] = i
+                still_ok = self.send_packet(self.packet_mv[:num_bytes + 2])
+
+                # Last packet?  If so, then clear after send
+                if self.packet_buffer[0] == 108:
+                    self.clear_one_slot(i)
+
+        return still_ok
+
+    #
+    #   Send "length" bytes of a file starting at "offset"
+    #   (a length of -1 sends everything up to the end of the file)
+    #
+    #   "wrapper" (if given) is called with the open file and returns the
+    #   file object to send from instead (e.g. a compressed version)
+    #
+    def server_send_data_from_file(self, pathname, window=1,
+                                   offset=0, length=-1, wrapper=None):
+        still_ok = 1
+
+        (is_good, realpath) = self.path_is_good(pathname)
+
+        # Reserve an empty buffer slot
+        my_slot = self.find_free_slot()
+
+        if is_good and os.path.isfile(realpath) and (my_slot != -1):
+            try:
+                f = open(pathname, "rb")
+                remaining = os.fstat(f.fileno()).st_size - offset
+
+                if (length >= 0) and (length < remaining):
+                    remaining = length
+
+                # Starting past the end of the file is an error
+                if remaining < 0:
+                    f.close()
+                    still_ok = 0
+
+                elif offset > 0:
+                    f.seek(offset)
+
+                # More than a packet to send?  Then read ahead of it
+                if still_ok and (self.read_ahead > 0) and \
+                        (remaining > self.raw_port.max_packet - 2):
+                    f = io.BufferedReader(usb_readahead.ReadAheadReader(f,
+                                                length, self.read_ahead))
+
+                # Send a different version of the file instead?
+                if still_ok and (wrapper is not None):
+                    f = wrapper(f)
+
+            except Exception as my_except:
+                still_ok = 0
+
+            if still_ok:
+                self.server_start_file_slot(my_slot, f, window, length)
+        else:
+            still_ok = 0
+
+        if still_ok == 0:
+            if my_slot != -1:
+                self.clear_one_slot(my_slot)
+
+            self.server_send_err_response()
+
+        return still_ok
+
+    # Send from an open file object (any io.BufferedReader) in a free slot
+    def server_send_data_from_reader(self, f, window=1):
+        still_ok = 1
+
+        my_slot = self.find_free_slot()
+
+        if my_slot != -1:
+            self.server_start_file_slot(my_slot, f, window, -1)
+
+        else:
+            f.close()
+            still_ok = 0
+            self.server_send_err_response()
+
+        return still_ok
+
+    def server_start_file_slot(self, my_slot, f, window, length):
+        self.buffer[my_slot] = f
+        self.init_time[my_slot] = int(time.time())
+
+        # How much is left to send (for files)
+        self.buff_len[my_slot] = length
+
+        # Send the first segment(s) of the file
+        self.__server_send_burst(my_slot, window)
+
+
+    #
+    #   Wrap an open file so that reading it returns the compressed data
+    #   (not compressed at all if it looks like it already is)
+    #
+    def server_compress_file(self, f, client_algos):
+        algo = usb_compress.choose_algo(self.compress_algos, client_algos)
+
+        first_block = f.read(usb_compress.COMPRESS_BLOCK)
+
+        if (algo != usb_compress.COMP_NONE) and \
+                usb_compress.looks_compressed(first_block):
+            self.print_debug(4, "Already compressed - sending as is")
+            algo = usb_compress.COMP_NONE
+
+        return io.BufferedReader(usb_compress.CompressedReader(f, algo,
+                                        self.compress_level, first_block))
 
 #
 # ----------------------------------------------------------------------
 #
-    def add_slash(self, p):
-        if isinstance(p, str):
-            p = p.encode("latin1")
 
-        if not p.endswith(b"/"):
-            p = p + b"/"
 
-        return p
+    def __send_next_buff_section(self, i):
 
-    def add_prefix_entry(self, real_p, alias_p):
-        if isinstance(real_p, str):
-            real_p = real_p.encode("latin1")
+        start = self.buff_start[i]
+        remain = self.buff_len[i] - start
 
-        if isinstance(alias_p, str):
-            alias_p = alias_p.encode("latin1")
+        if remain + 2 <= self.raw_port.max_packet:
+            end = start + remain
 
-        self.good_prefixes.append([real_p, alias_p])
+            still_ok = self.send_packet_vec([b"l" +
+                                 self.one_byte_struct.pack(i),
+                                 self.buffer[i][start:end]])
 
-    def add_good_prefix(self, p):
-        # Allow for the form of <real-path> <alias-path>+
-        if isinstance(p, list):
-            if len(p) == 1:
-                real_p = self.add_slash(p[0])
+            self.clear_one_slot(i)
 
-                self.add_prefix_entry(real_p, real_p)
-                self.print_debug(4, "Added GOOD_PREFIX", real_p)
+        else:
+            end = start + self.raw_port.max_packet - 2
+
+            still_ok = self.send_packet_vec([b"d" +
+                                 self.one_byte_struct.pack(i),
+                                 self.buffer[i][start:end]])
+
+            # Problem sending?  If so, abort this transaction
+            if still_ok == 0:
+                self.clear_one_slot(i)
+
+            # Update pointer to location
+            self.buff_start[i] = end
+
+        return still_ok
+
+#
+# ----------------------------------------------------------------------
+#
+
+    def __server_send_next_buffer_block(self, trans_id):
+        still_ok = 1
+
+        if (trans_id < 1) or (trans_id >= MAX_TRANSACTIONS):
+            still_ok = 0
+            self.server_send_err_response()
+
+        # Already at the end?  Then just send an empty last data packet
+        elif self.buffer[trans_id] is None:
+            still_ok = self.send_packet(b"l" + self.one_byte_struct.pack(trans_id))
+
+        # More data to send?
+        else:
+            if isinstance(self.buffer[trans_id], io.BufferedReader):
+                still_ok = self.__server_send_next_from_file(trans_id)
+
+            else:
+                still_ok = self.__send_next_buff_section(trans_id)
+
+        return still_ok
+
+    #
+    #   Send up to "count" packets of a transaction back-to-back
+    #   (used when the client granted credits for streaming)
+    #
+    def __server_send_burst(self, trans_id, count):
+        still_ok = 1
+        done = False
+        sent = 0
+
+        # (two tagged "W"s for the same slot must not mix their packets)
+        with self.slot_locks[trans_id % MAX_TRANSACTIONS]:
+            while (not done) and (sent < count):
+                still_ok = self.__server_send_next_buffer_block(trans_id)
+                sent += 1
+
+                # Stop on errors and after the last packet (which frees
+                #  the slot)
+                done = (not still_ok) or (self.buffer[trans_id] is None)
+
+        return still_ok
+
+    def server_get_cmd_full_path_or_id(self):
+        path = b""
+        still_ok = 1
+
+        data = self.receive_packet()
+
+        # Nothing arrived before the timeout
+        if data is None:
+            return (None, None)
+
+        while (still_ok != 0) and (data[0] == b"P") and \
+               (len(path) < MAX_FILE_PATHLEN):
+
+            path = path + data[1:]
+
+            # Indicate ready for next packet
+            still_ok = self.send_packet(b"c")
 
-            elif len(p) > 1:
-                real_p = self.add_slash(p[0])
+            if still_ok:
+                data = self.receive_packet()
 
-                for alias_p in p[1:]:
-                    alias_p = self.add_slash(alias_p)
+        cmd = chr(data[0])
 
-                    self.add_prefix_entry(real_p, alias_p)
-                    self.print_debug(4, "Added GOOD_PREFIX", real_p, alias_p)
+        if (cmd == "C") or (cmd == "Q"):
+            path = data[1]            # Not actually a path, but an "ID"
 
-        elif isinstance(p, str):
-            real_p = self.add_slash(p)
-            self.good_prefixes.append([real_p, real_p])
-            self.print_debug(4, "Added GOOD_PREFIX", real_p)
+        elif cmd == "W":
+            path = bytes(data[1:3])   # Transaction ID + number of credits
 
-        else:
-            print("Invalid path given to add_good_prefix",
-                  p, "ignoring", file=sys.stderr)
+        elif (cmd == "U") or (cmd == "I"):
+            path = bytes(data[1:])    # Transaction/tag ID + data
 
+        elif cmd in CMD_ARG_SIZES:
+            # Keep the fixed arguments in front of the (prefixed) path
+            arg_end = 1 + CMD_ARG_SIZES[cmd]
+            path = bytes(data[1:arg_end]) + path + data[arg_end:]
 
-#
-# ----------------------------------------------------------------------
-#
+        else:
+            path = path + data[1:]
 
-    # Convert any aliases into real paths
+        if (not isinstance(path, int)) and (cmd != "U") and \
+                (cmd != "I") and (len(path) >= MAX_FILE_PATHLEN):
 
+            print("Too long of a path given for cmd",
+                  cmd, path, file=sys.stderr)
+            still_ok = 0
 
-    def path_convert_aliases(self, p):
+        if still_ok:
+            return (cmd, path)
 
-        slash_p = self.add_slash(p)
+        else:
+            self.server_send_err_response()
+            return (None, None)
 
-        for (real_p, alias_p) in self.good_prefixes:
 
-            if p.startswith(alias_p):
-                p = p.replace(alias_p, real_p, 1)
-            elif p == alias_p:
-                p = real_p
-            elif slash_p == alias_p:
-                p = real_p[:-1]
+    def __server_handle_list_dir(self, realpath, algo=None):
+        """Handle the "ls" requests that point to a directory"""
 
-        return p
+        #
+        # For a directory, provide a list of files in that directory
+        #
+        buff = bytearray(0)
 
-    def path_is_good(self, p):
-        is_good = False
+        still_ok = 1
 
-        # Unalias the path
-        p = self.path_convert_aliases(p)
+        try:
+            files = os.listdir(realpath)
+        except Exception as my_except:
+            still_ok = 0
 
-        # Convert to an absolute path
-        p = os.path.realpath(p)
+        if still_ok:
+            for item in os.scandir(realpath):
 
-        for (one_prefix, alias_p) in self.good_prefixes:
+                link_ok = True
 
-            # Allow for access to the read directory itself too
-            #  (the stored path ends with "/", so ignore that ending)
-            if p.startswith(one_prefix) or (p == one_prefix[:-1]):
-                is_good = True
+                if item.is_symlink():
+                    destlink = self.readAndConvertLink(item.path, realpath)
+                    (link_ok, fullname2) = self.path_is_good(destlink)
 
-        # Disallow non files and directories
-        if (not os.path.isfile(p)) and (not os.path.isdir(p)):
-            is_good = False
+                #
+                #   Don't include symlinks that lead out of the sandboxed areas
+                #
 
-        # Extra check for symlinks that go out of a good section
-        # if (is_good) and (os.path.islink(p)):
-        #    (is_good, p2) = self.path_is_good(os.readlink(p))
+                if link_ok:
+                    #
+                    #   Don't show things other than files and/or directories
+                    #
+                    if item.is_dir() or item.is_file():
 
-        return (is_good, p)
-#
-# ----------------------------------------------------------------------
-#
+                        # Seperate with NULs
+                        if buff != b"":
+                            buff.append(0)
 
-    def clear_one_slot(self, i):
-        # If this is a file handle, then close it first
-        if isinstance(self.buffer[i], io.BufferedReader):
-            self.buffer[i].close()
+                        buff += item.name
 
-        self.buffer[i] = None
-        self.init_time[i] = 0
-        self.buff_start[i] = 0
-        self.buff_len[i] = 0
+                        # Cache the results for later stat() requests
+                        self.stat_cache[item.path] = (self.curr_time, item.stat())
 
-    def purge_old_buffers(self, purge_time=240):
-        too_old = int(time.time() - purge_time)
+            self.__server_send_list_response(buff, algo)
 
-        for i in range(0, MAX_TRANSACTIONS):
-            # Delete transactions older than the purge time
-            if self.init_time[i] < too_old:
-                self.clear_one_slot(i)
+        return still_ok
 
-    def find_free_slot_h(self):
-        start = random.randint(1, MAX_TRANSACTIONS - 1)
-        last = (start - 1) % MAX_TRANSACTIONS
+#
+#----------------------------------------------------------------------
+#
 
-        # Skip the zero slot
-        if last == 0:
-            last = 1
+    #
+    #   Send a listing, compressed with "algo" if it is not None
+    #   (for "Y" requests)
+    #
+    def __server_send_list_response(self, data, algo):
+        if algo is not None:
+            # Not worth it if it fits into a single packet anyway
+            if len(data) + 3 <= self.raw_port.max_packet:
+                algo = usb_compress.COMP_NONE
 
-        i = start
-        while (self.buffer[i] is not None) and (i != last):
-            i = i + 1
-            i = i % MAX_TRANSACTIONS
+            data = usb_compress.compress_buffer(data, algo,
+                                                self.compress_level)
 
-            # Skip slot 0
-            if i == 0:
-                i = 1
+        return self.__server_send_data_response(data)
 
-        # Did we run out of buffers?  if so, then return -1 as an error
-        if self.buffer[i] is not None:
-            i = -1
+    #
+    #   Pack one entry of an "A" listing
+    #     <len:16bit><name><stat record><len:16bit><link>
+    #
+    def __server_pack_ls_stat_entry(self, name, stat_res, is_symlink, link):
+        flags = stat.S_ISDIR(stat_res.st_mode)
 
-        return i
+        if stat.S_ISREG(stat_res.st_mode):
+            flags = flags | 0x02
 
-    #  Find a free slot, but try to purge if necessary
-    def find_free_slot(self):
-        free_slot = self.find_free_slot_h()
+        if is_symlink:
+            flags = flags | 0x80
 
-        if free_slot < 0:
-            self.purge_old_buffers()
-            free_slot = self.find_free_slot_h()
+        return self.two_byte_struct.pack(len(name)) + name + \
+               self.stat_long_struct.pack(flags,
+                                          stat.S_IMODE(stat_res.st_mode),
+                                          stat_res.st_size,
+                                          int(stat_res.st_mtime),
+                                          int(stat_res.st_ctime)) + \
+               self.two_byte_struct.pack(len(link)) + link
 
-        return free_slot
+    def __server_handle_list_stat_dir(self, realpath, algo=None):
+        """Handle the "ls + stat" requests that point to a directory"""
 
-    #
-    # ----------------------------------------------------------------------
-    #
+        buff = bytearray(0)
 
-    def server_send_one_packet(self, response, trans_id=0, data=b""):
         still_ok = 1
 
-        # Double check to see if the resulting packet would be too big
-        if len(data) + 2 > self.raw_port.max_packet:
+        try:
+            all_items = list(os.scandir(realpath))
+        except Exception as my_except:
             still_ok = 0
 
-        else:
-            still_ok = self.send_packet(response +
-                                 self.one_byte_struct.pack(trans_id) +
-                                 data)
+        if still_ok:
+            for item in all_items:
+                link = b""
+                link_ok = True
 
-        return still_ok
+                if item.is_symlink():
+                    link = self.server_symlink_dest(item.path)
+                    link_ok = link is not None
 
-    def server_send_err_response(self):
-        return self.server_send_one_packet(b"z")
+                #
+                #   Same rules as "L" - only files and directories, and
+                #   no symlinks that lead out of the sandboxed areas
+                #
+                if link_ok and (item.is_dir() or item.is_file()):
+                    try:
+                        stat_res = item.stat()
 
-    def __server_send_data_response(self, data=b""):
-        still_ok = 1
+                    except Exception as my_except:
+                        stat_res = None
 
-        response = b"l"      # default=Last packet
-        trans_id = 0         # default to no transaction (since single packet)
+                    if stat_res is not None:
+                        # Cache the results for later stat() requests
+                        self.stat_cache[item.path] = (self.curr_time,
+                                                      stat_res)
 
-        whole_len = len(data)
-        end = whole_len
+                        buff += self.__server_pack_ls_stat_entry(item.name,
+                                        stat_res, item.is_symlink(), link)
 
-        # Does the data (+ 2 byte header) NOT fit into a single packet?
-        if whole_len + 3 > self.raw_port.max_packet:
+            self.__server_send_list_response(buff, algo)
 
-            end = self.raw_port.max_packet - 2
-            my_slot = self.find_free_slot()
+        return still_ok
 
-            # Valid slot?
-            if my_slot != -1:
-                self.buffer[my_slot] = data[end:]
+    def server_handle_list_stat_cmd(self, path, algo=None):
+        (still_ok, realpath) = self.path_is_good(path)
 
-                # Record when created
-                self.init_time[my_slot] = int(time.time())
+        if still_ok:
+            if os.path.isfile(realpath):
+                # Single file?  Send one entry without a name
+                initialpath = self.path_convert_aliases(path)
+                link = b""
 
-                # At the beginning of the buffer
-                self.buff_start[my_slot] = 0
+                if os.path.islink(initialpath):
+                    link = self.server_symlink_dest(initialpath)
 
-                # What (how much) is left to buffer
-                self.buff_len[my_slot] = whole_len - end
+                # (not from the stat cache - like the entries of a
+                #  directory, e.g. for checking a copy of the file)
+                try:
+                    stat_res = os.stat(realpath)
+                    self.stat_cache[realpath] = (self.curr_time, stat_res)
 
-                response = b"d"
+                except OSError as my_except:
+                    stat_res = None
 
-                # Convert to 1..MAX_TRANSACTIONS (vs. 0..MAX_TRANSACTIONS-1)
-                trans_id = my_slot
+                if (stat_res is None) or (link is None):
+                    still_ok = 0
+
+                else:
+                    self.__server_send_list_response(
+                        self.__server_pack_ls_stat_entry(b"", stat_res,
+                                        os.path.islink(initialpath), link),
+                        algo)
+
+            elif os.path.isdir(realpath):
+                still_ok = self.__server_handle_list_stat_dir(realpath, algo)
 
             else:
                 still_ok = 0
-                self.server_send_err_response()
 
-        # Check to see if it still possible to send the packet
-        if still_ok != 0:
-            still_ok = self.server_send_one_packet(response, trans_id, data[:end])
+        if not still_ok:
+            self.server_send_err_response()
 
         return still_ok
 
-    def __server_send_next_from_file(self, i):
-        still_ok = 1
+#
+#----------------------------------------------------------------------
+#
 
-        if self.buffer[i] is None:
-            still_ok = self.send_packet(b"l" + i.to_byte(1, 'little'))
+    def server_handle_list_cmd(self, path, algo=None):
+        (still_ok, realpath) = self.path_is_good(path)
 
-        else:
-            try:
-                num_bytes = self.buffer[i].readinto(self.packet_mv[2:])
+        if still_ok:
+            if os.path.isfile(realpath):
+                # Single file?  Just send back TWO NULs
 
-            except Exception as my_except:
-                still_ok = 0
+                self.__server_send_list_response(b"\0\0", algo)
 
-            if still_ok:
-                # If we didn't use all of the buffer, then we are at the end
+            elif os.path.isdir(realpath):
+                still_ok = self.__server_handle_list_dir(realpath, algo)
 
-                if num_bytes < self.raw_port.max_packet - 2:
-                    self.packet_buffer[0] = 108      # b"l"
-                else:
-                    self.packet_buffer[0] = 100      # b"d"
+            else:
+                # Don't admit to having anything other than
+                #   files and directories
 
-                self.packet_buffer[1] = i
-                still_ok = self.send_packet(self.packet_mv[:num_bytes + 2])
+                still_ok = 0
 
-                # Last packet?  If so, then clear after send
-                if self.packet_buffer[0] == 108:
-                    self.clear_one_slot(i)
+        if not still_ok:
+            self.server_send_err_response()
 
         return still_ok
 
-    def server_send_data_from_file(self, pathname):
-        still_ok = 1
-
-        (is_good, realpath) = self.path_is_good(pathname)
+#
+# ----------------------------------------------------------------------
+#
 
-        # Reserve an empty buffer slot
-        my_slot = self.find_free_slot()
+    def server_handle_get_file(self, path, window=1, offset=0, length=-1):
+        (is_good, realpath) = self.path_is_good(path)
 
-        if is_good and os.path.isfile(realpath) and (my_slot != -1):
-            try:
-                f = open(pathname, "rb")
+        # Only handle files (nothting else)
+        if is_good and os.path.isfile(realpath):
+            still_ok = self.server_send_data_from_file(realpath, window,
+                                                       offset, length)
+        else:
+            self.server_send_err_response()
+            still_ok = 0
 
-            except Exception as my_except:
-                still_ok = 0
+        return still_ok
 
-            if still_ok:
-                self.buffer[my_slot] = f
-                self.init_time[my_slot] = int(time.time())
+    # F<window><path> - a "G" that starts with "window" packets in flight
+    def server_handle_stream_file(self, data):
+        window = max(data[0], 1)
 
-                # Send the first segment of the file
-                self.__server_send_next_from_file(my_slot)
-        else:
-            still_ok = 0
+        return self.server_handle_get_file(data[1:], window)
 
-        if still_ok == 0:
+    # R<window><offset><length><path> - an "F" for part of a file
+    #   (a length of 0 means up to the end of the file)
+    def server_handle_range_file(self, data):
+        if len(data) < 1 + self.range_struct.size:
             self.server_send_err_response()
+            still_ok = 0
 
-        return still_ok
+        else:
+            window = max(data[0], 1)
+            (offset, length) = self.range_struct.unpack_from(data, 1)
 
+            if length == 0:
+                length = -1
 
-#
-# ----------------------------------------------------------------------
-#
+            still_ok = self.server_handle_get_file(
+                                data[1 + self.range_struct.size:],
+                                window, offset, length)
 
+        return still_ok
 
-    def __send_next_buff_section(self, i):
+    # X<window><algos><path> - an "F" that sends a compressed stream
+    #   (algos = bitmask of the compression types the client can decode)
+    #
+    # V<window><algos><path> - the same, but the digest of the file is
+    #   sent after it (inside of the compressed stream)
+    def server_handle_compressed_file(self, data, with_digest=False):
+        still_ok = 0
 
-        start = self.buff_start[i]
-        remain = self.buff_len[i] - start
+        def wrapper(f):
+            if with_digest:
+                f = io.BufferedReader(usb_digest.DigestReader(f))
 
-        if remain + 2 <= self.raw_port.max_packet:
-            end = start + remain
+            return self.server_compress_file(f, data[1])
 
-            still_ok = self.send_packet(b"l" +
-                                 self.one_byte_struct.pack(i) +
-                                 self.buffer[i][start:end])
+        if len(data) >= 2:
+            window = max(data[0], 1)
+            (is_good, realpath) = self.path_is_good(data[2:])
 
-            self.clear_one_slot(i)
+            if is_good and os.path.isfile(realpath):
+                still_ok = self.server_send_data_from_file(realpath, window,
+                                                           wrapper=wrapper)
+            else:
+                self.server_send_err_response()
 
         else:
-            end = start + self.raw_port.max_packet - 2
+            self.server_send_err_response()
 
-            still_ok = self.send_packet(b"d" +
-                                 self.one_byte_struct.pack(i) +
-                                 self.buffer[i][start:end])
+        return still_ok
 
-            # Problem sending?  If so, abort this transaction
-            if still_ok == 0:
-                self.clear_one_slot(i)
+    #
+    # E<window><algos><flags><max_depth><path> - a manifest of a whole
+    #   directory tree (see usb_manifest), compressed like "X"
+    #
+    def server_handle_manifest_cmd(self, data):
+        still_ok = 0
 
-            # Update pointer to location
-            self.buff_start[i] = end
+        if len(data) >= 4:
+            window = max(data[0], 1)
+            get_digest = None
 
-        return still_ok
+            if data[2] & usb_manifest.MANIFEST_DIGESTS:
+                get_digest = self.server_cached_digest
 
-#
-# ----------------------------------------------------------------------
-#
+            (is_good, realpath) = self.path_is_good(data[4:])
 
-    def __server_send_next_buffer_block(self, trans_id):
-        still_ok = 1
+            if is_good and os.path.isdir(realpath):
+                f = io.BufferedReader(usb_manifest.ManifestReader(realpath,
+                                data[3], self.server_symlink_dest, get_digest))
 
-        if (trans_id < 1) or (trans_id > MAX_TRANSACTIONS):
-            still_ok = 0
+                still_ok = self.server_send_data_from_reader(
+                                self.server_compress_file(f, data[1]), window)
+            else:
+                self.server_send_err_response()
+
+        else:
             self.server_send_err_response()
 
-        # Already at the end?  Then just send an empty last data packet
-        elif self.buffer[trans_id] is None:
-            still_ok = self.send_packet(b"l" + self.one_byte_struct.pack(trans_id))
+        return still_ok
 
-        # More data to send?
-        else:
-            if isinstance(self.buffer[trans_id], io.BufferedReader):
-                still_ok = self.__server_send_next_from_file(trans_id)
+    #
+    # J<algos><journal_id:64bit><generation:64bit><path> - the changes
+    #   under a directory since a generation (compressed like "Y")
+    #
+    #   Returns <journal_id><generation><status> and, if status is 0, the
+    #   changes (see usb_journal).  A status of 1 means the client has to
+    #   do a full resync.
+    #
+    def server_handle_changes_cmd(self, data):
+        still_ok = 0
 
-            else:
-                still_ok = self.__send_next_buff_section(trans_id)
+        if (self.journal is not None) and \
+                (len(data) > 1 + usb_journal.id_gen_struct.size):
+            algo = usb_compress.choose_algo(self.compress_algos, data[0])
+            (journal_id, generation) = \
+                    usb_journal.id_gen_struct.unpack_from(data, 1)
 
-        return still_ok
+            (is_good, realpath) = self.path_is_good(
+                                    data[1 + usb_journal.id_gen_struct.size:])
 
-    def server_get_cmd_full_path_or_id(self):
-        path = b""
-        still_ok = 1
+            if is_good and os.path.isdir(realpath):
+                still_ok = 1
 
-        data = self.receive_packet()
+                (journal_id, generation, changes) = \
+                        self.journal.changes_since(journal_id, generation,
+                                                   self.add_slash(realpath))
 
-        while (still_ok != 0) and (data[0] == b"P") and \
-               (len(path) < MAX_FILE_PATHLEN):
+                buff = usb_journal.id_gen_struct.pack(journal_id, generation)
 
-            path = path + data[1:]
+                if changes is None:
+                    buff += b"\x01"
+                else:
+                    buff += b"\x00" + usb_journal.pack_changes(changes)
 
-            # Indicate ready for next packet
-            still_ok = self.send_packet(b"c")
+                self.__server_send_list_response(buff, algo)
 
-            if still_ok:
-                data = self.receive_packet()
+        if not still_ok:
+            self.server_send_err_response()
 
-        cmd = chr(data[0])
+        return still_ok
 
-        if (cmd == "C") or (cmd == "Q"):
-            path = data[1]            # Not actually a path, but an "ID"
-        else:
-            path = path + data[1:]
+    # Y<algos><cmd><path> - a compressed "L" or "A" listing
+    def server_handle_compressed_list(self, data):
+        still_ok = 0
 
-            if len(path) >= MAX_FILE_PATHLEN:
+        if len(data) >= 2:
+            algo = usb_compress.choose_algo(self.compress_algos, data[0])
+            cmd = chr(data[1])
 
-                print("Too long of a path given for cmd",
-                      cmd, path, file=sys.stderr)
-                still_ok = 0
+            if cmd == "L":
+                still_ok = self.server_handle_list_cmd(data[2:], algo)
 
-        if still_ok:
-            return (cmd, path)
+            elif cmd == "A":
+                still_ok = self.server_handle_list_stat_cmd(data[2:], algo)
+
+            else:
+                self.server_send_err_response()
 
         else:
             self.server_send_err_response()
-            return (None, None)
 
+        return still_ok
 
-    def __server_handle_list_dir(self, realpath):
-        """Handle the "ls" requests that point to a directory"""
-
-        #
-        # For a directory, provide a list of files in that directory
-        #
-        buff = bytearray(0)
-
+    #
+    #   U<trans-id><data> - upload data into a transaction slot
+    #       (a trans-id of 0 starts a new upload, and the slot used is
+    #       returned.  The upload is used by a later command, e.g. "D")
+    #
+    def server_handle_upload_cmd(self, data):
         still_ok = 1
 
-        try:
-            files = os.listdir(realpath)
-        except Exception as my_except:
+        if len(data) < 1:
             still_ok = 0
 
-        if still_ok:
-            for item in os.scandir(realpath):
+        elif data[0] == 0:
+            my_slot = self.find_free_slot()
 
-                link_ok = True
+            if my_slot == -1:
+                still_ok = 0
 
-                if item.is_symlink():
-                    destlink = self.readAndConvertLink(item.path, realpath)
-                    (link_ok, fullname2) = self.path_is_good(destlink)
+            else:
+                self.buffer[my_slot] = UploadBuffer(data[1:])
+                self.init_time[my_slot] = int(time.time())
 
-                #
-                #   Don't include symlinks that lead out of the sandboxed areas
-                #
+                self.__server_send_data_response(
+                        self.one_byte_struct.pack(my_slot))
 
-                if link_ok:
-                    #
-                    #   Don't show things other than files and/or directories
-                    #
-                    if item.is_dir() or item.is_file():
+        else:
+            upload = None
 
-                        # Seperate with NULs
-                        if buff != b"":
-                            buff.append(0)
+            if data[0] < MAX_TRANSACTIONS:
+                upload = self.buffer[data[0]]
 
-                        buff += item.name
+            if (not isinstance(upload, UploadBuffer)) or \
+                    (len(upload) + len(data) > usb_delta.MAX_SIGNATURE_SIZE):
+                still_ok = 0
 
-                        # Cache the results for later stat() requests
-                        self.stat_cache[item.path] = (self.curr_time, item.stat())
+            else:
+                upload += data[1:]
+                self.init_time[data[0]] = int(time.time())
 
-            self.__server_send_data_response(buff)
+                self.__server_send_data_response()
+
+        if not still_ok:
+            self.server_send_err_response()
 
         return still_ok
 
-#
-#----------------------------------------------------------------------
-#
+    # Take (and free up) the data uploaded into a slot, None if not valid
+    def server_take_upload(self, trans_id):
+        upload = None
 
-    def server_handle_list_cmd(self, path):
-        (still_ok, realpath) = self.path_is_good(path)
+        if (trans_id >= 1) and (trans_id < MAX_TRANSACTIONS) and \
+                isinstance(self.buffer[trans_id], UploadBuffer):
+            upload = self.buffer[trans_id]
+            self.clear_one_slot(trans_id)
 
-        if still_ok:
-            if os.path.isfile(realpath):
-                # Single file?  Just send back TWO NULs
+        return upload
 
-                self.__server_send_data_response(b"\0\0")
+    #
+    #   D<window><trans-id><path> - an "F" that sends the changes to the
+    #   file relative to the block signatures uploaded into <trans-id>
+    #
+    def server_handle_delta_cmd(self, data):
+        still_ok = 0
+        signatures = None
 
-            elif os.path.isdir(realpath):
-                still_ok = self.__server_handle_list_dir(realpath)
+        if len(data) >= 2:
+            window = max(data[0], 1)
+            upload = self.server_take_upload(data[1])
 
-            else:
-                # Don't admit to having anything other than
-                #   files and directories
+            if upload is not None:
+                signatures = usb_delta.parse_signatures(upload)
 
-                still_ok = 0
+        if signatures is not None:
+            (is_good, realpath) = self.path_is_good(data[2:])
 
-        if not still_ok:
+            if is_good and os.path.isfile(realpath):
+                still_ok = self.server_send_data_from_file(realpath, window,
+                    wrapper=lambda f: io.BufferedReader(
+                                        usb_delta.DeltaReader(f, signatures)))
+            else:
+                self.server_send_err_response()
+
+        else:
             self.server_send_err_response()
 
         return still_ok
 
-#
-# ----------------------------------------------------------------------
-#
+    # W<trans-id><credits> - send up to "credits" more packets
+    def server_handle_window_cmd(self, data):
+        still_ok = 1
 
-    def server_handle_get_file(self, path):
-        (is_good, realpath) = self.path_is_good(path)
+        trans_id = data[0]
+        credits = max(data[1], 1)
 
-        # Only handle files (nothting else)
-        if is_good and os.path.isfile(realpath):
-            still_ok = self.server_send_data_from_file(realpath)
-        else:
-            self.server_send_err_response()
+        # A client may grant credits just before it sees the last packet,
+        #  so silently ignore windows for finished transactions
+        if (trans_id < 1) or (trans_id >= MAX_TRANSACTIONS) or \
+                (self.buffer[trans_id] is None):
+            self.print_debug(4, "Ignoring window for finished transaction",
+                             trans_id)
             still_ok = 0
 
+        else:
+            still_ok = self.__server_send_burst(trans_id, credits)
+
         return still_ok
 #
 # ----------------------------------------------------------------------
@@ -1242,6 +2976,24 @@ class Server(USBComm):
 
         return still_ok
 
+    #
+    #   Return the destination of a symlink, relative to the directory
+    #   that holds the link (or None if it leads out of the good paths)
+    #
+    def server_symlink_dest(self, linkpath):
+        result = None
+
+        curr_dir = os.path.dirname(linkpath)
+        destpath = self.readAndConvertLink(linkpath, curr_dir)
+
+        # Verify that the destination is also a good path
+        (is_also_good, realdestpath) = self.path_is_good(destpath)
+
+        if is_also_good:
+            result = os.path.relpath(realdestpath, os.path.realpath(curr_dir))
+
+        return result
+
     def server_handle_symlink_cmd(self, path):
         unaliased_path = self.path_convert_aliases(path)
         (is_good, realpath) = self.path_is_good(path)
@@ -1252,22 +3004,9 @@ class Server(USBComm):
             result = b""
 
             if os.path.islink(unaliased_path):
-                curr_dir = os.path.dirname(unaliased_path)
-                destpath = self.readAndConvertLink(unaliased_path, curr_dir)
-
-                # Verify that the destination is also a good path
-                (is_also_good, realdestpath) = self.path_is_good(destpath)
-
-                if is_also_good:
-                    if os.path.isdir(realpath):
-                        base = realpath
-                    else:
-                        base = os.path.dirname(realpath)
-
-                    relpath = os.path.relpath(realdestpath, base)
+                result = self.server_symlink_dest(unaliased_path)
 
-                    result = relpath
-                else:
+                if result is None:
                     self.print_debug(4, "Destination of symlink",
                                      realpath, "is not in a good directory")
                     still_ok = 0
@@ -1293,7 +3032,7 @@ class Server(USBComm):
 
         # Only handle files (nothing else)
         if is_good and os.path.isfile(realpath):
-            result = self.compute_hash(realpath)
+            result = self.server_hash_file(realpath)
 
         if result is not None:
             still_ok = self.__server_send_data_response(result.encode('latin1'))
@@ -1303,6 +3042,192 @@ class Server(USBComm):
             still_ok = 0
 
         return still_ok
+
+    # T<leaf_size:32bit><path> - the SHA-512 of each piece of a file
+    def server_handle_tree_hash(self, data):
+        result = None
+
+        if len(data) > self.leaf_size_struct.size:
+            (leaf_size,) = self.leaf_size_struct.unpack_from(data, 0)
+            leaf_size = usb_treehash.clamp_leaf_size(leaf_size)
+
+            (is_good, realpath) = self.path_is_good(
+                                    data[self.leaf_size_struct.size:])
+
+            # Only handle files (nothing else)
+            if is_good and os.path.isfile(realpath):
+                result = self.server_tree_hash_file(realpath, leaf_size)
+
+        if result is not None:
+            still_ok = self.__server_send_data_response(
+                                    usb_treehash.pack_tree(result))
+
+        else:
+            self.server_send_err_response()
+            still_ok = 0
+
+        return still_ok
+
+    #
+    #   I<tag:8><request> - a request (from a relay) that is handled by
+    #   the thread of its tag, which sends every response packet back as
+    #   i<tag:8><packet> (see usb_pipeline)
+    #
+    def server_handle_tagged_cmd(self, data):
+        still_ok = 1
+
+        if (not (self.features & FEATURE_PIPELINE)) or (len(data) < 2) or \
+                (data[0] >= usb_pipeline.MAX_TAGS):
+            still_ok = 0
+
+        else:
+            port = self.tag_ports.get(data[0])
+
+            if port is None:
+                port = self.__start_tag_thread(data[0])
+
+            port.packets.put(data[1:])
+
+        if not still_ok:
+            self.server_send_err_response()
+
+        return still_ok
+
+    #
+    #   A Server on another port, which shares the slots and settings of
+    #   this one (and cannot handle tagged requests itself)
+    #
+    def __server_clone(self, port):
+        clone = Server(port, self.timeout)
+
+        clone.buffer = self.buffer
+        clone.init_time = self.init_time
+        clone.buff_start = self.buff_start
+        clone.buff_len = self.buff_len
+        clone.good_prefixes = self.good_prefixes
+        clone.alias_trie = self.alias_trie
+        clone.good_trie = self.good_trie
+        clone.path_cache = self.path_cache
+
+        clone.send_lock = self.send_lock
+        clone.slot_lock = self.slot_lock
+        clone.slot_locks = self.slot_locks
+
+        clone.features = self.features & ~FEATURE_PIPELINE
+        clone.compress_algos = self.compress_algos
+        clone.compress_level = self.compress_level
+        clone.hash_cache = self.hash_cache
+        clone.journal = self.journal
+        clone.job_pool = self.job_pool
+        clone.read_ahead = self.read_ahead
+        clone.hash_workers = self.hash_workers
+        clone.debug = self.debug
+
+        return clone
+
+    # A Server (and thread) for one tag
+    def __start_tag_thread(self, tag):
+        port = usb_pipeline.TaggedPort(self.raw_port, self.send_lock,
+                                       usb_pipeline.RESP_TAGGED, tag)
+
+        tag_server = self.__server_clone(port)
+
+        self.tag_ports[tag] = port
+
+        tag_thread = threading.Thread(target=tag_server.server_tag_loop)
+        tag_thread.daemon = True        # Die with the main thread
+        tag_thread.start()
+
+        return port
+
+    #
+    #   B<request> - handle a slow request (see JOB_CMDS) in the job pool.
+    #   If it is done quickly, it is answered as usual, otherwise with
+    #   p<job-id:8> and the answer is asked for with "O" (see usb_jobs)
+    #
+    def server_handle_background_cmd(self, data):
+        still_ok = 1
+
+        if (not (self.features & FEATURE_JOBS)) or (len(data) < 1) or \
+                (chr(data[0]) not in JOB_CMDS):
+            still_ok = 0
+
+        else:
+            port = usb_jobs.CapturePort(self.raw_port.max_packet, data)
+            job_id = self.job_pool.start(lambda: self.__run_job(port))
+
+            # All job ids in use?  Then just handle it here
+            if job_id is None:
+                still_ok = self.__send_job_result(self.__run_job(port))
+
+            elif self.job_pool.wait(job_id, usb_jobs.JOB_GRACE):
+                (state, packets) = self.job_pool.take(job_id)
+                still_ok = self.__send_job_result(packets)
+
+            else:
+                still_ok = self.send_packet(usb_jobs.RESP_PENDING +
+                                            bytes([job_id]))
+
+        if not still_ok:
+            self.server_send_err_response()
+
+        return still_ok
+
+    # Handle the request of a job, and return what was sent back
+    def __run_job(self, port):
+        job_server = self.__server_clone(port)
+        job_server.features &= ~FEATURE_JOBS
+
+        job_server.server_get_cmd_and_respond()
+
+        # (ends the stat cache thread, if the request started one)
+        job_server.stop_threads = True
+
+        return port.packets
+
+    #
+    #   O<job-id:8> - send the answer of a job if it is done (only once),
+    #   p<job-id:8> if it is not, or an error if there is no such job
+    #
+    def server_handle_poll_cmd(self, data):
+        still_ok = 0
+
+        if (self.job_pool is not None) and (len(data) == 1):
+            (state, packets) = self.job_pool.take(data[0])
+
+            if state == usb_jobs.JOB_RUNNING:
+                still_ok = self.send_packet(usb_jobs.RESP_PENDING + data)
+
+            elif state == usb_jobs.JOB_DONE:
+                still_ok = self.__send_job_result(packets)
+
+        if not still_ok:
+            self.server_send_err_response()
+
+        return still_ok
+
+    def __send_job_result(self, packets):
+        still_ok = (packets is not None) and (len(packets) > 0)
+
+        if still_ok:
+            for one_packet in packets:
+                still_ok = self.send_packet(one_packet)
+
+        return still_ok
+
+    def server_tag_loop(self):
+        while not self.stop_threads:
+            try:
+                self.server_get_cmd_and_respond()
+
+            except Exception as my_except:
+                print("usb_comm::server_tag_loop failed", my_except,
+                      file=sys.stderr)
+                traceback.print_exc()
+
+            # Nothing sent back?  Then say so (the relay is waiting)
+            if not self.raw_port.answered:
+                self.send_packet(b"")
 #
 # ----------------------------------------------------------------------
 #
@@ -1320,14 +3245,42 @@ class Server(USBComm):
 
         (cmd, data) = self.server_get_cmd_full_path_or_id()
 
+        if cmd is not None:
+            self.last_cmd_time = time.time()
+
         if cmd is None:
             pass            # Already handled
 
+        elif cmd == "A":
+            self.print_debug(3, "CMD=A - List Directory with Attributes")
+
+            self.server_handle_list_stat_cmd(data)
+
+        elif cmd == "B":
+            self.print_debug(3, "CMD=B - Background Job")
+
+            self.server_handle_background_cmd(data)
+
         elif cmd == "C":
             self.print_debug(3, "CMD=C - Send Continuation Data")
 
             # Send the next portion of the buffer
-            self.__server_send_next_buffer_block(data)
+            self.__server_send_burst(data, 1)
+
+        elif cmd == "D":
+            self.print_debug(3, "CMD=D - Get File Changes (delta)")
+
+            self.server_handle_delta_cmd(data)
+
+        elif cmd == "E":
+            self.print_debug(3, "CMD=E - Manifest of a Directory Tree")
+
+            self.server_handle_manifest_cmd(data)
+
+        elif cmd == "F":
+            self.print_debug(3, "CMD=F - Get File (streamed)")
+
+            self.server_handle_stream_file(data)
 
         elif cmd == "G":
             self.print_debug(3, "CMD=G - Get File")
@@ -1339,6 +3292,16 @@ class Server(USBComm):
 
             self.server_handle_hash_file(data)
 
+        elif cmd == "I":
+            self.print_debug(3, "CMD=I - Tagged Request")
+
+            self.server_handle_tagged_cmd(data)
+
+        elif cmd == "J":
+            self.print_debug(3, "CMD=J - Changes Since (journal)")
+
+            self.server_handle_changes_cmd(data)
+
         elif cmd == "K":
             self.print_debug(3, "CMD=K - Return SymlinK")
 
@@ -1357,7 +3320,18 @@ class Server(USBComm):
         elif cmd == "N":
             self.print_debug(3, "CMD=N - No Op")
 
-            self.__server_send_data_response()     # Empty data response
+            if data == b"F":
+                # Report the optional features of this server
+                self.__server_send_data_response(
+                        self.features.to_bytes(4, 'little') +
+                        FEATURE_ORIGIN_SERVER)
+            else:
+                self.__server_send_data_response()     # Empty data response
+
+        elif cmd == "O":
+            self.print_debug(3, "CMD=O - Job Answer")
+
+            self.server_handle_poll_cmd(data)
 
         elif cmd == "Q":
             self.print_debug(3, "CMD=Q - SetPriority")
@@ -1366,11 +3340,46 @@ class Server(USBComm):
 
             self.__server_send_data_response()     # Empty data response
 
+        elif cmd == "R":
+            self.print_debug(3, "CMD=R - Get Part of a File")
+
+            self.server_handle_range_file(data)
+
         elif cmd == "S":
             self.print_debug(3, "CMD=S - Stat a File/Directory")
 
             self.server_handle_stat_cmd(data)
 
+        elif cmd == "T":
+            self.print_debug(3, "CMD=T - Tree Hash File")
+
+            self.server_handle_tree_hash(data)
+
+        elif cmd == "U":
+            self.print_debug(3, "CMD=U - Upload Data")
+
+            self.server_handle_upload_cmd(data)
+
+        elif cmd == "V":
+            self.print_debug(3, "CMD=V - Get File (with digest)")
+
+            self.server_handle_compressed_file(data, with_digest=True)
+
+        elif cmd == "W":
+            self.print_debug(3, "CMD=W - Window (more credits)")
+
+            self.server_handle_window_cmd(data)
+
+        elif cmd == "X":
+            self.print_debug(3, "CMD=X - Get File (compressed)")
+
+            self.server_handle_compressed_file(data)
+
+        elif cmd == "Y":
+            self.print_debug(3, "CMD=Y - List Directory (compressed)")
+
+            self.server_handle_compressed_list(data)
+
         elif cmd == "Z":
             self.print_debug(3, "CMD=Z - Reset Buffers")
 
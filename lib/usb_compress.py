@@ -0,0 +1,241 @@
+#
+#   Compression helpers for the "X" (compressed get) and "Y" (compressed
+#   listing) commands
+#
+#   A compressed stream starts with one byte that says which algorithm
+#   the server picked (COMP_NONE if it decided not to compress), followed
+#   by the compressed data.  The algorithm numbers are also used as a
+#   bitmask by the client to say what it can decode.
+#
+
+import collections
+import io
+import lzma
+import math
+import zlib
+
+# Optional - pip install zstandard
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMP_NONE = 0x00
+COMP_ZLIB = 0x01
+COMP_LZMA = 0x02
+COMP_ZSTD = 0x04
+
+COMP_NAMES = {"none": COMP_NONE, "zlib": COMP_ZLIB,
+              "lzma": COMP_LZMA, "zstd": COMP_ZSTD}
+
+DEF_COMPRESS_LEVEL = 3
+
+# How much of a file to read at a time (and to check for entropy)
+COMPRESS_BLOCK = 64 * 1024
+
+# Bits per byte above which data is treated as already compressed
+MAX_ENTROPY = 7.5
+
+
+def supported_algos():
+    algos = COMP_ZLIB | COMP_LZMA
+
+    if zstandard is not None:
+        algos |= COMP_ZSTD
+
+    return algos
+
+
+#
+#   Convert a list of names ("zstd,zlib") into a list of algorithms
+#   (in order of preference), skipping the ones that are not available
+#
+def parse_algo_list(names):
+    algo_list = []
+
+    for name in names.replace(",", " ").split():
+        algo = COMP_NAMES.get(name.lower())
+
+        if algo is None:
+            raise ValueError("Unknown compression type " + name)
+
+        if (algo != COMP_NONE) and (algo & supported_algos()):
+            algo_list.append(algo)
+
+    return algo_list
+
+
+# Pick the first of our (preferred) algorithms that the client can decode
+def choose_algo(algo_list, client_algos):
+    result = COMP_NONE
+
+    for algo in algo_list:
+        if algo & client_algos:
+            result = algo
+            break
+
+    return result
+
+
+#
+#   Estimate if the data is already compressed (or encrypted)
+#   using the Shannon entropy of the bytes
+#
+def looks_compressed(sample):
+    result = False
+    total = len(sample)
+
+    if total >= 1024:
+        entropy = 0.0
+
+        for count in collections.Counter(sample).values():
+            p = count / total
+            entropy -= p * math.log2(p)
+
+        result = entropy > MAX_ENTROPY
+
+    return result
+
+
+class NullCompressor:
+    def compress(self, data):
+        return bytes(data)
+
+    def flush(self):
+        return b""
+
+
+def new_compressor(algo, level=DEF_COMPRESS_LEVEL):
+    if algo == COMP_ZLIB:
+        obj = zlib.compressobj(max(1, min(level, 9)))
+
+    elif algo == COMP_LZMA:
+        obj = lzma.LZMACompressor(preset=max(0, min(level, 9)))
+
+    elif algo == COMP_ZSTD:
+        obj = zstandard.ZstdCompressor(level=level).compressobj()
+
+    else:
+        obj = NullCompressor()
+
+    return obj
+
+
+# Compress a whole (in memory) buffer, with the algorithm byte in front
+def compress_buffer(data, algo, level=DEF_COMPRESS_LEVEL):
+    obj = new_compressor(algo, level)
+
+    return bytes([algo]) + obj.compress(data) + obj.flush()
+
+
+#
+#   A (raw) file object that reads another file and returns the
+#   compressed version of it.  Meant to be wrapped by io.BufferedReader.
+#
+class CompressedReader(io.RawIOBase):
+    def __init__(self, f, algo, level=DEF_COMPRESS_LEVEL, first_block=b""):
+        self.f = f
+        self.obj = new_compressor(algo, level)
+
+        self.pending = bytearray([algo])
+        self.pending += self.obj.compress(first_block)
+        self.at_eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        # Fill up as much as possible (a short read means end of file)
+        while (len(self.pending) < len(b)) and (not self.at_eof):
+            data = self.f.read(COMPRESS_BLOCK)
+
+            if len(data) == 0:
+                self.pending += self.obj.flush()
+                self.at_eof = True
+            else:
+                self.pending += self.obj.compress(data)
+
+        num_bytes = min(len(b), len(self.pending))
+
+        b[:num_bytes] = self.pending[:num_bytes]
+        del self.pending[:num_bytes]
+
+        return num_bytes
+
+    def close(self):
+        if not self.closed:
+            self.f.close()
+
+        super().close()
+
+
+#
+#   Incremental decoder for the client side
+#
+#       feed() returns the data decoded so far (possibly empty)
+#       finish() returns what is left, and sets "complete" if the
+#       whole compressed stream was seen
+#
+class StreamDecoder:
+    def __init__(self):
+        self.algo = None
+        self.obj = None
+        self.complete = False
+
+    def feed(self, data):
+        result = b""
+
+        if self.algo is None:
+            if len(data) > 0:
+                self.algo = data[0]
+
+                if self.algo == COMP_ZLIB:
+                    self.obj = zlib.decompressobj()
+
+                elif self.algo == COMP_LZMA:
+                    self.obj = lzma.LZMADecompressor()
+
+                elif self.algo == COMP_ZSTD:
+                    self.obj = zstandard.ZstdDecompressor().decompressobj()
+
+                elif self.algo != COMP_NONE:
+                    raise ValueError("Unknown compression type " +
+                                     str(self.algo))
+
+                result = self.feed(data[1:])
+
+        elif self.obj is None:
+            result = bytes(data)
+
+        else:
+            result = self.obj.decompress(data)
+
+        return result
+
+    def finish(self):
+        result = b""
+
+        if self.algo == COMP_NONE:
+            self.complete = True
+
+        elif self.algo == COMP_ZLIB:
+            result = self.obj.flush()
+            self.complete = self.obj.eof
+
+        elif self.obj is not None:
+            # (older versions of zstandard do not have "eof")
+            self.complete = getattr(self.obj, "eof", True)
+
+        return result
+
+
+# Decode a whole (in memory) compressed buffer
+def decompress_buffer(data):
+    decoder = StreamDecoder()
+
+    result = decoder.feed(data) + decoder.finish()
+
+    if not decoder.complete:
+        raise ValueError("Incomplete compressed data")
+
+    return result
@@ -0,0 +1,385 @@
+#
+#   Delta transfer (rsync-like) helpers for the "U" (upload) and "D"
+#   (delta get) commands
+#
+#   The client sends the signatures of the blocks of its old copy of a
+#   file.  The server then sends back a list of records that rebuild the
+#   new file from those blocks and literal data:
+#
+#       L<len:32bit><data>              - literal data
+#       B<index:32bit><count:32bit>     - copy "count" blocks of the
+#                                         client's old file
+#       E<sha512:64bytes>               - end (hash of the whole new file)
+#
+#   Signatures are <block_size:32bit><count:32bit> followed by a
+#   <weak:32bit><strong:16bytes> entry for each block of the old file.
+#   The weak checksum is adler32, which can be "rolled" one byte at a
+#   time to find blocks that moved (e.g. data was inserted).  To keep the
+#   cost down (this is pure python) the rolling search is only done over
+#   the RESYNC_BLOCKS blocks after the last match (the block with the
+#   change itself never matches, so this needs to be at least 2).
+#
+
+import hashlib
+import io
+import math
+import struct
+import zlib
+
+DELTA_MIN_BLOCK = 4 * 1024
+DELTA_MAX_BLOCK = 4 * 1024 * 1024
+
+# Largest signature list a server will accept
+MAX_SIGNATURE_SIZE = 64 * 1024 * 1024
+
+# Send literal data once this much is pending
+MAX_LITERAL = 64 * 1024
+
+# Largest piece of an old file read at a time when copying blocks
+COPY_CHUNK = 1024 * 1024
+
+# Number of blocks after a match to search for moved blocks
+RESYNC_BLOCKS = 2
+
+ADLER_MOD = 65521
+
+STRONG_LEN = 16
+
+sig_header_struct = struct.Struct("<LL")
+sig_entry_struct = struct.Struct("<L" + str(STRONG_LEN) + "s")
+literal_struct = struct.Struct("<L")
+blocks_struct = struct.Struct("<LL")
+
+DIGEST_LEN = hashlib.sha512().digest_size
+
+
+def strong_hash(data):
+    return hashlib.blake2b(data, digest_size=STRONG_LEN).digest()
+
+
+# About sqrt(size), so both the signatures and the blocks stay small
+def choose_block_size(size):
+    block_size = DELTA_MIN_BLOCK * math.ceil(math.isqrt(size) /
+                                             DELTA_MIN_BLOCK)
+
+    return max(DELTA_MIN_BLOCK, min(block_size, DELTA_MAX_BLOCK))
+
+
+def compute_signatures(path, block_size):
+    sigs = bytearray(0)
+    count = 0
+
+    with open(path, "rb") as f:
+        block = f.read(block_size)
+
+        while len(block) > 0:
+            sigs += sig_entry_struct.pack(zlib.adler32(block),
+                                          strong_hash(block))
+            count += 1
+
+            block = f.read(block_size)
+
+    return sig_header_struct.pack(block_size, count) + sigs
+
+
+#
+#   Returns (block_size, weak -> [block indexes], strong hashes)
+#   or None if the signatures are not valid
+#
+def parse_signatures(data):
+    result = None
+
+    if len(data) >= sig_header_struct.size:
+        (block_size, count) = sig_header_struct.unpack_from(data, 0)
+
+        if (block_size >= 1) and (block_size <= DELTA_MAX_BLOCK) and \
+                (len(data) == sig_header_struct.size +
+                               count * sig_entry_struct.size):
+            weak_table = {}
+            strong_list = []
+
+            offset = sig_header_struct.size
+
+            for i in range(0, count):
+                (weak, strong) = sig_entry_struct.unpack_from(data, offset)
+                offset += sig_entry_struct.size
+
+                weak_table.setdefault(weak, []).append(i)
+                strong_list.append(strong)
+
+            result = (block_size, weak_table, strong_list)
+
+    return result
+
+
+#
+#   A (raw) file object that reads the new file and returns the delta
+#   records.  Meant to be wrapped by io.BufferedReader.
+#
+class DeltaReader(io.RawIOBase):
+    def __init__(self, f, signatures):
+        (self.block_size, self.weak_table, self.strong_list) = signatures
+
+        self.f = f
+        self.digest = hashlib.sha512()
+
+        self.buf = bytearray(0)         # Unprocessed data from the file
+        self.pos = 0                    #  (and where it starts)
+        self.file_eof = False
+
+        self.literal = bytearray(0)
+        self.run_start = 0
+        self.run_count = 0
+
+        # Look for moved blocks after a match (and at the start)
+        self.resync_left = RESYNC_BLOCKS
+
+        self.pending = bytearray(0)
+        self.at_eof = False
+
+    def readable(self):
+        return True
+
+    def find_block(self, data, weak):
+        result = -1
+
+        for i in self.weak_table.get(weak, []):
+            if strong_hash(data) == self.strong_list[i]:
+                result = i
+                break
+
+        return result
+
+    def flush_literal(self):
+        if len(self.literal) > 0:
+            self.pending += b"L" + literal_struct.pack(len(self.literal))
+            self.pending += self.literal
+            self.literal = bytearray(0)
+
+    def flush_run(self):
+        if self.run_count > 0:
+            self.pending += b"B" + blocks_struct.pack(self.run_start,
+                                                      self.run_count)
+            self.run_count = 0
+
+    def add_block(self, i):
+        self.flush_literal()
+
+        if (self.run_count > 0) and (self.run_start + self.run_count == i):
+            self.run_count += 1
+        else:
+            self.flush_run()
+            self.run_start = i
+            self.run_count = 1
+
+    def add_literal(self, data):
+        self.flush_run()
+        self.literal += data
+
+        if len(self.literal) >= MAX_LITERAL:
+            self.flush_literal()
+
+    # Make sure that "size" bytes are in the buffer (unless at the end)
+    def fill_buffer(self, size):
+        if self.pos > 0:
+            del self.buf[:self.pos]
+            self.pos = 0
+
+        while (len(self.buf) < size) and (not self.file_eof):
+            data = self.f.read(max(size - len(self.buf), COPY_CHUNK))
+
+            if len(data) == 0:
+                self.file_eof = True
+            else:
+                self.digest.update(data)
+                self.buf += data
+
+    #
+    #   Roll the weak checksum over the next block, looking for the
+    #   start of a known block.  Returns the offset or -1.
+    #
+    def rolling_search(self):
+        bs = self.block_size
+        buf = self.buf
+        start = self.pos
+        end = len(buf) - bs           # Last possible start of a block
+
+        weak = zlib.adler32(buf[start:start + bs])
+        a = weak & 0xffff
+        b = weak >> 16
+
+        result = -1
+        k = start
+
+        while (result == -1) and (k < end) and (k < start + bs):
+            out_byte = buf[k]
+            in_byte = buf[k + bs]
+
+            a = (a - out_byte + in_byte) % ADLER_MOD
+            b = (b + a - 1 - bs * out_byte) % ADLER_MOD
+            k += 1
+
+            weak = (b << 16) | a
+
+            if weak in self.weak_table:
+                if self.find_block(buf[k:k + bs], weak) != -1:
+                    result = k - start
+
+        return result
+
+    # Process one block of the new file
+    def next_step(self):
+        bs = self.block_size
+
+        self.fill_buffer(2 * bs)
+        block = self.buf[self.pos:self.pos + bs]
+
+        if len(block) == 0:
+            self.flush_literal()
+            self.flush_run()
+            self.pending += b"E" + self.digest.digest()
+            self.at_eof = True
+
+        else:
+            i = self.find_block(block, zlib.adler32(block))
+
+            if i != -1:
+                self.add_block(i)
+                self.pos += len(block)
+                self.resync_left = RESYNC_BLOCKS
+
+            elif (self.resync_left > 0) and (len(block) == bs):
+                skip = self.rolling_search()
+                self.resync_left -= 1
+
+                # Found a block further on?  Send what is in front of it
+                if skip == -1:
+                    skip = bs
+
+                self.add_literal(self.buf[self.pos:self.pos + skip])
+                self.pos += skip
+
+            else:
+                self.add_literal(block)
+                self.pos += len(block)
+
+    def readinto(self, b):
+        # Fill up as much as possible (a short read means end of file)
+        while (len(self.pending) < len(b)) and (not self.at_eof):
+            self.next_step()
+
+        num_bytes = min(len(b), len(self.pending))
+
+        b[:num_bytes] = self.pending[:num_bytes]
+        del self.pending[:num_bytes]
+
+        return num_bytes
+
+    def close(self):
+        if not self.closed:
+            self.f.close()
+
+        super().close()
+
+
+#
+#   Rebuild a file from the delta records (on the client side)
+#
+#       feed() hands the rebuilt data to "output" as it is decoded
+#       finish() sets "complete" if the end record was seen and the
+#       hash of the rebuilt data matched
+#
+class DeltaDecoder:
+    def __init__(self, basis_f, block_size, output):
+        self.basis_f = basis_f
+        self.block_size = block_size
+        self.output = output
+
+        self.digest = hashlib.sha512()
+        self.buf = bytearray(0)
+        self.literal_left = 0
+        self.ended = False
+        self.complete = False
+
+    def emit(self, data):
+        if len(data) > 0:
+            self.digest.update(data)
+            self.output(data)
+
+    def copy_blocks(self, index, count):
+        self.basis_f.seek(index * self.block_size)
+        left = count * self.block_size
+
+        while left > 0:
+            data = self.basis_f.read(min(left, COPY_CHUNK))
+
+            # The last block of the old file may be a short one
+            #  (anything else that is wrong is caught by the hash check)
+            if len(data) == 0:
+                left = 0
+            else:
+                self.emit(data)
+                left -= len(data)
+
+    def feed(self, data):
+        self.buf += data
+        pos = 0
+        done = False
+
+        while not done:
+            avail = len(self.buf) - pos
+
+            if self.literal_left > 0:
+                num_bytes = min(self.literal_left, avail)
+
+                self.emit(self.buf[pos:pos + num_bytes])
+                self.literal_left -= num_bytes
+                pos += num_bytes
+
+                done = self.literal_left > 0
+
+            elif avail == 0:
+                done = True
+
+            elif self.ended:
+                raise ValueError("Data after the end of a delta")
+
+            elif self.buf[pos] == ord("L"):
+                if avail >= 1 + literal_struct.size:
+                    (self.literal_left,) = literal_struct.unpack_from(
+                                                    self.buf, pos + 1)
+                    pos += 1 + literal_struct.size
+                else:
+                    done = True
+
+            elif self.buf[pos] == ord("B"):
+                if avail >= 1 + blocks_struct.size:
+                    (index, count) = blocks_struct.unpack_from(self.buf,
+                                                               pos + 1)
+                    pos += 1 + blocks_struct.size
+
+                    self.copy_blocks(index, count)
+                else:
+                    done = True
+
+            elif self.buf[pos] == ord("E"):
+                if avail >= 1 + DIGEST_LEN:
+                    self.ended = True
+                    self.complete = (self.digest.digest() ==
+                                     bytes(self.buf[pos + 1:pos + 1 +
+                                                    DIGEST_LEN]))
+                    pos += 1 + DIGEST_LEN
+                else:
+                    done = True
+
+            else:
+                raise ValueError("Unknown delta record " +
+                                 str(self.buf[pos]))
+
+        del self.buf[:pos]
+
+    def finish(self):
+        if (not self.ended) or (len(self.buf) > 0):
+            self.complete = False
+
+        return self.complete
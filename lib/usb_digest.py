@@ -0,0 +1,111 @@
+#
+#   Whole-file digest trailer for the "V" (verified get) command
+#
+#   The server hashes the file as it is read for sending and puts the
+#   SHA-512 of it (DIGEST_LEN bytes) after the last of the data.  The
+#   client hashes what it receives and compares it to the trailer, so
+#   the file does not have to be read (and hashed) a second time on
+#   either side to verify it.
+#
+
+import hashlib
+import io
+import sys
+
+DIGEST_LEN = hashlib.sha512().digest_size
+
+# How much of a file to read at a time
+DIGEST_BLOCK = 64 * 1024
+
+
+#
+#   A (raw) file object that reads another file and adds the digest of
+#   it at the end.  Meant to be wrapped by io.BufferedReader.
+#
+class DigestReader(io.RawIOBase):
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha512()
+
+        self.pending = bytearray(0)
+        self.at_eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        # Fill up as much as possible (a short read means end of file)
+        while (len(self.pending) < len(b)) and (not self.at_eof):
+            data = self.f.read(max(len(b), DIGEST_BLOCK))
+
+            if len(data) == 0:
+                self.pending += self.digest.digest()
+                self.at_eof = True
+            else:
+                self.digest.update(data)
+                self.pending += data
+
+        num_bytes = min(len(b), len(self.pending))
+
+        b[:num_bytes] = self.pending[:num_bytes]
+        del self.pending[:num_bytes]
+
+        return num_bytes
+
+    def close(self):
+        if not self.closed:
+            self.f.close()
+
+        super().close()
+
+
+#
+#   Client side - the same feed()/finish()/"complete" interface as
+#   usb_compress.StreamDecoder, so it fits in the same places.  The data
+#   is passed through "inner" (e.g. a StreamDecoder) first, if given.
+#   The last DIGEST_LEN bytes are held back, since they may be the
+#   trailer.
+#
+class DigestDecoder:
+    def __init__(self, inner=None):
+        self.inner = inner
+        self.digest = hashlib.sha512()
+
+        self.held = bytearray(0)
+        self.complete = False
+
+    def __pass_on(self, data):
+        self.held += data
+
+        num_bytes = max(len(self.held) - DIGEST_LEN, 0)
+        result = bytes(self.held[:num_bytes])
+
+        del self.held[:num_bytes]
+        self.digest.update(result)
+
+        return result
+
+    def feed(self, data):
+        if self.inner is not None:
+            data = self.inner.feed(data)
+
+        return self.__pass_on(data)
+
+    def finish(self):
+        inner_ok = True
+        data = b""
+
+        if self.inner is not None:
+            data = self.inner.finish()
+            inner_ok = self.inner.complete
+
+        result = self.__pass_on(data)
+
+        self.complete = inner_ok and (len(self.held) == DIGEST_LEN) and \
+                        (self.digest.digest() == bytes(self.held))
+
+        if inner_ok and (not self.complete):
+            print("Verify failed: the data received does not match the " +
+                  "digest sent", file=sys.stderr)
+
+        return result
@@ -0,0 +1,214 @@
+#
+#   Weighted fair queue of requests for the relay's USB thread
+#
+#   Every client has its own queues, and the clients take turns (deficit
+#   round robin): on each turn a client may send requests that cost up
+#   to "quantum" times its weight (plus whatever it did not use on its
+#   last turn).  The cost of a request is the number of packets the
+#   server may send back for it, so a client that streams large windows
+#   gets its share of the link and no more.
+#
+#   Small requests (e.g. stat and list) are in an interactive class that
+#   is served before the bulk class.  Any request that has waited more
+#   than "max_wait" seconds is sent next (oldest first), so no client is
+#   ever starved, whatever its weight.
+#
+#   A request that was taken (and counted) can be handed to one of the
+#   threads that take them (put_pinned), which gets it before anything
+#   else, e.g. so that the requests of a transaction go the same way.
+#
+
+import collections
+import queue
+import threading
+import time
+
+CLASS_INTERACTIVE = 0
+CLASS_BULK = 1
+
+DEF_QUANTUM = 8                 # Packets per turn (for a weight of 1)
+DEF_MAX_WAIT = 5.0              # In seconds
+
+# How fast the average wait follows new waits (0-1)
+WAIT_SMOOTHING = 0.1
+
+
+class ClientQueue:
+    def __init__(self, weight):
+        self.weight = weight
+        self.queues = [collections.deque(), collections.deque()]
+        self.deficit = [0.0, 0.0]
+        self.in_turn = [False, False]
+        self.avg_wait = 0.0
+        self.served = 0
+
+
+class FairQueue:
+    def __init__(self, quantum=DEF_QUANTUM, max_wait=DEF_MAX_WAIT):
+        self.quantum = quantum
+        self.max_wait = max_wait
+
+        self.cond = threading.Condition()
+        self.clients = {}
+        self.active = [collections.deque(), collections.deque()]
+        self.num_items = 0
+
+        # Taker -> the requests that were handed to it
+        self.pinned = {}
+
+    #
+    #   Add a request.  "weight" is the share of the client (it replaces
+    #   the weight given with its earlier requests) and "cost" is what
+    #   the request counts for against it.
+    #
+    def put(self, client, weight, req_class, cost, item):
+        with self.cond:
+            cq = self.clients.get(client)
+
+            if cq is None:
+                cq = ClientQueue(weight)
+                self.clients[client] = cq
+
+            cq.weight = weight
+
+            if len(cq.queues[req_class]) == 0:
+                self.active[req_class].append(client)
+
+            cq.queues[req_class].append((time.time(), cost, item))
+            self.num_items += 1
+
+            self.cond.notify()
+
+    # Hand a request to the thread that calls get() with "taker"
+    def put_pinned(self, taker, item):
+        with self.cond:
+            self.pinned.setdefault(taker, collections.deque()).append(item)
+
+            # (the others waiting would not take it)
+            self.cond.notify_all()
+
+    #
+    #   Returns the next request (the ones handed to "taker" first), or
+    #   raises queue.Empty after "timeout"
+    #
+    def get(self, timeout=None, taker=None):
+        with self.cond:
+            if not self.cond.wait_for(lambda: (self.num_items > 0) or
+                                      (len(self.pinned.get(taker, ())) > 0),
+                                      timeout):
+                raise queue.Empty
+
+            if len(self.pinned.get(taker, ())) > 0:
+                result = self.pinned[taker].popleft()
+
+            else:
+                (client, req_class) = self.__oldest_overdue()
+
+                if client is None:
+                    req_class = CLASS_INTERACTIVE
+
+                    if len(self.active[CLASS_INTERACTIVE]) == 0:
+                        req_class = CLASS_BULK
+
+                    client = self.__next_turn(req_class)
+
+                result = self.__take(client, req_class)
+
+        return result
+
+    #
+    #   The (client, class) of the request that has waited the longest,
+    #   if it waited too long (the lock is already held)
+    #
+    def __oldest_overdue(self):
+        result = (None, None)
+        oldest = time.time() - self.max_wait
+
+        for req_class in (CLASS_INTERACTIVE, CLASS_BULK):
+            for client in self.active[req_class]:
+                enqueued = self.clients[client].queues[req_class][0][0]
+
+                if enqueued < oldest:
+                    oldest = enqueued
+                    result = (client, req_class)
+
+        return result
+
+    #
+    #   Deficit round robin - the client whose turn it is (and who has
+    #   enough credit left for its next request)
+    #
+    def __next_turn(self, req_class):
+        active = self.active[req_class]
+        result = None
+
+        while result is None:
+            client = active[0]
+            cq = self.clients[client]
+
+            if not cq.in_turn[req_class]:
+                cq.deficit[req_class] += self.quantum * cq.weight
+                cq.in_turn[req_class] = True
+
+            cost = cq.queues[req_class][0][1]
+
+            if cq.deficit[req_class] >= cost:
+                cq.deficit[req_class] -= cost
+                result = client
+
+            else:
+                cq.in_turn[req_class] = False
+                active.rotate(-1)
+
+        return result
+
+    # Remove the first request of a client (the lock is already held)
+    def __take(self, client, req_class):
+        cq = self.clients[client]
+
+        (enqueued, cost, item) = cq.queues[req_class].popleft()
+        self.num_items -= 1
+
+        wait = time.time() - enqueued
+        cq.avg_wait += (wait - cq.avg_wait) * WAIT_SMOOTHING
+        cq.served += 1
+
+        # Nothing left?  Then it is out of the rotation (and starts over)
+        if len(cq.queues[req_class]) == 0:
+            self.active[req_class].remove(client)
+            cq.deficit[req_class] = 0.0
+            cq.in_turn[req_class] = False
+
+        return item
+
+    # Drop a client (and anything it still has queued)
+    def forget(self, client):
+        with self.cond:
+            cq = self.clients.pop(client, None)
+
+            if cq is not None:
+                for req_class in (CLASS_INTERACTIVE, CLASS_BULK):
+                    if len(cq.queues[req_class]) > 0:
+                        self.num_items -= len(cq.queues[req_class])
+                        self.active[req_class].remove(client)
+
+    #
+    #   Returns (client, queued requests, wait of the oldest one, average
+    #   wait, requests served) for every client, in seconds
+    #
+    def stats(self):
+        result = []
+        now = time.time()
+
+        with self.cond:
+            for (client, cq) in self.clients.items():
+                oldest = 0.0
+
+                for one_queue in cq.queues:
+                    if len(one_queue) > 0:
+                        oldest = max(oldest, now - one_queue[0][0])
+
+                result.append((client, len(cq.queues[0]) + len(cq.queues[1]),
+                               oldest, cq.avg_wait, cq.served))
+
+        return result
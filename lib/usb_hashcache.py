@@ -0,0 +1,231 @@
+#
+#   Persistent cache of file hashes for the server ("H" and "T")
+#
+#   Hashes are kept in a sqlite database, keyed by the device, inode,
+#   size and mtime (in ns) of the file, so any change to a file (or a
+#   new file at the same path) is a cache miss.  The least recently used
+#   entries are removed once there are more than "max_entries".
+#
+#   HashWarmer is an optional thread that hashes files under the
+#   allowed paths ahead of time, but only while the server is idle.
+#
+
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import usb_treehash
+
+DEF_MAX_ENTRIES = 1000000
+
+# Evict down to this fraction of max_entries (so it is not done often)
+EVICT_FRACTION = 0.9
+
+# Seconds without a command before the warmer starts hashing
+DEF_WARMER_IDLE = 30
+
+# Seconds between scans of the allowed paths by the warmer
+WARMER_RESCAN = 15 * 60
+
+# How much of a file the warmer reads at a time (it stops between
+#  these reads if the server gets busy)
+WARMER_CHUNK = 1024 * 1024
+
+KIND_SHA512 = "sha512"
+
+
+# Tree hashes with different leaf sizes are different entries
+def tree_kind(leaf_size):
+    return "tree:" + str(leaf_size)
+
+
+def stat_key(st):
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def file_key(path):
+    result = None
+
+    try:
+        st = os.stat(path)
+
+    except OSError as my_except:
+        st = None
+
+    if st is not None:
+        result = stat_key(st)
+
+    return result
+
+
+class HashCache:
+    def __init__(self, filename, max_entries=DEF_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.num_entries = 0
+
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS hashes (" +
+                            "dev INTEGER, ino INTEGER, size INTEGER, " +
+                            "mtime_ns INTEGER, kind TEXT, digest BLOB, " +
+                            "last_used REAL, " +
+                            "PRIMARY KEY (dev, ino, size, mtime_ns, kind))")
+            self.db.execute("CREATE INDEX IF NOT EXISTS hashes_last_used " +
+                            "ON hashes (last_used)")
+
+            (self.num_entries,) = self.db.execute(
+                            "SELECT COUNT(*) FROM hashes").fetchone()
+
+    def get(self, key, kind):
+        result = None
+
+        if key is not None:
+            with self.lock, self.db:
+                row = self.db.execute("SELECT digest FROM hashes WHERE " +
+                        "dev=? AND ino=? AND size=? AND mtime_ns=? AND " +
+                        "kind=?", key + (kind,)).fetchone()
+
+                if row is not None:
+                    result = bytes(row[0])
+
+                    self.db.execute("UPDATE hashes SET last_used=? WHERE " +
+                            "dev=? AND ino=? AND size=? AND mtime_ns=? AND " +
+                            "kind=?", (time.time(),) + key + (kind,))
+
+        return result
+
+    def put(self, key, kind, digest):
+        with self.lock, self.db:
+            cursor = self.db.execute("INSERT OR REPLACE INTO hashes " +
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        key + (kind, digest, time.time()))
+
+            self.num_entries += cursor.rowcount
+
+            if self.num_entries > self.max_entries:
+                self.__evict()
+
+    # Remove the least recently used entries (the lock is already held)
+    def __evict(self):
+        keep = int(self.max_entries * EVICT_FRACTION)
+
+        (self.num_entries,) = self.db.execute(
+                            "SELECT COUNT(*) FROM hashes").fetchone()
+
+        if self.num_entries > keep:
+            self.db.execute("DELETE FROM hashes WHERE rowid IN (SELECT " +
+                            "rowid FROM hashes ORDER BY last_used LIMIT ?)",
+                            (self.num_entries - keep,))
+
+            self.num_entries = keep
+
+    def contains(self, key, kind):
+        with self.lock:
+            row = self.db.execute("SELECT 1 FROM hashes WHERE " +
+                        "dev=? AND ino=? AND size=? AND mtime_ns=? AND " +
+                        "kind=?", key + (kind,)).fetchone()
+
+        return row is not None
+
+    #
+    #   Return the cached digest of a file, or compute (and cache) it.
+    #   It is only cached if the file did not change while it was hashed.
+    #
+    def lookup(self, path, kind, compute):
+        key = file_key(path)
+        result = self.get(key, kind)
+
+        if result is None:
+            result = compute(path)
+
+            if (result is not None) and (key is not None) and \
+                    (file_key(path) == key):
+                self.put(key, kind, result)
+
+        return result
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+#
+#   Hash the files under "roots" that are not in the cache yet (both the
+#   SHA-512 and the default tree hash, reading each file only once)
+#
+class HashWarmer(threading.Thread):
+    def __init__(self, cache, roots, is_idle):
+        threading.Thread.__init__(self, daemon=True)
+
+        self.cache = cache
+        self.roots = roots
+        self.is_idle = is_idle          # Returns True if the server is idle
+        self.leaf_size = usb_treehash.DEF_LEAF_SIZE
+
+    def wait_for_idle(self):
+        while not self.is_idle():
+            time.sleep(1)
+
+    def warm_file(self, path):
+        key = file_key(path)
+
+        if (key is not None) and \
+                (not self.cache.contains(key, KIND_SHA512)):
+            whole = hashlib.sha512()
+            leaf = hashlib.sha512()
+            leaf_len = 0
+            leaves = []
+
+            with open(path, "rb") as f:
+                self.wait_for_idle()
+                data = f.read(min(WARMER_CHUNK, self.leaf_size))
+
+                while len(data) > 0:
+                    whole.update(data)
+                    leaf.update(data)
+                    leaf_len += len(data)
+
+                    if leaf_len == self.leaf_size:
+                        leaves.append(leaf.digest())
+                        leaf = hashlib.sha512()
+                        leaf_len = 0
+
+                    self.wait_for_idle()
+                    data = f.read(min(WARMER_CHUNK,
+                                      self.leaf_size - leaf_len))
+
+            if leaf_len > 0:
+                leaves.append(leaf.digest())
+
+            # Skip files that changed while they were being hashed
+            if file_key(path) == key:
+                tree = usb_treehash.TreeHash(self.leaf_size, key[2], leaves)
+
+                self.cache.put(key, KIND_SHA512,
+                               whole.hexdigest().encode("latin1"))
+                self.cache.put(key, tree_kind(self.leaf_size),
+                               usb_treehash.pack_tree(tree))
+
+    def run(self):
+        while True:
+            for root in self.roots:
+                for (dirpath, dirnames, filenames) in os.walk(root):
+                    for name in filenames:
+                        path = os.path.join(dirpath, name)
+
+                        if os.path.isfile(path) and \
+                                (not os.path.islink(path)):
+                            try:
+                                self.warm_file(path)
+
+                            except OSError as my_except:
+                                print("Hash warmer could not read", path,
+                                      my_except, file=sys.stderr)
+
+            time.sleep(WARMER_RESCAN)
@@ -0,0 +1,178 @@
+#
+#   Background jobs - slow requests that the server handles in a pool of
+#   worker threads, so the link is not held up while it hashes a large
+#   file or lists a slow (e.g. NFS) directory
+#
+#   A client sends B<request> (only for the commands in usb_comm's
+#   JOB_CMDS).  If the request is done within JOB_GRACE seconds, the
+#   server just answers it.  Otherwise it answers p<job-id:8> straight
+#   away, and the client asks for the answer with O<job-id:8> now and
+#   then - it gets p<job-id:8> again until the job is done.  The answer
+#   to a job is only sent once, and answers that are not asked for
+#   within MAX_JOB_AGE seconds are thrown away.
+#
+#   A job is handled by a Server of its own on a CapturePort, which
+#   keeps (copies of) the packets it sends until they are asked for.
+#   Only requests whose answer starts with a single packet can be jobs
+#   (the rest of a longer answer comes from a transaction slot, as
+#   usual).
+#
+#   (see FEATURE_JOBS in usb_comm and "B" in PROTOCOL.txt)
+#
+
+import queue
+import sys
+import threading
+import time
+import traceback
+
+REQ_BACKGROUND = b"B"
+REQ_POLL = b"O"
+RESP_PENDING = b"p"
+
+DEF_WORKERS = 4
+
+MAX_JOBS = 255                  # Job ids are 1-255
+
+JOB_GRACE = 0.02                # In seconds
+MAX_JOB_AGE = 5 * 60            # In seconds
+
+# How often a client asks for the answer (doubling from the first)
+MIN_POLL_DELAY = 0.01           # In seconds
+MAX_POLL_DELAY = 0.5            # In seconds
+
+JOB_UNKNOWN = 0
+JOB_RUNNING = 1
+JOB_DONE = 2
+
+
+class CapturePort:
+    #
+    #   A port that hands out one request and keeps everything sent
+    #   back (as bytes, since the senders reuse their buffers)
+    #
+    def __init__(self, max_packet, request):
+        self.max_packet = max_packet
+        self.via_relay = False
+        self.request = request
+        self.packets = []
+
+    def send_packet(self, data):
+        self.packets.append(bytes(data))
+
+        return 1
+
+    def send_packet_vec(self, bufs):
+        self.packets.append(b"".join(bufs))
+
+        return 1
+
+    def receive_packet(self, timeout=None):
+        data = self.request
+        self.request = None
+
+        return data
+
+    def get_max_packet(self):
+        return self.max_packet
+
+    def setMaxPacket(self, new_size=-1):
+        return (self.max_packet, self.max_packet)
+
+
+class Job:
+    def __init__(self, work):
+        self.work = work                # Returns the packets to send
+        self.result = None
+        self.done = threading.Event()
+        self.finished_at = None
+
+
+class JobPool:
+    def __init__(self, num_workers=DEF_WORKERS):
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.pending = queue.Queue()
+        self.last_id = 0
+
+        for i in range(max(num_workers, 1)):
+            worker = threading.Thread(target=self.__worker)
+            worker.daemon = True        # Die with the main thread
+            worker.start()
+
+    def __worker(self):
+        while True:
+            job = self.pending.get()
+
+            try:
+                result = job.work()
+
+            except Exception as my_except:
+                print("usb_jobs: job failed", my_except, file=sys.stderr)
+                traceback.print_exc()
+
+                result = None
+
+            job.result = result
+            job.finished_at = time.time()
+            job.done.set()
+
+    #
+    #   Queue "work" (a function that returns the packets of the answer)
+    #   and return its job id, or None if every job id is in use
+    #
+    def start(self, work):
+        job_id = None
+
+        with self.lock:
+            self.__expire()
+
+            # (the next free id after the last one - not reused soon)
+            for i in range(MAX_JOBS):
+                next_id = (self.last_id + i) % MAX_JOBS + 1
+
+                if (job_id is None) and (next_id not in self.jobs):
+                    job_id = next_id
+
+            if job_id is not None:
+                self.last_id = job_id
+                self.jobs[job_id] = Job(work)
+                self.pending.put(self.jobs[job_id])
+
+        return job_id
+
+    # Forget the answers nobody asked for (the lock is already held)
+    def __expire(self):
+        too_old = time.time() - MAX_JOB_AGE
+
+        for (job_id, job) in list(self.jobs.items()):
+            if (job.finished_at is not None) and (job.finished_at < too_old):
+                del self.jobs[job_id]
+
+    # Wait up to "timeout" seconds for a job, True if it is done
+    def wait(self, job_id, timeout):
+        job = self.jobs.get(job_id)
+
+        return (job is not None) and job.done.wait(timeout)
+
+    #
+    #   Returns (JOB_UNKNOWN, None), (JOB_RUNNING, None) or (JOB_DONE,
+    #   packets) - a job that is done is forgotten
+    #
+    def take(self, job_id):
+        result = (JOB_UNKNOWN, None)
+
+        with self.lock:
+            job = self.jobs.get(job_id)
+
+            if job is None:
+                pass
+
+            elif not job.done.is_set():
+                result = (JOB_RUNNING, None)
+
+            else:
+                del self.jobs[job_id]
+                result = (JOB_DONE, job.result)
+
+        return result
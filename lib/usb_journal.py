@@ -0,0 +1,330 @@
+#
+#   Change journal for the "J" (changes since) command
+#
+#   Every change to a file or directory under the watched roots is given
+#   the next generation number and kept (in memory) in a bounded list.
+#   A client remembers the generation it last saw and later asks for the
+#   changes since then, so it only has to look at what changed.  If the
+#   journal no longer has all of those changes (it was truncated, events
+#   were lost or the server restarted - which picks a new journal id)
+#   the client is told to do a full resync instead.
+#
+#   Changes are found with inotify (called through ctypes) or, for
+#   filesystems that do not support it (e.g. NFS), by rescanning the
+#   tree every so often and comparing it to the last scan.
+#
+
+import collections
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import sys
+import threading
+import time
+
+DEF_JOURNAL_SIZE = 100000
+
+# Seconds between rescans of trees that cannot use inotify
+DEF_RESCAN_TIME = 600
+
+CHANGE_CREATED = ord("c")
+CHANGE_DELETED = ord("d")
+CHANGE_MODIFIED = ord("m")
+
+# Filesystems where inotify does not see changes made by other hosts
+RESCAN_FS_TYPES = ["nfs", "nfs4", "cifs", "smb3", "fuse.sshfs"]
+
+# From /usr/include/linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+             IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR | \
+             IN_DONT_FOLLOW
+
+event_struct = struct.Struct("iIII")
+
+id_gen_struct = struct.Struct("<QQ")
+
+
+class ChangeJournal:
+    def __init__(self, max_entries=DEF_JOURNAL_SIZE):
+        self.lock = threading.Lock()
+
+        # A new id each time the server starts (old generations are void)
+        self.journal_id = time.time_ns()
+
+        self.generation = 0
+        self.truncated_gen = 0          # Changes up to here are gone
+        self.changes = collections.deque()
+        self.max_entries = max_entries
+
+    def record(self, path, kind):
+        with self.lock:
+            self.generation += 1
+            self.changes.append((self.generation, kind, path))
+
+            while len(self.changes) > self.max_entries:
+                (self.truncated_gen, old_kind, old_path) = \
+                        self.changes.popleft()
+
+    # Forget everything so far (e.g. events were lost)
+    def truncate(self):
+        with self.lock:
+            self.generation += 1
+            self.truncated_gen = self.generation
+            self.changes.clear()
+
+    #
+    #   Returns (journal id, current generation, changes) where changes
+    #   is a list of (kind, path) under "prefix" (a real path ending in a
+    #   "/") since "generation", or None if a full resync is needed
+    #
+    def changes_since(self, journal_id, generation, prefix):
+        result = None
+
+        with self.lock:
+            if (journal_id == self.journal_id) and \
+                    (generation >= self.truncated_gen) and \
+                    (generation <= self.generation):
+                result = []
+
+                for (gen, kind, path) in reversed(self.changes):
+                    if gen <= generation:
+                        break
+
+                    if path.startswith(prefix):
+                        result.append((kind, path[len(prefix):]))
+
+                result.reverse()
+
+            current = self.generation
+
+        return (self.journal_id, current, result)
+
+
+#
+#   Use /proc/mounts to find the type of filesystem that holds a path
+#
+def filesystem_type(path):
+    result = None
+    best = b""
+
+    try:
+        with open("/proc/mounts", "rb") as f:
+            for line in f:
+                parts = line.split()
+
+                if len(parts) >= 3:
+                    mountpoint = parts[1].replace(b"\\040", b" ")
+
+                    if (path == mountpoint) or \
+                            path.startswith(mountpoint.rstrip(b"/") + b"/"):
+                        if len(mountpoint) >= len(best):
+                            best = mountpoint
+                            result = parts[2].decode("latin1")
+
+    except OSError as my_except:
+        result = None
+
+    return result
+
+
+#
+#   Watch a tree with inotify.  Raises OSError if inotify cannot be used
+#   (or the tree has more directories than inotify allows to be watched)
+#
+class InotifyWatcher(threading.Thread):
+    def __init__(self, journal, root):
+        threading.Thread.__init__(self, daemon=True)
+
+        self.journal = journal
+        self.root = root.rstrip(b"/")
+        self.wd_to_path = {}
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.add_tree(self.root)
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+
+        if wd >= 0:
+            self.wd_to_path[wd] = path
+
+        elif ctypes.get_errno() == errno.ENOSPC:
+            raise OSError(errno.ENOSPC, "Too many directories to watch " +
+                          "(see fs.inotify.max_user_watches)")
+
+    def add_tree(self, top):
+        self.add_watch(top)
+
+        for (dirpath, dirnames, filenames) in os.walk(top):
+            for name in dirnames:
+                self.add_watch(os.path.join(dirpath, name))
+
+    def handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            print("Change journal lost events under", self.root,
+                  file=sys.stderr)
+            self.journal.truncate()
+
+        elif mask & IN_IGNORED:
+            self.wd_to_path.pop(wd, None)
+
+        elif wd in self.wd_to_path:
+            path = self.wd_to_path[wd]
+
+            if len(name) > 0:
+                path = path + b"/" + name
+
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.journal.record(path, CHANGE_CREATED)
+
+                # Watch new directories too (and what is already in them)
+                if mask & IN_ISDIR:
+                    try:
+                        self.add_tree(path)
+
+                    except OSError as my_except:
+                        print("Change journal cannot watch", path, my_except,
+                              file=sys.stderr)
+                        self.journal.truncate()
+
+            elif mask & (IN_DELETE | IN_MOVED_FROM | IN_DELETE_SELF):
+                self.journal.record(path, CHANGE_DELETED)
+
+            else:
+                self.journal.record(path, CHANGE_MODIFIED)
+
+    def run(self):
+        while True:
+            data = os.read(self.fd, 64 * 1024)
+            pos = 0
+
+            while pos + event_struct.size <= len(data):
+                (wd, mask, cookie, name_len) = event_struct.unpack_from(data,
+                                                                        pos)
+                pos += event_struct.size
+
+                name = data[pos:pos + name_len].rstrip(b"\0")
+                pos += name_len
+
+                self.handle_event(wd, mask, name)
+
+
+#
+#   Find changes by comparing scans of the tree (for NFS and the like)
+#
+class RescanWatcher(threading.Thread):
+    def __init__(self, journal, root, rescan_time=DEF_RESCAN_TIME):
+        threading.Thread.__init__(self, daemon=True)
+
+        self.journal = journal
+        self.root = root.rstrip(b"/")
+        self.rescan_time = rescan_time
+
+    def scan(self):
+        result = {}
+
+        for (dirpath, dirnames, filenames) in os.walk(self.root):
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+
+                try:
+                    st = os.lstat(path)
+                    result[path] = (st.st_mode, st.st_size, st.st_mtime_ns,
+                                    st.st_ctime_ns)
+
+                except OSError as my_except:
+                    pass        # Went away during the scan
+
+        return result
+
+    def run(self):
+        last = self.scan()
+
+        while True:
+            time.sleep(self.rescan_time)
+
+            now = self.scan()
+
+            for path in sorted(last.keys() - now.keys()):
+                self.journal.record(path, CHANGE_DELETED)
+
+            for path in sorted(now):
+                old = last.get(path)
+
+                if old is None:
+                    self.journal.record(path, CHANGE_CREATED)
+
+                elif old != now[path]:
+                    self.journal.record(path, CHANGE_MODIFIED)
+
+            last = now
+
+
+#
+#   Start watching a root (with inotify unless it is on a filesystem
+#   that needs rescanning, or inotify fails)
+#
+def watch_root(journal, root, rescan_time=DEF_RESCAN_TIME):
+    watcher = None
+
+    if filesystem_type(root) not in RESCAN_FS_TYPES:
+        try:
+            watcher = InotifyWatcher(journal, root)
+
+        except (OSError, AttributeError) as my_except:
+            print("Cannot use inotify for", root, "(" + str(my_except) + ")",
+                  "- rescanning instead", file=sys.stderr)
+
+    if watcher is None:
+        watcher = RescanWatcher(journal, root, rescan_time)
+
+    watcher.start()
+
+    return watcher
+
+
+# <kind:8bit><path_len:16bit><path> (the records of a "J" response)
+def pack_changes(changes):
+    data = bytearray(0)
+
+    for (kind, path) in changes:
+        data += bytes([kind]) + struct.pack("<H", len(path)) + path
+
+    return data
+
+
+def unpack_changes(data, pos=0):
+    result = []
+
+    while pos + 3 <= len(data):
+        kind = data[pos]
+        (path_len,) = struct.unpack_from("<H", data, pos + 1)
+        pos += 3
+
+        result.append((kind, bytes(data[pos:pos + path_len])))
+        pos += path_len
+
+    return result
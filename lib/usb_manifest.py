@@ -0,0 +1,226 @@
+#
+#   Recursive manifest of a directory tree for the "E" command
+#
+#   The manifest is a stream of records, each one prefixed by its length
+#   so that it can be parsed as it arrives:
+#
+#       <len:32bit><type:8bit><path_len:16bit><path>...
+#
+#   where "path" is relative to the directory that was asked for ("/"
+#   between the parts) and "type" is one of:
+#
+#       e - an entry, followed by <stat record><link_len:16bit><link>
+#           <digest_len:8bit><digest>  (same stat record as "A", the
+#           link is "" if not a symlink, and the digest is the SHA-512
+#           of the file if the server had it cached, otherwise empty)
+#       ! - a directory that could not be read
+#       $ - the end of the manifest (with an empty path)
+#
+#   Directories are walked depth first, with the entries of each
+#   directory sent before the contents of its subdirectories.
+#
+
+import io
+import os
+import stat
+import struct
+
+RECORD_ENTRY = ord("e")
+RECORD_UNREADABLE = ord("!")
+RECORD_END = ord("$")
+
+# Flags of an "E" request
+MANIFEST_DIGESTS = 0x01         # Include the (cached) digests of files
+
+MAX_MANIFEST_DEPTH = 255
+
+# Same as the stat records in an "A" listing
+stat_long_struct = struct.Struct("<BHQqq")
+
+len_struct = struct.Struct("<L")
+two_byte_struct = struct.Struct("<H")
+
+
+def pack_record(rec_type, path, data=b""):
+    body = bytes([rec_type]) + two_byte_struct.pack(len(path)) + path + data
+
+    return len_struct.pack(len(body)) + body
+
+
+def pack_entry(path, stat_res, is_symlink, link, digest):
+    flags = stat.S_ISDIR(stat_res.st_mode)
+
+    if stat.S_ISREG(stat_res.st_mode):
+        flags = flags | 0x02
+
+    if is_symlink:
+        flags = flags | 0x80
+
+    return pack_record(RECORD_ENTRY, path,
+                       stat_long_struct.pack(flags,
+                                             stat.S_IMODE(stat_res.st_mode),
+                                             stat_res.st_size,
+                                             int(stat_res.st_mtime),
+                                             int(stat_res.st_ctime)) +
+                       two_byte_struct.pack(len(link)) + link +
+                       bytes([len(digest)]) + digest)
+
+
+#
+#   A (raw) file object that walks the tree as it is read and returns
+#   the manifest.  Meant to be wrapped by io.BufferedReader.
+#
+#       link_dest(path) returns the destination of a symlink (or None if
+#       the link should not be listed)
+#
+#       get_digest(path, stat_res) returns the digest of a file (or None)
+#
+class ManifestReader(io.RawIOBase):
+    def __init__(self, realpath, max_depth, link_dest, get_digest=None):
+        self.root = realpath
+        self.max_depth = max_depth
+        self.link_dest = link_dest
+        self.get_digest = get_digest
+
+        self.stack = [(b"", 0)]         # (relative path, depth) to walk
+
+        self.pending = bytearray(0)
+        self.at_eof = False
+
+    def readable(self):
+        return True
+
+    def next_dir(self):
+        (reldir, depth) = self.stack.pop()
+        subdirs = []
+
+        try:
+            all_items = list(os.scandir(os.path.join(self.root, reldir)))
+
+        except OSError as my_except:
+            all_items = None
+            self.pending += pack_record(RECORD_UNREADABLE, reldir)
+
+        for item in (all_items or []):
+            link = b""
+            link_ok = True
+
+            if item.is_symlink():
+                link = self.link_dest(item.path)
+                link_ok = link is not None
+
+            # Same rules as "A" (only files, dirs and good symlinks)
+            if link_ok and (item.is_dir() or item.is_file()):
+                try:
+                    stat_res = item.stat()
+
+                except OSError as my_except:
+                    stat_res = None
+
+                if stat_res is not None:
+                    relpath = item.name
+
+                    if reldir != b"":
+                        relpath = reldir + b"/" + item.name
+
+                    digest = None
+
+                    if (self.get_digest is not None) and item.is_file():
+                        digest = self.get_digest(item.path, stat_res)
+
+                    self.pending += pack_entry(relpath, stat_res,
+                                               item.is_symlink(), link,
+                                               digest or b"")
+
+                    # (do not follow symlinks into other directories)
+                    if item.is_dir() and (not item.is_symlink()) and \
+                            (depth < self.max_depth):
+                        subdirs.append((relpath, depth + 1))
+
+        # Walk the first subdirectory next
+        subdirs.reverse()
+        self.stack.extend(subdirs)
+
+    def readinto(self, b):
+        # Fill up as much as possible (a short read means end of file)
+        while (len(self.pending) < len(b)) and (not self.at_eof):
+            if len(self.stack) > 0:
+                self.next_dir()
+            else:
+                self.pending += pack_record(RECORD_END, b"")
+                self.at_eof = True
+
+        num_bytes = min(len(b), len(self.pending))
+
+        b[:num_bytes] = self.pending[:num_bytes]
+        del self.pending[:num_bytes]
+
+        return num_bytes
+
+
+#
+#   Client side - feed() returns the records that are complete so far
+#   as (type, path, stat record, link, digest) tuples (the last three
+#   are None except for entries).  "ended" is set by the end record.
+#
+class ManifestParser:
+    def __init__(self):
+        self.buf = bytearray(0)
+        self.ended = False
+
+    def parse_record(self, body):
+        rec_type = body[0]
+        (path_len,) = two_byte_struct.unpack_from(body, 1)
+
+        pos = 1 + two_byte_struct.size
+        path = bytes(body[pos:pos + path_len])
+        pos += path_len
+
+        stat_res = None
+        link = None
+        digest = None
+
+        if rec_type == RECORD_ENTRY:
+            stat_res = stat_long_struct.unpack_from(body, pos)
+            pos += stat_long_struct.size
+
+            (link_len,) = two_byte_struct.unpack_from(body, pos)
+            pos += two_byte_struct.size
+
+            link = bytes(body[pos:pos + link_len])
+            pos += link_len
+
+            digest_len = body[pos]
+            digest = bytes(body[pos + 1:pos + 1 + digest_len])
+
+        elif rec_type == RECORD_END:
+            self.ended = True
+
+        elif rec_type != RECORD_UNREADABLE:
+            raise ValueError("Unknown manifest record " + str(rec_type))
+
+        return (rec_type, path, stat_res, link, digest)
+
+    def feed(self, data):
+        result = []
+        pos = 0
+
+        self.buf += data
+
+        while len(self.buf) - pos >= len_struct.size:
+            (rec_len,) = len_struct.unpack_from(self.buf, pos)
+
+            if len(self.buf) - pos - len_struct.size < rec_len:
+                break
+
+            pos += len_struct.size
+
+            if self.ended:
+                raise ValueError("Data after the end of a manifest")
+
+            result.append(self.parse_record(self.buf[pos:pos + rec_len]))
+            pos += rec_len
+
+        del self.buf[:pos]
+
+        return result
@@ -0,0 +1,195 @@
+#
+#   Client side cache of what t-mirror saw last time (--trust-cache)
+#
+#   For every remote directory that was mirrored, the remote mtime and
+#   ctime, the local mtime (in ns, after it was mirrored) and the names
+#   of its subdirectories are kept in a sqlite database next to the
+#   local tree.  A directory whose remote times and local mtime are the
+#   same as last time has the same entries, so it does not have to be
+#   listed again - only its subdirectories have to be looked at.
+#
+#   (a file that is rewritten in place does not change the times of its
+#   directory, so that is only found by a full run, e.g. --revalidate,
+#   or by the change journal below)
+#
+#   The remote times have to come from a listing ("A") or a manifest
+#   ("E"), which stat every entry, and not from "S", which the server
+#   (and a relay) may answer from a stat cache.
+#
+#   Without a manifest, the times would only be known by listing the
+#   directories.  If the server keeps a change journal ("J"), the
+#   generation that the cache is up to date with is kept as well, and a
+#   directory that the journal saw no changes in since then is known to
+#   be unchanged without looking at it at all (its times, and those of
+#   its subdirectories, are the ones in the cache).
+#
+
+import os
+import sqlite3
+import time
+
+# Directories that changed this close to the start of the run are not
+#  kept (their times are in seconds, so a change in the same second as
+#  the listing would not be seen)
+RACY_SECONDS = 2
+
+
+def cache_name(local_dir):
+    return local_dir.rstrip("/") + ".t-mirror.db"
+
+
+def local_mtime(path):
+    result = None
+
+    try:
+        result = os.stat(path).st_mtime_ns
+
+    except OSError as my_except:
+        result = None
+
+    return result
+
+
+class MirrorCache:
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.start_time = time.time()
+
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS dirs (" +
+                            "remote_path TEXT PRIMARY KEY, " +
+                            "remote_mtime INTEGER, remote_ctime INTEGER, " +
+                            "local_path TEXT, local_mtime_ns INTEGER, " +
+                            "subdirs TEXT)")
+
+            self.db.execute("CREATE TABLE IF NOT EXISTS journal (" +
+                            "remote_path TEXT PRIMARY KEY, " +
+                            "journal_id INTEGER, generation INTEGER)")
+
+        # The remote directories with changes since the last run (None if
+        #  the journal is not used), and the journal state of this run
+        self.changed_dirs = None
+        self.new_journal = None
+
+    #
+    #   Returns the names of the subdirectories if nothing changed in the
+    #   directory since it was mirrored (or None if it has to be listed)
+    #
+    def unchanged_subdirs(self, remote_dir, r_stat, local_dir):
+        result = None
+
+        row = self.db.execute("SELECT remote_mtime, remote_ctime, " +
+                              "local_path, local_mtime_ns, subdirs " +
+                              "FROM dirs WHERE remote_path=?",
+                              (remote_dir,)).fetchone()
+
+        if (self.changed_dirs is not None) and \
+                (remote_dir in self.changed_dirs):
+            row = None
+
+        if (row is not None) and (r_stat is not None) and \
+                (row[0] == r_stat["mtime"]) and \
+                (row[1] == r_stat["ctime"]) and (row[2] == local_dir) and \
+                (row[3] == local_mtime(local_dir)):
+            result = []
+
+            if row[4] != "":
+                result = row[4].split("/")
+
+        return result
+
+    # Remember a directory that was just mirrored
+    def put(self, remote_dir, r_stat, local_dir, subdirs):
+        mtime_ns = local_mtime(local_dir)
+
+        if (r_stat is not None) and (mtime_ns is not None) and \
+                (max(r_stat["mtime"], r_stat["ctime"]) <
+                 self.start_time - RACY_SECONDS):
+            self.db.execute("INSERT OR REPLACE INTO dirs " +
+                            "VALUES (?, ?, ?, ?, ?, ?)",
+                            (remote_dir, r_stat["mtime"], r_stat["ctime"],
+                             local_dir, mtime_ns, "/".join(sorted(subdirs))))
+        else:
+            self.forget(remote_dir)
+
+    # Forget a directory (so it is listed next time)
+    def forget(self, remote_dir):
+        self.db.execute("DELETE FROM dirs WHERE remote_path=?", (remote_dir,))
+
+    #
+    #   The times of a remote directory when it was mirrored (as an
+    #   r_stat with only those), or None if they are not known to be
+    #   right (not in the cache, changed, or the journal is not used)
+    #
+    def cached_stat(self, remote_dir):
+        result = None
+        row = None
+
+        if (self.changed_dirs is not None) and \
+                (remote_dir not in self.changed_dirs):
+            row = self.db.execute("SELECT remote_mtime, remote_ctime " +
+                                  "FROM dirs WHERE remote_path=?",
+                                  (remote_dir,)).fetchone()
+
+        if row is not None:
+            result = {"is_dir": 1, "is_file": 0, "is_symlink": 0,
+                      "mtime": row[0], "ctime": row[1]}
+
+        return result
+
+    #
+    #   The journal id and generation of the server that the cache is up
+    #   to date with for "remote_dir" ((0, 0) if not known)
+    #
+    def journal_state(self, remote_dir):
+        result = (0, 0)
+
+        row = self.db.execute("SELECT journal_id, generation " +
+                              "FROM journal WHERE remote_path=?",
+                              (remote_dir,)).fetchone()
+
+        if row is not None:
+            result = (row[0], row[1])
+
+        return result
+
+    #
+    #   The answer of the journal (asked for before anything is looked
+    #   at): "changes" is a list of (kind, path) under "remote_dir", or
+    #   None if they are not known.  The directories with no changes in
+    #   them are then known to be unchanged, and the journal state is
+    #   kept by end_journal().
+    #
+    def use_journal(self, remote_dir, journal_id, generation, changes):
+        self.new_journal = (remote_dir, journal_id, generation)
+
+        if changes is not None:
+            self.changed_dirs = set()
+
+            # (the entry itself, e.g. a directory that was replaced, and
+            #  the directory it is in - named like t-mirror names them)
+            for (kind, path) in changes:
+                full_path = remote_dir + "/" + path
+
+                self.changed_dirs.add(full_path)
+                self.changed_dirs.add(full_path.rsplit("/", 1)[0])
+
+    def journal_in_use(self):
+        return self.changed_dirs is not None
+
+    #
+    #   Keep the journal state if everything was mirrored (or forget it,
+    #   so that the next run does not trust the journal)
+    #
+    def end_journal(self, ok):
+        if self.new_journal is not None:
+            if ok:
+                self.db.execute("INSERT OR REPLACE INTO journal " +
+                                "VALUES (?, ?, ?)", self.new_journal)
+            else:
+                self.db.execute("DELETE FROM journal WHERE remote_path=?",
+                                (self.new_journal[0],))
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,159 @@
+#
+#   Faster path checks for the server ("path_is_good")
+#
+#   Every request checks its path: the aliases are replaced, the real
+#   path is found (one lstat for each part of it), it has to be under an
+#   allowed directory, and it has to be a file or a directory.  Some
+#   requests check several paths (e.g. each symlink in a listing).
+#
+#   PrefixTrie finds the alias (or allowed directory) that a path starts
+#   with by walking the parts of the path once, instead of trying every
+#   prefix in turn.
+#
+#   PathCache keeps the paths that were allowed (not the ones that were
+#   not - a file may be created at any time).  The real path is still
+#   found again for every request, so a symlink that now points
+#   elsewhere is checked again; what is saved is the check of the
+#   allowed directories and the stat of the file.  Without a change
+#   journal (see usb_journal) an answer is kept for up to "ttl" seconds.
+#   With one, it is kept until the journal shows that the path changed.
+#
+
+import threading
+import time
+
+DEF_MAX_ENTRIES = 10000
+DEF_TTL = 5                     # In seconds, without a journal (0 = none)
+
+# More changes than this at once and the whole cache is dropped
+MAX_CHANGES = 100
+
+
+def path_parts(p):
+    return p.rstrip(b"/").split(b"/")
+
+
+#
+#   Paths (as bytes) and a value for each, e.g. the real path of an
+#   alias.  A path matches a prefix only as a whole, so "/data/" is a
+#   prefix of "/data/x" and "/data", but not of "/database".
+#
+class PrefixTrie:
+    def __init__(self):
+        # (each node is a dict of parts, and the value is under None)
+        self.root = {}
+
+    # (the first value given for a prefix is kept)
+    def insert(self, prefix, value):
+        node = self.root
+
+        for part in path_parts(prefix):
+            node = node.setdefault(part, {})
+
+        node.setdefault(None, value)
+
+    #
+    #   Returns (value, rest) for the longest prefix of "p" in the trie,
+    #   where rest is the list of the parts of "p" after it, or (None,
+    #   None) if none of them is a prefix of "p"
+    #
+    def longest_match(self, p):
+        result = (None, None)
+        parts = p.split(b"/")
+        node = self.root
+        i = 0
+
+        while (node is not None) and (i < len(parts)):
+            node = node.get(parts[i])
+            i += 1
+
+            if (node is not None) and (None in node):
+                result = (node[None], parts[i:])
+
+        return result
+
+    def has_prefix_of(self, p):
+        (value, rest) = self.longest_match(p)
+
+        return rest is not None
+
+
+#
+#   The (allowed) answers of path_is_good() by the path asked for
+#
+class PathCache:
+    def __init__(self, ttl=DEF_TTL, max_entries=DEF_MAX_ENTRIES,
+                 journal=None):
+        self.lock = threading.Lock()
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        # path -> (time, unaliased path, answer), oldest first
+        self.entries = {}
+
+        self.seen_gen = 0
+        self.set_journal(journal)
+
+    def set_journal(self, journal):
+        with self.lock:
+            self.journal = journal
+            self.entries.clear()
+
+            if journal is not None:
+                self.seen_gen = journal.generation
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    # Returns (unaliased path, answer), or (None, None) if not known
+    def get(self, p):
+        result = (None, None)
+
+        with self.lock:
+            self.__check_journal()
+
+            if p in self.entries:
+                (added, unaliased, answer) = self.entries[p]
+
+                if (self.journal is not None) or \
+                        (time.time() - added < self.ttl):
+                    result = (unaliased, answer)
+                else:
+                    del self.entries[p]
+
+        return result
+
+    def put(self, p, unaliased, answer):
+        with self.lock:
+            self.entries.pop(p, None)
+            self.entries[p] = (time.time(), unaliased, answer)
+
+            while len(self.entries) > self.max_entries:
+                del self.entries[next(iter(self.entries))]
+
+    #
+    #   Drop the answers for the paths that changed since the last look
+    #   (and for what is under them).  The lock is already held.
+    #
+    def __check_journal(self):
+        if (self.journal is not None) and \
+                (self.journal.generation != self.seen_gen):
+            (journal_id, self.seen_gen, changes) = \
+                    self.journal.changes_since(self.journal.journal_id,
+                                               self.seen_gen, b"")
+
+            if (changes is None) or (len(changes) > MAX_CHANGES):
+                self.entries.clear()
+
+            else:
+                changed = PrefixTrie()
+
+                for (kind, path) in changes:
+                    changed.insert(path, True)
+
+                for (p, (added, unaliased, answer)) in \
+                        list(self.entries.items()):
+                    if changed.has_prefix_of(unaliased) or \
+                            changed.has_prefix_of(answer[1]):
+                        del self.entries[p]
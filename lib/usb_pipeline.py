@@ -0,0 +1,154 @@
+#
+#   Pipelining - more than one request in flight on a USB link at a time
+#
+#   The relay sends each request as I<tag:8><request>, and the server
+#   answers it (in a thread of its own for each tag, so the answers to
+#   different tags can come back in any order) with every response packet
+#   sent as i<tag:8><packet>.  A tag is only used for one request at a
+#   time, so the packets that come back for a tag are simply the
+#   responses to its request, in order.  A request that has no response
+#   at all (e.g. a "W" for a finished transaction) is answered with an
+#   empty i<tag:8>, so the relay does not have to wait for a timeout.
+#
+#   On both sides a tag looks like a port of its own (TaggedPort) whose
+#   max packet size leaves room for the two byte envelope, so usb_comm's
+#   Client and Server can use it without knowing about tags at all.
+#
+#   (see FEATURE_PIPELINE in usb_comm and "I" in PROTOCOL.txt)
+#
+
+import os
+import queue
+import sys
+import threading
+import traceback
+
+REQ_TAGGED = b"I"
+RESP_TAGGED = b"i"
+
+# Requests the relay keeps in flight (1 = one at a time, without tags)
+DEF_MAX_IN_FLIGHT = 8
+
+# Tags (and so threads) that a server handles at once
+MAX_TAGS = 32
+
+
+class TaggedPort:
+    #
+    #   "code" is put in front of every packet sent (with the tag), and
+    #   whoever reads the real port puts the packets for this tag in
+    #   "packets".  The side that asks ("drop_stale") throws away what is
+    #   left of an earlier answer (e.g. after a timeout) when it sends.
+    #
+    def __init__(self, raw_port, send_lock, code, tag, drop_stale=False):
+        self.raw_port = raw_port
+        self.send_lock = send_lock
+        self.header = code + bytes([tag])
+        self.tag = tag
+        self.drop_stale = drop_stale
+
+        self.max_packet = raw_port.max_packet - len(self.header)
+        self.via_relay = raw_port.via_relay
+
+        self.packets = queue.Queue()
+        self.answered = True            # Was anything sent since the
+                                        #  last packet arrived?
+
+    def send_packet(self, data):
+        if self.drop_stale:
+            while not self.packets.empty():
+                self.packets.get()
+
+        self.answered = True
+
+        with self.send_lock:
+            retval = self.raw_port.send_packet(self.header + data)
+
+        return retval
+
+    def send_packet_vec(self, bufs):
+        if self.drop_stale:
+            while not self.packets.empty():
+                self.packets.get()
+
+        self.answered = True
+
+        with self.send_lock:
+            retval = self.raw_port.send_packet_vec([self.header] + list(bufs))
+
+        return retval
+
+    # An empty packet (the end of an answer with no response) is None
+    def receive_packet(self, timeout=None):
+        try:
+            data = self.packets.get(timeout=timeout)
+
+        except queue.Empty:
+            data = None
+
+        if data is not None:
+            self.answered = False
+
+            if len(data) == 0:
+                data = None
+
+        return data
+
+    def get_max_packet(self):
+        return self.max_packet
+
+    def setMaxPacket(self, new_size=-1):
+        old_size = self.max_packet
+
+        # (never more than fits in the envelope)
+        if (new_size < 64) or \
+                (new_size > self.raw_port.max_packet - len(self.header)):
+            new_size = self.raw_port.max_packet - len(self.header)
+
+        self.max_packet = new_size
+
+        return (old_size, new_size)
+
+
+#
+#   The relay's side - reads everything that comes back from the server
+#   and hands each packet to the port of its tag
+#
+class Demultiplexer(threading.Thread):
+    def __init__(self, raw_port):
+        threading.Thread.__init__(self, daemon=True)
+
+        self.raw_port = raw_port
+        self.send_lock = threading.Lock()
+        self.ports = {}
+
+    def add_port(self, tag):
+        port = TaggedPort(self.raw_port, self.send_lock, REQ_TAGGED, tag,
+                          drop_stale=True)
+        self.ports[tag] = port
+
+        return port
+
+    def run(self):
+        while True:
+            try:
+                data = self.raw_port.receive_packet()
+
+            except Exception as my_except:
+                print("usb_pipeline: receive_packet failed", my_except,
+                      file=sys.stderr)
+                traceback.print_exc()
+
+                os._exit(1)
+
+            if (data is None) or (len(data) == 0):
+                pass            # (zero length packets are skipped)
+
+            elif (len(data) >= 2) and (data[0] == RESP_TAGGED[0]) and \
+                    (data[1] in self.ports):
+                # (a copy - the port may reuse its buffer)
+                self.ports[data[1]].packets.put(bytes(data[2:]))
+
+            else:
+                print("usb_pipeline: dropping an untagged packet",
+                      bytes(data[:2]), file=sys.stderr)
@@ -0,0 +1,177 @@
+#
+#   Read-ahead for files sent by the server
+#
+#   Without it, each packet of a file is read from the disk only after
+#   the client asked for it, so the latency of the disk (or NFS) and of
+#   the USB link add up for every packet.  A ReadAheadReader has a
+#   thread of its own that reads the file into a ring of large (page
+#   aligned) buffers while the packets before them are on the wire.
+#
+#   The kernel is told that the file is read sequentially (and what is
+#   about to be read), and that its pages are no longer needed once the
+#   transfer is done, so streaming large files does not push everything
+#   else (e.g. the directories and the hash cache) out of the page cache.
+#
+
+import collections
+import io
+import mmap
+import os
+import threading
+
+RING_BLOCKS = 4
+
+DEF_READ_AHEAD = 1024 * 1024            # Bytes in the ring (0 = none)
+
+
+# "advice" is the name, e.g. "POSIX_FADV_SEQUENTIAL"
+def advise(fd, offset, length, advice):
+    # (not every platform has it, and it is only a hint anyway)
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, advice))
+
+        except OSError as my_except:
+            pass
+
+
+#
+#   A (raw) file object that reads ahead of what was asked for in
+#   another (open) file, from where it is now, for up to "length" bytes
+#   (-1 = up to the end).  Meant to be wrapped by io.BufferedReader.
+#
+class ReadAheadReader(io.RawIOBase):
+    def __init__(self, f, length=-1, ring_bytes=DEF_READ_AHEAD):
+        self.f = f
+        self.fd = f.fileno()
+        self.start = f.tell()
+
+        self.end = None
+        if length >= 0:
+            self.end = self.start + length
+
+        self.block_size = max(ring_bytes // RING_BLOCKS, mmap.PAGESIZE)
+        self.block_size -= self.block_size % mmap.PAGESIZE
+
+        self.ring = mmap.mmap(-1, self.block_size * RING_BLOCKS)
+        self.ring_mv = memoryview(self.ring)
+
+        # Blocks that are waiting to be read into, and ones that were
+        #  (as (block, number of bytes)), in file order
+        self.cond = threading.Condition()
+        self.free = collections.deque(range(RING_BLOCKS))
+        self.filled = collections.deque()
+        self.used = 0                   # Bytes taken from filled[0]
+        self.at_eof = False
+        self.error = None
+        self.stopping = False
+
+        advise(self.fd, self.start, 0, "POSIX_FADV_SEQUENTIAL")
+
+        self.thread = threading.Thread(target=self.__reader)
+        self.thread.daemon = True       # Die with the main thread
+        self.thread.start()
+
+    def readable(self):
+        return True
+
+    def __reader(self):
+        offset = self.start
+        done = False
+
+        while not done:
+            with self.cond:
+                self.cond.wait_for(lambda: (len(self.free) > 0) or
+                                           self.stopping)
+                done = self.stopping
+
+                if not done:
+                    block = self.free.popleft()
+
+            if not done:
+                want = self.block_size
+
+                if self.end is not None:
+                    want = max(0, min(want, self.end - offset))
+
+                # (the kernel can start on the block after this one)
+                advise(self.fd, offset + want, self.block_size,
+                       "POSIX_FADV_WILLNEED")
+
+                first = block * self.block_size
+                num_bytes = 0
+                error = None
+
+                try:
+                    if want > 0:
+                        num_bytes = os.preadv(self.fd,
+                                    [self.ring_mv[first:first + want]],
+                                    offset)
+
+                except OSError as my_except:
+                    error = my_except
+
+                offset += num_bytes
+
+                with self.cond:
+                    self.error = error
+                    done = (error is not None) or (num_bytes == 0)
+
+                    if num_bytes > 0:
+                        self.filled.append((block, num_bytes))
+                    else:
+                        self.free.append(block)
+
+                    self.at_eof = done
+                    self.cond.notify_all()
+
+    def readinto(self, b):
+        num_bytes = 0
+        done = False
+
+        # Fill up as much as possible (a short read means end of file)
+        with self.cond:
+            while (num_bytes < len(b)) and (not done):
+                self.cond.wait_for(lambda: (len(self.filled) > 0) or
+                                           self.at_eof)
+
+                if len(self.filled) == 0:
+                    done = True
+
+                    if self.error is not None:
+                        raise self.error
+
+                else:
+                    (block, filled_bytes) = self.filled[0]
+
+                    first = block * self.block_size + self.used
+                    count = min(len(b) - num_bytes, filled_bytes - self.used)
+
+                    b[num_bytes:num_bytes + count] = \
+                            self.ring_mv[first:first + count]
+
+                    num_bytes += count
+                    self.used += count
+
+                    # All of this block was used?  Then read into it again
+                    if self.used == filled_bytes:
+                        self.filled.popleft()
+                        self.free.append(block)
+                        self.used = 0
+                        self.cond.notify_all()
+
+        return num_bytes
+
+    def close(self):
+        if not self.closed:
+            with self.cond:
+                self.stopping = True
+                self.cond.notify_all()
+
+            self.thread.join()
+
+            advise(self.fd, 0, 0, "POSIX_FADV_DONTNEED")
+
+            self.f.close()
+
+        super().close()
@@ -0,0 +1,257 @@
+#
+#   On-disk cache of file contents for the relay
+#
+#   The data of file requests ("G" and "F", and "X"/"V" which are kept
+#   apart for each compression/digest variant) is saved as it passes
+#   through the relay, so the next request for the same file can be
+#   answered from the local disk instead of going over USB again.
+#
+#   Files on their way through the relay are kept in a SpillFile (so
+#   the clients that share a download can each read it at their own
+#   pace), which is added to the cache once it is complete.
+#
+#   Entries are keyed by the remote path, size and mtime (taken from an
+#   "A" of the file just before it is used, and just after it was
+#   fetched), so a file that changed is a miss.  The least recently used
+#   entries are removed to keep the total under "max_bytes".  The index
+#   is a sqlite database in the same directory as the data, so the cache
+#   is kept across restarts.
+#
+
+import hashlib
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+INDEX_NAME = "index.db"
+
+# Files changed this close to the request may still be being written
+RACY_SECONDS = 2
+
+# The "variant" of plain file data ("G" and "F")
+VARIANT_PLAIN = b""
+
+
+class ContentCache:
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.used_bytes = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.db = sqlite3.connect(os.path.join(cache_dir, INDEX_NAME),
+                                  check_same_thread=False)
+
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS files (" +
+                            "path BLOB, variant BLOB, size INTEGER, " +
+                            "mtime INTEGER, name TEXT, bytes INTEGER, " +
+                            "last_used REAL, PRIMARY KEY (path, variant))")
+            self.db.execute("CREATE INDEX IF NOT EXISTS files_last_used " +
+                            "ON files (last_used)")
+
+            self.__remove_strays()
+
+            (self.used_bytes,) = self.db.execute(
+                            "SELECT COALESCE(SUM(bytes), 0) FROM files"
+                            ).fetchone()
+
+            # (in case the limit was lowered since the last run)
+            self.__evict(0)
+
+    def data_name(self, path, variant):
+        return hashlib.sha256(variant + b"\0" + path).hexdigest()
+
+    #
+    #   Remove data files that are not in the index (e.g. fills that were
+    #   cut short by a restart) and entries whose data file is gone.  The
+    #   lock is already held.
+    #
+    def __remove_strays(self):
+        names = set()
+
+        for (name,) in self.db.execute("SELECT name FROM files").fetchall():
+            if os.path.isfile(os.path.join(self.cache_dir, name)):
+                names.add(name)
+            else:
+                self.db.execute("DELETE FROM files WHERE name=?", (name,))
+
+        for name in os.listdir(self.cache_dir):
+            if (name not in names) and (not name.startswith(INDEX_NAME)):
+                try:
+                    os.unlink(os.path.join(self.cache_dir, name))
+
+                except OSError as my_except:
+                    print("Could not remove", name, "from the cache",
+                          my_except, file=sys.stderr)
+
+    #
+    #   Remove the least recently used entries until "new_bytes" more
+    #   fit under the limit (the lock is already held)
+    #
+    def __evict(self, new_bytes):
+        while (self.used_bytes + new_bytes > self.max_bytes) and \
+                (self.used_bytes > 0):
+            row = self.db.execute("SELECT path, variant, name, bytes " +
+                                  "FROM files ORDER BY last_used LIMIT 1"
+                                  ).fetchone()
+
+            if row is None:
+                self.used_bytes = 0
+            else:
+                self.__remove_entry(row[0], row[1], row[2], row[3])
+
+    def __remove_entry(self, path, variant, name, num_bytes):
+        self.db.execute("DELETE FROM files WHERE path=? AND variant=?",
+                        (path, variant))
+        self.used_bytes -= num_bytes
+
+        try:
+            os.unlink(os.path.join(self.cache_dir, name))
+
+        except OSError as my_except:
+            pass        # Already gone
+
+    #
+    #   Return the cached data (an open file) if the file is still the
+    #   same size and mtime, otherwise None
+    #
+    def lookup(self, path, variant, size, mtime):
+        result = None
+
+        with self.lock, self.db:
+            row = self.db.execute("SELECT size, mtime, name, bytes " +
+                                  "FROM files WHERE path=? AND variant=?",
+                                  (path, variant)).fetchone()
+
+            if row is None:
+                pass
+
+            elif (row[0] != size) or (row[1] != mtime):
+                self.__remove_entry(path, variant, row[2], row[3])
+
+            else:
+                try:
+                    result = open(os.path.join(self.cache_dir, row[2]), "rb")
+
+                except OSError as my_except:
+                    self.__remove_entry(path, variant, row[2], row[3])
+
+                if result is not None:
+                    self.db.execute("UPDATE files SET last_used=? " +
+                                    "WHERE path=? AND variant=?",
+                                    (time.time(), path, variant))
+
+        return result
+
+    # Should a file of this size and mtime be kept?
+    def can_keep(self, size, mtime):
+        return (size <= self.max_bytes) and \
+               (mtime < time.time() - RACY_SECONDS)
+
+    #
+    #   Add the (complete) data in a SpillFile to the cache.  The spill
+    #   file has to be in the cache directory (it is linked into place).
+    #
+    def keep(self, spill, path, variant, size, mtime):
+        name = self.data_name(path, variant)
+
+        # (a lost or repeated packet would change the length)
+        if (variant == VARIANT_PLAIN) and (spill.num_bytes != size):
+            pass
+
+        elif spill.failed or (spill.num_bytes > self.max_bytes):
+            pass
+
+        else:
+            with self.lock, self.db:
+                row = self.db.execute("SELECT name, bytes FROM files " +
+                                      "WHERE path=? AND variant=?",
+                                      (path, variant)).fetchone()
+
+                if row is not None:
+                    self.__remove_entry(path, variant, row[0], row[1])
+
+                self.__evict(spill.num_bytes)
+
+                try:
+                    os.link(spill.name, os.path.join(self.cache_dir, name))
+
+                except OSError as my_except:
+                    print("Could not add to the content cache:", my_except,
+                          file=sys.stderr)
+                    name = None
+
+                if name is not None:
+                    self.db.execute("INSERT INTO files " +
+                                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (path, variant, size, mtime, name,
+                                     spill.num_bytes, time.time()))
+                    self.used_bytes += spill.num_bytes
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+#
+#   The data of a file as it arrives, which can be read back (from any
+#   offset) while it is still being written.  The file is removed by
+#   close() (unless it was linked into a cache by then).
+#
+class SpillFile:
+    def __init__(self, spill_dir=None):
+        self.num_bytes = 0
+        self.failed = False
+
+        (self.fd, self.name) = tempfile.mkstemp(dir=spill_dir,
+                                                suffix=".tmp")
+
+    def write(self, data):
+        view = memoryview(data)
+
+        try:
+            while (not self.failed) and (len(view) > 0):
+                num_written = os.write(self.fd, view)
+                view = view[num_written:]
+                self.num_bytes += num_written
+
+        except OSError as my_except:
+            print("Could not write to the spill file:", my_except,
+                  file=sys.stderr)
+            self.failed = True
+
+    def read(self, offset, length):
+        return os.pread(self.fd, length, offset)
+
+    def close(self):
+        os.close(self.fd)
+
+        try:
+            os.unlink(self.name)
+
+        except OSError as my_except:
+            pass        # Already gone
+
+
+#
+#   A complete file (from the cache) that can be read like a SpillFile
+#
+class CachedFile:
+    def __init__(self, f):
+        self.fd = f.fileno()
+        self.f = f
+        self.num_bytes = os.fstat(self.fd).st_size
+        self.failed = False
+
+    def read(self, offset, length):
+        return os.pread(self.fd, length, offset)
+
+    def close(self):
+        self.f.close()
@@ -0,0 +1,137 @@
+#
+#   Tree (two level Merkle) hashes of files for the "T" command
+#
+#   The file is split into fixed size leaves, each leaf is hashed with
+#   SHA-512 (in a pool of threads - hashlib releases the GIL), and the
+#   root is the SHA-512 of the leaf size, the file size and all of the
+#   leaf hashes.  Comparing the leaf lists of two copies of a file tells
+#   which byte ranges are different.
+#
+
+import collections
+import concurrent.futures
+import hashlib
+import os
+import struct
+
+DEF_LEAF_SIZE = 4 * 1024 * 1024
+MIN_LEAF_SIZE = 64 * 1024
+MAX_LEAF_SIZE = 256 * 1024 * 1024
+
+DEF_WORKERS = os.cpu_count() or 1
+
+LEAF_LEN = hashlib.sha512().digest_size
+
+header_struct = struct.Struct("<LQ")
+
+TreeHash = collections.namedtuple("TreeHash",
+                                  ["leaf_size", "file_size", "leaves"])
+
+
+def clamp_leaf_size(leaf_size):
+    return max(MIN_LEAF_SIZE, min(leaf_size, MAX_LEAF_SIZE))
+
+
+def hash_leaf(data):
+    return hashlib.sha512(data).digest()
+
+
+#
+#   Hash a file one leaf at a time.  At most 2 leaves per worker are
+#   in memory at once.  Returns a TreeHash or None if it cannot be read.
+#
+def compute_tree_hash(path, leaf_size=DEF_LEAF_SIZE, workers=DEF_WORKERS):
+    result = None
+    leaves = []
+    file_size = 0
+
+    try:
+        f = open(path, "rb")
+
+    except Exception as my_except:
+        f = None
+
+    if f is not None:
+        with f, concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            in_flight = collections.deque()
+
+            data = f.read(leaf_size)
+
+            while len(data) > 0:
+                file_size += len(data)
+                in_flight.append(pool.submit(hash_leaf, data))
+
+                if len(in_flight) >= 2 * workers:
+                    leaves.append(in_flight.popleft().result())
+
+                data = f.read(leaf_size)
+
+            while len(in_flight) > 0:
+                leaves.append(in_flight.popleft().result())
+
+        result = TreeHash(leaf_size, file_size, leaves)
+
+    return result
+
+
+def tree_root(tree):
+    digest = hashlib.sha512(header_struct.pack(tree.leaf_size,
+                                               tree.file_size))
+
+    for leaf in tree.leaves:
+        digest.update(leaf)
+
+    return digest.hexdigest()
+
+
+# <leaf_size:32><file_size:64><leaf hashes...> (the "T" response)
+def pack_tree(tree):
+    return header_struct.pack(tree.leaf_size, tree.file_size) + \
+           b"".join(tree.leaves)
+
+
+def unpack_tree(data):
+    result = None
+
+    if len(data) >= header_struct.size:
+        (leaf_size, file_size) = header_struct.unpack_from(data, 0)
+        body = data[header_struct.size:]
+
+        if (leaf_size > 0) and (len(body) % LEAF_LEN == 0):
+            leaves = [bytes(body[i:i + LEAF_LEN])
+                      for i in range(0, len(body), LEAF_LEN)]
+
+            result = TreeHash(leaf_size, file_size, leaves)
+
+    return result
+
+
+#
+#   List the (offset, length) ranges of the "remote" file that are not
+#   the same in the "local" one (the trees must use the same leaf size)
+#
+def diff_ranges(local, remote):
+    ranges = []
+
+    for i in range(0, len(remote.leaves)):
+        if (i >= len(local.leaves)) or (local.leaves[i] != remote.leaves[i]):
+            offset = i * remote.leaf_size
+            length = min(remote.leaf_size, remote.file_size - offset)
+
+            # Merge with the previous range if they touch
+            if (len(ranges) > 0) and \
+                    (ranges[-1][0] + ranges[-1][1] == offset):
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + length)
+            else:
+                ranges.append((offset, length))
+
+    # Just a longer local file?  (all of the leaves match)
+    if (len(ranges) == 0) and (local.file_size != remote.file_size):
+        ranges.append((remote.file_size, 0))
+
+    return ranges
+
+
+def format_ranges(ranges):
+    return ", ".join(str(offset) + "-" + str(offset + length)
+                     for (offset, length) in ranges)